@@ -12,8 +12,54 @@ Use configuration.yaml to enable the user to easily tune a number of settings:
   the configured zone
 - Tolerance: the tolerance used to calculate the direction of travel in metres
   (to filter out small GPS co-ordinate changes
+- Refresh Interval: optional number of seconds after which the entity is
+  written even if its values have not changed, from a timer, so it is
+  re-written while no device reports a move. By default unchanged values
+  are never re-written
+- Distance Backend: exact (default), haversine or equirectangular. The fast
+  backends fall back to the exact calculation whenever their error could
+  change the published distance or direction of travel
+- Coalesce Window: optional number of seconds in which a burst of updates
+  is collected. Each device's updates collapse to its latest one, its
+  direction of travel is taken from its position before the window, and
+  the entity is written at most once per window. Off by default
+- Log Sample Rate / Log Rate Limit: per-event debug lines are only written
+  for every Nth update of a device, and at most this many times per device
+  per minute (defaults 1 and 10)
+- Persist: optionally keep the entity values and the last device positions
+  in .proximity.json in the configuration directory, so the entity comes
+  back with its last values after a restart and the direction of travel is
+  known from the first update of each device
+- Throttle Interval / Throttle Delta: optionally hold back writes where only
+  the distance changed until this many seconds per km of distance have
+  passed since the last write and the distance has changed by this fraction
+  of itself, so a device far from the zone is written rarely while one
+  close to it stays responsive. Changes of the direction of travel or the
+  nearest device are always written. A distance held back by the interval
+  is written once the interval has passed, even if the device has stopped
+- Trend Window: optional number of recent distances of each device (default
+  2, its previous and latest update) the direction of travel is taken from,
+  along the least-squares line through them, so GPS jitter does not flip
+  the direction back and forth
+- Top K: optionally publish the K devices nearest to the zone, with their
+  distances, in the nearest_devices attribute
+- Shadow Sample Rate: optionally check every Nth evaluated update against
+  the original full scan of the devices with exact distances, counting (in
+  the diagnostics entity) and logging any update where the published
+  distance, direction of travel or nearest device differs from it. Off by
+  default
+- Trace Size: optional number of evaluation stages (distance, in-zone scan,
+  ignored zone check, comparison, direction of travel and entity write) to
+  keep timings for. When set, the proximity.dump_trace service writes them
+  to a Chrome trace file (filename defaults to proximity_trace.json, a
+  relative filename is taken from the configuration directory). Tracing is
+  off by default
+- Diagnostics: set to false to leave out the diagnostics entity and the
+  timing of each evaluation it reports, e.g. for offline replays. On by
+  default
 
-Loging levels debug, info and error are in use
+Loging levels debug, info and error are in use. Info logs one summary line
+each time the entity is written; the per-event detail is at debug level
 
 Example configuration.yaml entry:
 proximity:
@@ -26,16 +72,78 @@ proximity:
     - device_tracker.eleanorsiphone
     - device_tracker.tsiphone
   tolerance: 50
+  refresh_interval: 3600
+  throttle_interval: 2
+  throttle_delta: 0.05
+  distance_backend: equirectangular
+  coalesce_window: 5
+  log_sample_rate: 10
+  log_rate_limit: 6
+  persist: true
+  top_k: 3
+  trend_window: 5
+  shadow_sample_rate: 100
+  trace_size: 10000
+  diagnostics: true
 """
 
+import json
 import logging
+import os
+import threading
+from bisect import bisect_left, insort
+from collections import OrderedDict, deque, namedtuple
+from math import asin, cos, hypot, radians, sin, sqrt
+from time import perf_counter
 # import re
-from homeassistant.helpers.event import track_state_change
+from datetime import timedelta
+from homeassistant.helpers.event import (
+    track_point_in_utc_time, track_state_change)
 from homeassistant.helpers.entity import Entity
 # import homeassistant.util as util
 from homeassistant.util.location import distance
+import homeassistant.util.dt as dt_util
 
-from homeassistant.const import (ATTR_HIDDEN)
+from homeassistant.const import ATTR_HIDDEN
+
+# cores without the asyncio event loop only support the synchronous setup
+try:
+    from homeassistant.core import callback
+    from homeassistant.helpers.event import (
+        async_track_point_in_utc_time, async_track_state_change)
+except ImportError:
+    callback = None
+
+# async_setup is a generator coroutine, the kind the Python 3.4 cores run;
+# asyncio.coroutine is gone from Python 3.11, where types.coroutine makes
+# the same generator awaitable
+try:
+    from asyncio import coroutine
+except ImportError:
+    from types import coroutine
+
+# helpers shared with proximity_zones: relative inside custom_components,
+# top-level for the offline tools
+try:
+    from .proximity_common import (
+        AXIS_A, BACKEND_EQUIRECTANGULAR, BACKEND_EXACT, BACKEND_HAVERSINE,
+        DEFAULT_DISTANCE_BACKEND, DEFAULT_LOG_RATE_LIMIT,
+        DEFAULT_LOG_SAMPLE_RATE, DEFAULT_TREND_WINDOW, DIAGNOSTICS_INTERVAL,
+        DISTANCE_ERROR_FLOOR, EARTH_RADIUS, ECCENTRICITY_SQ,
+        EQUIRECTANGULAR_ERROR, EQUIRECTANGULAR_MAX_LATITUDE, HAVERSINE_ERROR,
+        DeviceLogLimiter, DeviceTrack, DistanceTrend, EntityPublisher,
+        ProximityDiagnostics, SnapshotStore, displacement, load_snapshot,
+        near_rounding_boundary, near_tolerance_boundary)
+except ImportError:
+    from proximity_common import (
+        AXIS_A, BACKEND_EQUIRECTANGULAR, BACKEND_EXACT, BACKEND_HAVERSINE,
+        DEFAULT_DISTANCE_BACKEND, DEFAULT_LOG_RATE_LIMIT,
+        DEFAULT_LOG_SAMPLE_RATE, DEFAULT_TREND_WINDOW, DIAGNOSTICS_INTERVAL,
+        DISTANCE_ERROR_FLOOR, EARTH_RADIUS, ECCENTRICITY_SQ,
+        EQUIRECTANGULAR_ERROR, EQUIRECTANGULAR_MAX_LATITUDE, HAVERSINE_ERROR,
+        DeviceLogLimiter, DeviceTrack, DistanceTrend, EntityPublisher,
+        ProximityDiagnostics, SnapshotStore, displacement, load_snapshot,
+        near_rounding_boundary, near_tolerance_boundary)
 
 DEPENDENCIES = ['zone', 'device_tracker']
 
@@ -48,253 +156,851 @@ default_tolerance = 1
 # default zone
 default_proximity_zone = 'home'
 
+# service writing the recorded evaluation stages to a Chrome trace file
+SERVICE_DUMP_TRACE = 'dump_trace'
+ATTR_FILENAME = 'filename'
+default_trace_filename = 'proximity_trace.json'
+
+# snapshot of the entity and device positions, read once at setup and
+# written shortly after a change
+SNAPSHOT_FILE = '.proximity.json'
+
 # entity attributes
 ATTR_DIST_FROM = 'dist_from_zone'
 ATTR_DIR_OF_TRAVEL = 'dir_of_travel'
 ATTR_NEAREST_DEVICE = 'nearest_device'
+ATTR_NEAREST_DEVICES = 'nearest_devices'
+
+# options accepted in configuration.yaml
+CONF_KEYS = frozenset([
+    'zone', 'devices', 'ignored_zones', 'tolerance', 'refresh_interval',
+    'distance_backend', 'coalesce_window', 'log_sample_rate',
+    'log_rate_limit', 'trace_size', 'persist', 'top_k', 'trend_window',
+    'throttle_interval', 'throttle_delta', 'shadow_sample_rate',
+    'diagnostics'])
+
+# validated configuration, compiled once at setup
+ProximityPlan = namedtuple('ProximityPlan', [
+    'zone', 'devices', 'ignored_zones', 'tolerance', 'refresh_interval',
+    'distance_backend', 'coalesce_window', 'log_sample_rate',
+    'log_rate_limit', 'trace_size', 'persist', 'top_k', 'trend_window',
+    'throttle_interval', 'throttle_delta', 'shadow_sample_rate',
+    'diagnostics'])
 
 # Shortcut for the logger
 _LOGGER = logging.getLogger(__name__)
 
+def haversine_distance(lat1, lon1, lat2, lon2):
+    """ Spherical distance in metres and its error bound. """
+    lat1, lat2 = radians(lat1), radians(lat2)
+    hav = sin((lat2 - lat1) / 2) ** 2 + \
+        cos(lat1) * cos(lat2) * sin(radians(lon2 - lon1) / 2) ** 2
+    metres = 2 * EARTH_RADIUS * asin(sqrt(min(hav, 1)))
+    return metres, metres * HAVERSINE_ERROR + DISTANCE_ERROR_FLOOR
+
+def equirectangular_distance(lat1, lon1, lat2, lon2):
+    """ Locally flat ellipsoidal distance in metres and its error bound. """
+    mean_lat = radians(lat1 + lat2) / 2
+    curvature = 1 - ECCENTRICITY_SQ * sin(mean_lat) ** 2
+    prime_vertical = AXIS_A / sqrt(curvature)
+    meridional = prime_vertical * (1 - ECCENTRICITY_SQ) / curvature
+    lon_diff = (lon2 - lon1 + 180) % 360 - 180
+    metres = hypot(radians(lon_diff) * prime_vertical * cos(mean_lat),
+                   radians(lat2 - lat1) * meridional)
+    if max(abs(lat1), abs(lat2)) > EQUIRECTANGULAR_MAX_LATITUDE:
+        return metres, float('inf')
+    ratio = metres / EARTH_RADIUS
+    return metres, metres * (EQUIRECTANGULAR_ERROR + 2 * ratio ** 2) + \
+        DISTANCE_ERROR_FLOOR
+
+DISTANCE_BACKENDS = {
+    BACKEND_HAVERSINE: haversine_distance,
+    BACKEND_EQUIRECTANGULAR: equirectangular_distance,
+}
+
 def setup(hass, config):
+    """ Set up the proximity entity from a worker thread.
 
-    # get the zones and offsets from configuration.yaml
-    ignored_zones = []
-    if 'ignored_zones' in config[DOMAIN]:
-        for variable in config[DOMAIN]['ignored_zones']:
-            ignored_zones.append(variable)
-            _LOGGER.info('Ignored zones loaded: %s', variable)
+    Compatibility shim for cores without async_setup: callbacks run in the
+    worker pool and write the entity with hass.states.set.
+    """
+    plan = compile_plan(config[DOMAIN])
+    if plan is None:
+        return False
+    snapshot_zones = {}
+    if plan.persist:
+        snapshot_zones = load_snapshot(hass.config.path(SNAPSHOT_FILE))
+    return setup_proximity(hass, plan, snapshot_zones, run_on_loop=False)
 
-    # get the devices from configuration.yaml
-    if not 'devices' in config[DOMAIN]:
-        _LOGGER.error('devices not found in config')
+@coroutine
+def async_setup(hass, config):
+    """ Set up the proximity entity on the event loop.
+
+    Callbacks run directly on the loop and write the entity with
+    hass.states.async_set, so tracker updates never hop threads. The
+    snapshot is read in the executor before the entity is built.
+    """
+    plan = compile_plan(config[DOMAIN])
+    if plan is None:
         return False
+    snapshot_zones = {}
+    if plan.persist:
+        snapshot_zones = yield from hass.loop.run_in_executor(
+            None, load_snapshot, hass.config.path(SNAPSHOT_FILE))
+    return setup_proximity(hass, plan, snapshot_zones, run_on_loop=True)
+
+def compile_plan(proximity_config):
+    """ Validate the proximity configuration, None if it is unusable. """
+    for key in sorted(set(proximity_config) - CONF_KEYS):
+        _LOGGER.error('Unknown option %s ignored', key)
+
+    # get the devices from configuration.yaml, each once and in order
+    devices = proximity_config.get('devices')
+    if not devices:
+        _LOGGER.error('devices not found in config')
+        return None
+    if isinstance(devices, str):
+        devices = [devices]
+    devices = tuple(OrderedDict.fromkeys(str(device) for device in devices))
+    for device in devices:
+        _LOGGER.info('Proximity device added: %s', device)
+
+    # get the zones where proximity is not calculated
+    ignored_zones = proximity_config.get('ignored_zones') or ()
+    if isinstance(ignored_zones, str):
+        ignored_zones = [ignored_zones]
+    ignored_zones = frozenset(str(zone) for zone in ignored_zones)
+    for zone in ignored_zones:
+        _LOGGER.info('Ignored zones loaded: %s', zone)
+
+    # get the zone to monitor proximity to
+    zone = str(proximity_config.get('zone', default_proximity_zone))
+    _LOGGER.info('Zone set to %s', zone)
+
+    # get the distance backend
+    backend_name = proximity_config.get('distance_backend',
+                                        DEFAULT_DISTANCE_BACKEND)
+    if backend_name != BACKEND_EXACT and \
+            backend_name not in DISTANCE_BACKENDS:
+        _LOGGER.error('Unknown distance backend %s, using %s', backend_name,
+                      BACKEND_EXACT)
+        backend_name = BACKEND_EXACT
+    _LOGGER.debug('distance backend set to: %s', backend_name)
+
+    plan = ProximityPlan(
+        zone=zone,
+        devices=devices,
+        ignored_zones=ignored_zones,
+        tolerance=config_number(proximity_config, 'tolerance',
+                                default_tolerance),
+        refresh_interval=config_number(proximity_config,
+                                       'refresh_interval'),
+        distance_backend=backend_name,
+        coalesce_window=config_number(proximity_config, 'coalesce_window'),
+        log_sample_rate=int(config_number(proximity_config,
+                                          'log_sample_rate',
+                                          DEFAULT_LOG_SAMPLE_RATE)),
+        log_rate_limit=config_number(proximity_config, 'log_rate_limit',
+                                     DEFAULT_LOG_RATE_LIMIT),
+        trace_size=int(config_number(proximity_config, 'trace_size', 0)),
+        persist=bool(proximity_config.get('persist', False)),
+        top_k=int(config_number(proximity_config, 'top_k', 0)),
+        trend_window=int(config_number(proximity_config, 'trend_window',
+                                       DEFAULT_TREND_WINDOW)),
+        throttle_interval=config_number(proximity_config,
+                                        'throttle_interval'),
+        throttle_delta=config_number(proximity_config, 'throttle_delta'),
+        shadow_sample_rate=int(config_number(proximity_config,
+                                             'shadow_sample_rate', 0)),
+        diagnostics=bool(proximity_config.get('diagnostics', True)))
+    _LOGGER.debug('tolerance set to: %s', plan.tolerance)
+    _LOGGER.debug('refresh interval set to: %s', plan.refresh_interval)
+    _LOGGER.debug('coalesce window set to: %s', plan.coalesce_window)
+    _LOGGER.debug('trace size set to: %s', plan.trace_size)
+    _LOGGER.debug('trend window set to: %s', plan.trend_window)
+    _LOGGER.debug('throttle set to: %s s/km, %s of the distance',
+                  plan.throttle_interval, plan.throttle_delta)
+    _LOGGER.debug('shadow sample rate set to: %s', plan.shadow_sample_rate)
+    return plan
+
+def config_number(proximity_config, key, default=None):
+    """ A non-negative number option, else its default. """
+    value = proximity_config.get(key, default)
+    if value is None or (isinstance(value, (int, float)) and
+                         not isinstance(value, bool) and value >= 0):
+        return value
+    _LOGGER.error('%s must be a non-negative number, using %s', key,
+                  default)
+    return default
+
+def setup_proximity(hass, plan, snapshot_zones, run_on_loop):
+    """ get the zone, devices and settings from configuration.yaml """
+
+    # configuration.yaml was validated once, the callbacks only see the plan
+    ignored_zones = plan.ignored_zones
+    proximity_devices = plan.devices
+    tolerance = plan.tolerance
+    proximity_zone = plan.zone
+    coalesce_window = plan.coalesce_window
+    top_k = plan.top_k
+    shadow_sample_rate = plan.shadow_sample_rate
+    distance_backend = DISTANCE_BACKENDS.get(plan.distance_backend)
+
+    # the per-event logging limits
+    log_limiter = DeviceLogLimiter(_LOGGER, plan.log_sample_rate,
+                                   plan.log_rate_limit)
+
+    # the optional stage tracing ring
+    trace_size = plan.trace_size
+    if trace_size:
+        tracer = StageTracer(trace_size)
     else:
-        proximity_devices = []
-        for variable in config[DOMAIN]['devices']:
-            proximity_devices.append(variable)
-            _LOGGER.info('Proximity device added: %s', variable)
-
-    # get the direction of travel tolerance from configuration.yaml
-    if 'tolerance' in config[DOMAIN]:
-        tolerance = config[DOMAIN]['tolerance']
-	else
-		tolerance = default_tolerance
-    _LOGGER.debug('tolerance set to: %s', tolerance)
-
-    # get the zone to monitor proximity to from configuration.yaml
-    if 'zone' in config[DOMAIN]:
-        proximity_zone = config[DOMAIN]['zone']
-	else
-	    proximity_zone = default_proximity_zone
-    _LOGGER.info('Zone set to %s', proximity_zone)
+        tracer = QUIET_TRACER
 
     ENTITY_ID = DOMAIN + '.' + proximity_zone
+    zone_name = proximity_zone
     proximity_zone = 'zone.' + proximity_zone
 
     state = hass.states.get(proximity_zone)
     proximity_latitude = state.attributes.get('latitude')
     proximity_longitude = state.attributes.get('longitude')
     _LOGGER.debug('Zone settings: LAT:%s LONG:%s', proximity_latitude,
-		proximity_longitude)
+                  proximity_longitude)
 
     """========================================================"""
     # create an entity so that the proximity values can be used for other
-	# components
+    # components
     entities = set()
 
-    # set the default values
-    dist_from_zone = 'not set'
-    dir_of_travel = 'not set'
-    nearest_device = 'not set'
+    # the values persisted before a restart, they stand in for what the
+    # device states cannot decide at startup
+    restored_values = None
+    snapshot = None
+    saved = {}
+    if plan.persist:
+        snapshot = SnapshotStore(hass, hass.config.path(SNAPSHOT_FILE),
+                                 lambda: {ENTITY_ID: snapshot_state()},
+                                 run_on_loop)
+        saved = snapshot_zones.get(ENTITY_ID)
+        if not isinstance(saved, dict):
+            saved = {}
+        if isinstance(saved.get('state'), list) and len(saved['state']) == 3:
+            restored_values = tuple(saved['state'])
+            _LOGGER.info('%s: restored distance=%s direction=%s nearest=%s',
+                         ENTITY_ID, *restored_values)
+
+    # hot path counters, published as their own entity
+    diagnostics = ProximityDiagnostics(hass, zone_name)
+    diagnostics.entity_id = ENTITY_ID + '_diagnostics'
+    diagnostics.run_on_loop = run_on_loop
+
+    if run_on_loop:
+        set_state = hass.states.async_set
+    else:
+        set_state = hass.states.set
+    entities.add(ENTITY_ID)
+    if plan.diagnostics:
+        entities.add(diagnostics.entity_id)
+
+    def schedule(action, seconds):
+        """ Run a timer callback once the seconds have passed. """
+        point_in_time = dt_util.utcnow() + timedelta(seconds=seconds)
+        if run_on_loop:
+            async_track_point_in_utc_time(hass, action, point_in_time)
+        else:
+            track_point_in_utc_time(hass, action, point_in_time)
+
+    def publish_diagnostics(now=None):
+        """ Write the diagnostics entity and schedule the next write. """
+        diagnostics.publish()
+        schedule(publish_diagnostics, DIAGNOSTICS_INTERVAL)
 
-    proximity = Proximity(hass, dist_from_zone, dir_of_travel, nearest_device)
+    if run_on_loop:
+        publish_diagnostics = callback(publish_diagnostics)
+    if plan.diagnostics:
+        publish_diagnostics()
+
+
+    """========================================================"""
+    # per-device record of the state, position and distance (metres) from
+    # the zone it was last evaluated at, and an index of (distance in km,
+    # device) pairs kept in ascending order so the nearest device is always
+    # at the front. Only the device that changed is recalculated on each
+    # event
+    tracks = {device: DeviceTrack() for device in proximity_devices}
+    distance_index = []
+    devices_in_zone = set()
+
+    # the synchronous setup receives the state changes on the worker pool,
+    # so the evaluations that update these caches take turns; on the event
+    # loop the lock is never contended
+    evaluation_lock = threading.RLock()
+
+    # the recent distances of each device, when the direction of travel
+    # follows more than the previous and latest update
+    if plan.trend_window > DEFAULT_TREND_WINDOW:
+        for track in tracks.values():
+            track.trend = DistanceTrend(plan.trend_window)
+
+    def write_entity(values, ranking):
+        """ Write the entity with the values the publisher let through. """
+        started = tracer.start()
+        dist, direction, nearest = values
+        entity_attributes = {ATTR_DIST_FROM: dist,
+                             ATTR_DIR_OF_TRAVEL: direction,
+                             ATTR_NEAREST_DEVICE: nearest,
+                             ATTR_HIDDEN: False}
+        if top_k:
+            entity_attributes[ATTR_NEAREST_DEVICES] = [
+                {'entity_id': device, 'name': tracks[device].name,
+                 'distance': distance_km}
+                for distance_km, device in ranking]
+        set_state(ENTITY_ID, dist, entity_attributes)
+        tracer.span('write', started)
+
+    # decides which of the values evaluated are written, and when
+    publisher = EntityPublisher(hass, plan, diagnostics, distance_index,
+                                write_entity)
+    publisher.entity_id = ENTITY_ID
+    publisher.run_on_loop = run_on_loop
+    publisher.lock = evaluation_lock
+
+    def publish(dist, direction, nearest, throttle=True, log=_LOGGER):
+        """ Write the entity unless the visible values are unchanged.
+
+        log is the per-event logger of the device being evaluated.
+        """
+        publisher.publish((dist, direction, nearest), throttle, log)
+
+    def publish_ranking(log=_LOGGER):
+        """ Write a change in the ranking of a device that is not the
+        nearest, keeping the published values. """
+        if top_k:
+            publisher.publish(publisher.decided, log=log)
+
+    def zone_distance(latitude, longitude):
+        """ Exact distance in metres from the zone to a position. """
+        diagnostics.distances += 1
+        return distance(proximity_latitude, proximity_longitude, latitude,
+                        longitude)
+
+    def update_device_cache(device, device_state):
+        """ Update the cached state, zone membership and distance for a
+        device. """
+        track = tracks[device]
+        if track.distance is not None:
+            del distance_index[bisect_left(
+                distance_index, (round(track.distance / 1000, 1), device))]
+            track.distance = None
+            track.error = 0
+
+        if device_state is None:
+            track.state = track.latitude = track.longitude = None
+            track.in_zone = False
+            devices_in_zone.discard(device)
+            return None
+
+        track.name = device_state.attributes.get('friendly_name', device)
+        track.state = device_state.state
+        track.latitude = device_state.attributes.get('latitude')
+        track.longitude = device_state.attributes.get('longitude')
+        track.in_zone = track.state == zone_name
+        if track.in_zone:
+            devices_in_zone.add(device)
+        else:
+            devices_in_zone.discard(device)
+
+        if track.state in ignored_zones:
+            return None
+
+        if track.latitude is None:
+            return None
+
+        new_distance = None
+        if distance_backend is not None:
+            # use the fast backend unless its error straddles a 0.1 km step
+            diagnostics.distances += 1
+            new_distance, error = distance_backend(
+                proximity_latitude, proximity_longitude, track.latitude,
+                track.longitude)
+            if near_rounding_boundary(new_distance, error):
+                new_distance = None
+            else:
+                track.error = error
+        if new_distance is None:
+            new_distance = zone_distance(track.latitude, track.longitude)
+        track.distance = new_distance
+        insort(distance_index, (round(new_distance / 1000, 1), device))
+        if track.trend is not None:
+            track.trend.add(new_distance, track.error, track.latitude,
+                            track.longitude)
+        return new_distance
+
+    # updates dropped because they cannot change the entity
+    skipped_updates = 0
+
+    def should_process(device, new_state):
+        """ Drop attribute-only updates and moves within the tolerance. """
+        nonlocal skipped_updates
+        track = tracks[device]
+        if track.state is None or new_state is None or \
+                new_state.state != track.state:
+            return True
+        latitude = new_state.attributes.get('latitude')
+        longitude = new_state.attributes.get('longitude')
+        if (latitude != track.latitude or longitude != track.longitude) and (
+                latitude is None or track.latitude is None or
+                displacement(track.latitude, track.longitude, latitude,
+                             longitude) >= tolerance):
+            return True
+        skipped_updates += 1
+        diagnostics.skipped += 1
+        log_limiter.logger_for(device).debug(
+            '%s: update skipped, %s skipped so far', device, skipped_updates)
+        return False
+
+    # prime the cache with the current state of every device
+    for device in proximity_devices:
+        update_device_cache(device, hass.states.get(device))
+
+    # snapshot positions stand in for the previous position of the devices
+    # that have none at startup
+    saved_devices = saved.get('devices')
+    if isinstance(saved_devices, dict):
+        for device, position in saved_devices.items():
+            track = tracks.get(device)
+            if track is not None and track.latitude is None and \
+                    isinstance(position, list) and len(position) == 2:
+                track.restored = tuple(position)
+
+    def settled_values(kept):
+        """ The entity values decided from the cached devices alone.
+
+        kept are the values persisted before a restart: their direction of
+        travel stands while the same device is the nearest, and they stand
+        in whole while no device has a position.
+        """
+        for device in proximity_devices:
+            if tracks[device].in_zone:
+                return (0, 'arrived', tracks[device].name)
+        if distance_index:
+            distance_from_zone, device = distance_index[0]
+            name = tracks[device].name
+            if kept is not None and kept[2] == name and \
+                    kept[1] in ('towards', 'away_from', 'unknown'):
+                return (round(distance_from_zone), kept[1], name)
+            return (distance_from_zone, 'Unknown', name)
+        if kept is not None:
+            return kept
+        return ('not set', 'not set', 'not set')
+
+    # the entity starts from the primed device states rather than waiting
+    # for an update that the filter may drop
+    publisher.published = publisher.decided = settled_values(restored_values)
+    proximity = Proximity(hass, *publisher.published)
     proximity.entity_id = ENTITY_ID
+    if run_on_loop:
+        hass.async_add_job(proximity.async_update_ha_state())
+    else:
+        proximity.update_ha_state()
+
+    def snapshot_state():
+        """ The entity values and last device positions to persist. """
+        devices = {}
+        for device, track in tracks.items():
+            if track.latitude is not None:
+                devices[device] = [track.latitude, track.longitude]
+            elif track.restored is not None:
+                devices[device] = list(track.restored)
+        return {'state': list(publisher.published), 'devices': devices}
 
-    proximity.update_ha_state()
-    entities.add(proximity.entity_id)
+    def check_proximity_zone_state_change(entity, old_state, new_state):
+        """ Refresh the cached zone co-ordinates when the zone is edited. """
+        nonlocal proximity_latitude, proximity_longitude
+        if new_state is None or not 'latitude' in new_state.attributes:
+            return
+        with evaluation_lock:
+            if (new_state.attributes['latitude'] == proximity_latitude and
+                    new_state.attributes.get('longitude') ==
+                    proximity_longitude):
+                return
+            proximity_latitude = new_state.attributes['latitude']
+            proximity_longitude = new_state.attributes.get('longitude')
+            _LOGGER.info('%s: zone moved to LAT:%s LONG:%s, recalculating '
+                         'distances', ENTITY_ID, proximity_latitude,
+                         proximity_longitude)
+            for device, track in tracks.items():
+                if track.trend is not None:
+                    track.trend.clear()
+                update_device_cache(device, hass.states.get(device))
+                diagnostics.state_reads += 1
+
+            # publish the distance of the nearest device to the moved zone,
+            # its direction of travel is not known until it reports again
+            if devices_in_zone or not distance_index:
+                publish_ranking()
+                return
+            distance_from_zone, device = distance_index[0]
+            publish(distance_from_zone, 'Unknown', tracks[device].name,
+                    throttle=False)
 
     """========================================================"""
 
+    # evaluated updates counted towards the shadow sample rate
+    shadow_events = 0
+
+    # device updates waiting for the end of the coalescing window, as
+    # (first old state, latest new state)
+    pending = {}
+
     def check_proximity_dev_state_change(entity, old_state, new_state):
+        """ Evaluate a device update, or collect it while a coalescing
+        window is open. """
+        with evaluation_lock:
+            diagnostics.events += 1
+            if not coalesce_window:
+                process_dev_state_change(entity, old_state, new_state)
+                return
+
+            # collapse the updates of each device within the window to its
+            # first old state and latest new state
+            scheduled = bool(pending)
+            if entity in pending:
+                old_state = pending[entity][0]
+            pending[entity] = (old_state, new_state)
+            if scheduled:
+                return
+        schedule(flush_pending_state_changes, coalesce_window)
+
+    def flush_pending_state_changes(now=None):
+        """ Evaluate the device updates collected during the window and
+        write the entity once. """
+        with evaluation_lock:
+            changes = list(pending.items())
+            pending.clear()
+            publisher.hold()
+            try:
+                for entity, (old_state, new_state) in changes:
+                    process_dev_state_change(entity, old_state, new_state)
+            finally:
+                publisher.release()
+
+    if run_on_loop:
+        flush_pending_state_changes = callback(flush_pending_state_changes)
+
+    def process_dev_state_change(entity, old_state, new_state):
+        """ Time the evaluation of a device update for the diagnostics. """
+        nonlocal shadow_events
+        if plan.diagnostics:
+            started = perf_counter()
+        traced = tracer.begin(entity)
+        # drop updates that cannot change the entity before doing any
+        # work
+        processed = should_process(entity, new_state)
+        sampled = None
+        if processed and shadow_sample_rate and new_state is not None:
+            shadow_events += 1
+            if not shadow_events % shadow_sample_rate:
+                track = tracks[entity]
+                sampled = (track.state, track.latitude, track.longitude,
+                           track.restored, publisher.decided)
+        if processed:
+            evaluate_dev_state_change(entity, old_state, new_state)
+        tracer.span('evaluate', traced)
+        if plan.diagnostics:
+            diagnostics.record_latency(perf_counter() - started)
+        if sampled is not None:
+            shadow_check(entity, old_state, new_state, *sampled)
 
+    def shadow_check(entity, old_state, new_state, previous, latitude,
+                     longitude, restored, before):
+        """ Compare the values decided for an update with the reference
+        evaluation and count any divergence. """
+        started = perf_counter()
+        # the previous position the direction of travel is measured from
+        if previous is not None and previous not in ignored_zones and \
+                latitude is not None:
+            old_position = (latitude, longitude)
+        elif restored is not None:
+            old_position = restored
+        elif old_state is not None and 'latitude' in old_state.attributes:
+            old_position = (old_state.attributes['latitude'],
+                            old_state.attributes['longitude'])
+        else:
+            old_position = None
+        expected = reference_evaluation(entity, new_state, old_position)
+        if expected is None:
+            expected = before
+        diagnostics.shadow_checks += 1
+        decided = publisher.decided
+        if any(value is not None and value != actual
+               for value, actual in zip(expected, decided)):
+            diagnostics.shadow_divergences += 1
+            _LOGGER.error('%s: shadow check of %s diverged: expected %s, '
+                          'decided %s', ENTITY_ID, entity, expected,
+                          decided)
+        diagnostics.shadow_time += perf_counter() - started
+
+    def reference_evaluation(entity, new_state, old_position):
+        """ The values the original full scan of the devices sets the
+        entity to for an update, None if it leaves the entity unchanged.
+
+        The scan measures every device exactly from the state it was last
+        evaluated at. Values it does not decide (the nearest device once
+        arrived, a direction of travel that follows a trend) are None.
+        """
+        # check for devices in the monitored zone
+        for track in tracks.values():
+            if track.in_zone:
+                return (0, 'arrived', None)
+
+        # ignored zones and updates without a position leave the entity
+        if new_state.state in ignored_zones or \
+                not 'latitude' in new_state.attributes:
+            return None
+        new_distance = distance(proximity_latitude, proximity_longitude,
+                                new_state.attributes['latitude'],
+                                new_state.attributes['longitude'])
+        distance_from_zone = round(new_distance / 1000, 1)
+
+        # compare distance with other devices
+        for device, track in tracks.items():
+            if device == entity or track.state is None or \
+                    track.state in ignored_zones or track.latitude is None:
+                continue
+            if round(distance(proximity_latitude, proximity_longitude,
+                              track.latitude, track.longitude) / 1000, 1) <= \
+                    distance_from_zone:
+                return None
+
+        # calculate direction of travel
         entity_name = new_state.attributes['friendly_name']
+        # a trend of the recent distances decides the direction even
+        # without a previous position
+        trend = tracks[entity].trend
+        if trend is not None and trend.count > 1:
+            return (round(distance_from_zone), None, entity_name)
+        if old_position is None:
+            return (distance_from_zone, 'Unknown', entity_name)
+        distance_travelled = round(new_distance - distance(
+            proximity_latitude, proximity_longitude, *old_position), 1)
+        if distance_travelled <= tolerance * -1:
+            direction_of_travel = 'towards'
+        elif distance_travelled > tolerance:
+            direction_of_travel = 'away_from'
+        else:
+            direction_of_travel = 'unknown'
+        return (round(distance_from_zone), direction_of_travel, entity_name)
+
+    def evaluate_dev_state_change(entity, old_state, new_state):
+
+        if snapshot is not None:
+            snapshot.schedule()
+
+        # per-event lines are debug only, sampled and rate limited per device
+        log = log_limiter.logger_for(entity)
+
+        if new_state is None:
+            entity_name = tracks[entity].name
+        else:
+            entity_name = new_state.attributes['friendly_name']
 
         """========================================================"""
         # Debug lines to aid testing
         if old_state is not None:
-            _LOGGER.debug('%s: old_state: %s', entity_name, old_state)
+            log.debug('%s: old_state: %s', entity_name, old_state)
         else:
-            _LOGGER.debug('%s: no old_state', entity_name)
+            log.debug('%s: no old_state', entity_name)
 
         if new_state is not None:
-            _LOGGER.debug('%s: new_state: %s', entity_name, new_state)
+            log.debug('%s: new_state: %s', entity_name, new_state)
         else:
-            _LOGGER.debug('%s: no new_state', entity_name)
+            log.debug('%s: no new_state', entity_name)
 
         """========================================================"""
-        device_is_in_zone = False
+        # only the device that changed needs its distance recalculating
+        stage = tracer.start()
+        track = tracks[entity]
+        old_distance = track.distance
+        old_error = track.error
+        old_latitude, old_longitude = track.latitude, track.longitude
+        if track.restored is not None:
+            # the previous position is only known from the snapshot
+            if old_distance is None:
+                old_distance = zone_distance(*track.restored)
+                if track.trend is not None:
+                    track.trend.add(old_distance, 0, *track.restored)
+            track.restored = None
+        new_distance = update_device_cache(entity, new_state)
+        stage = tracer.span('distance', stage)
+
+        # a removed device has no position: the other devices decide the
+        # entity
+        if new_state is None:
+            if devices_in_zone or distance_index:
+                publish(*settled_values(publisher.decided), log=log)
+            else:
+                publish('not set', 'not set', 'not set', log=log)
+            return
 
         # check for devices in the monitored zone
-        for device in proximity_devices:
-            device_state = hass.states.get(device)
-            if device_state.state == config[DOMAIN]['zone']:
-                device_is_in_zone = True
-				_LOGGER.info('%s Device: %s is in the monitored zone: %s',
-					entity_name, device, device_state.state)
-
-        if device_is_in_zone:
-            entity_state = hass.states.get(ENTITY_ID)
-            if not entity_state.attributes[ATTR_DIR_OF_TRAVEL] == 'arrived':
-                entity_attributes = {ATTR_DIST_FROM:0, 
-					ATTR_DIR_OF_TRAVEL: 'arrived', 
-					ATTR_NEAREST_DEVICE: entity_name, ATTR_HIDDEN: False}
-                hass.states.set(ENTITY_ID, 0, entity_attributes)
-                _LOGGER.debug('%s Update entity: distance = 0: direction = '
-					'arrived: device = %s', ENTITY_ID, entity_name)
+        arrived = bool(devices_in_zone)
+        stage = tracer.span('in_zone_scan', stage)
+        if arrived:
+            log.debug('%s Devices: %s are in the monitored zone: %s',
+                      entity_name, ', '.join(devices_in_zone), zone_name)
+            if not publisher.published[1] == 'arrived':
+                publish(0, 'arrived', entity_name, log=log)
             else:
-                _LOGGER.debug('%s Entity not updted: %s is in proximity '
-					'zone:%s', ENTITY_ID, entity_name, config[DOMAIN]['zone'])
+                log.debug('%s Entity not updted: %s is in proximity '
+                          'zone:%s', ENTITY_ID, entity_name, zone_name)
             return
 
         """========================================================"""
         # check that the device is not in an ignored zone
-        if new_state.state in ignored_zones:
-            _LOGGER.info('%s Device is in an ignored zone: %s', ENTITY_ID, 
-				device)
+        ignored = new_state.state in ignored_zones
+        stage = tracer.span('ignored_zone_check', stage)
+        if ignored:
+            log.debug('%s Device is in an ignored zone: %s', ENTITY_ID,
+                      entity)
+            publish_ranking(log)
             return
 
         """========================================================"""
         # check for latitude and longitude (on startup these values may not
-		# exist)
-        if not 'latitude' in new_state.attributes:
-            _LOGGER.info('%s: not LAT or LONG current position cannot be '
-				'calculated', entity_name)
+        # exist)
+        if new_distance is None:
+            log.debug('%s: not LAT or LONG current position cannot be '
+                      'calculated', entity_name)
+            publish_ranking(log)
             return
 
-        # calculate the distance of the device from the monitored zone
-        distance_from_zone = round(distance(proximity_latitude,
-			proximity_longitude, new_state.attributes['latitude'],
-			new_state.attributes['longitude']) / 1000, 1)
-        _LOGGER.info('%s: distance from zone is: %s km', entity_name, 
-			distance_from_zone)
+        # distance of the device from the monitored zone
+        distance_from_zone = round(new_distance / 1000, 1)
+        log.debug('%s: distance from zone is: %s km', entity_name,
+                  distance_from_zone)
 
         """========================================================"""
-        # compare distance with other devices
-        # default behaviour
-        device_is_closest_to_zone = True
-
-        for device in proximity_devices:
-            # ignore the device we're working on
-            if device == entity:
-                continue
-
-            # get the device state
-            device_state = hass.states.get(device)
-            if device_state in ignored_zones:
-                _LOGGER.debug('%s: no need to compare with %s - device is in '
-					'ignored zone', entity_name, device)
-                continue
-
-            # check that the distance from the proximity zone can be calculated
-            if not 'latitude' in device_state.attributes:
-                _LOGGER.debug('%s: cannot compare with %s - no location '
-					'attributes', entity_name, device)
-                continue
-
-            # calculate the distance from the proximity zone for the compare
-			# device
-            compare_distance_from_zone = round(distance(proximity_latitude,
-				proximity_longitude, device_state.attributes['latitude'],
-				device_state.attributes['longitude'])/1000, 1)
-            _LOGGER.debug('%s: compare device %s: co-ordintes: LAT %s: LONG: '
-				'%s', entity_name, device, device_state.attributes['latitude'],
-				device_state.attributes['longitude'])
-
-            # compare the distances from the proximity zone
-            if distance_from_zone < compare_distance_from_zone:
-                _LOGGER.debug('%s: closer than %s: %s compared with %s',
-					entity_name, device, distance_from_zone,
-					compare_distance_from_zone)
-            elif distance_from_zone > compare_distance_from_zone:
-                device_is_closest_to_zone = False
-                _LOGGER.debug('%s: further away than %s: %s compared with %s',
-					entity_name, device, distance_from_zone,
-					compare_distance_from_zone)
-            else:
-                device_is_closest_to_zone = False
-                _LOGGER.debug('%s: same distance as %s: %s compared with %s',
-					entity_name, device, distance_from_zone,
-					compare_distance_from_zone)
+        # compare distance with other devices: the device is the closest only
+        # if it heads the index and no other device shares its distance
+        device_is_closest_to_zone = distance_index[0][1] == entity and (
+            len(distance_index) == 1 or
+            distance_index[1][0] > distance_from_zone)
+        stage = tracer.span('comparison', stage)
 
         """========================================================"""
         # if the device is not the closest to the proximity zone
         if not device_is_closest_to_zone:
-            _LOGGER.info('%s: device is not closest to zone', entity_name)
+            log.debug('%s: device is not closest to zone', entity_name)
+            publish_ranking(log)
             return
 
         """========================================================"""
         # calculate direction of travel
+        trend = track.trend
+        if trend is not None and trend.count > 1:
+            # follow the least-squares line through the recent distances,
+            # re-measuring them exactly if their error could change the
+            # direction of travel
+            travelled, error = trend.change()
+            if error and near_tolerance_boundary(travelled, error,
+                                                 tolerance):
+                trend.remeasure(zone_distance)
+                travelled, error = trend.change()
+            distance_travelled = round(travelled, 1)
+            log.debug('%s: trend of %s distances: %s', entity_name,
+                      trend.count, distance_travelled)
+
         # stop if we cannot calculate the direction of travel (i.e. we don't
-		# have a previous state and a current LAT and LONG)
-        if old_state is None or not 'latitude' in old_state.attributes:
-            entity_attributes = {ATTR_DIST_FROM: distance_from_zone,
-				ATTR_DIR_OF_TRAVEL: 'Unknown',
-				ATTR_NEAREST_DEVICE: entity_name, ATTR_HIDDEN: False}
-            hass.states.set(ENTITY_ID, distance_from_zone, entity_attributes)
-            _LOGGER.debug('%s Update entity: distance = %s: direction = '
-				'unknown: device = %s', ENTITY_ID, distance_from_zone,
-				entity_name)
-            _LOGGER.info('%s: Cannot determine direction of travel as old '
-				'and/or new LAT or LONG are missing', entity_name)
+        # have a previous position and a current LAT and LONG)
+        elif old_distance is None and (
+                old_state is None or not 'latitude' in old_state.attributes):
+            tracer.span('direction', stage)
+            publish(distance_from_zone, 'Unknown', entity_name, log=log)
+            log.debug('%s: Cannot determine direction of travel as old '
+                      'and/or new LAT or LONG are missing', entity_name)
             return
 
-        # reset the variables
-        distance_travelled = 0
-
-        old_distance = distance(proximity_latitude, proximity_longitude,
-			old_state.attributes['latitude'],
-			old_state.attributes['longitude'])
-        _LOGGER.debug('%s: old distance: %s', entity_name, old_distance)
+        else:
+            # reuse the cached distance for the previous position when we
+            # have it
+            if old_distance is None:
+                old_error = 0
+                old_distance = zone_distance(
+                    old_state.attributes['latitude'],
+                    old_state.attributes['longitude'])
+            log.debug('%s: old distance: %s', entity_name, old_distance)
+            log.debug('%s: new distance: %s', entity_name, new_distance)
 
-        new_distance = distance(proximity_latitude, proximity_longitude,
-			new_state.attributes['latitude'],
-			new_state.attributes['longitude'])
-        _LOGGER.debug('%s: new distance: %s', entity_name, new_distance)
+            distance_travelled = round(new_distance - old_distance, 1)
 
-        distance_travelled = round(new_distance - old_distance, 1)
+            # approximate distances are re-measured exactly if their error
+            # could change the direction of travel
+            error = old_error + track.error
+            if error and near_tolerance_boundary(new_distance - old_distance,
+                                                 error, tolerance):
+                if old_error:
+                    old_distance = zone_distance(old_latitude, old_longitude)
+                distance_travelled = round(
+                    zone_distance(new_state.attributes['latitude'],
+                                  new_state.attributes['longitude']) -
+                    old_distance, 1)
 
         # check for a margin of error
         if distance_travelled <= tolerance * -1:
             direction_of_travel = 'towards'
-            _LOGGER.info('%s: device travelled %s metres: moving %s',
-				entity_name, distance_travelled, direction_of_travel)
+            log.debug('%s: device travelled %s metres: moving %s',
+                      entity_name, distance_travelled, direction_of_travel)
         elif distance_travelled > tolerance:
             direction_of_travel = 'away_from'
-            _LOGGER.info('%s: device travelled %s metres: moving %s',
-				entity_name, distance_travelled, direction_of_travel)
+            log.debug('%s: device travelled %s metres: moving %s',
+                      entity_name, distance_travelled, direction_of_travel)
         else:
             direction_of_travel = 'unknown'
-            _LOGGER.info('%s: Cannot determine direction: %s is too small',
-				entity_name, distance_travelled)
+            log.debug('%s: Cannot determine direction: %s is too small',
+                      entity_name, distance_travelled)
 
         """========================================================"""
         # update the proximity entity
-        entity_attributes = {ATTR_DIST_FROM: round(distance_from_zone),
-			ATTR_DIR_OF_TRAVEL: direction_of_travel,
-			ATTR_NEAREST_DEVICE: entity_name, ATTR_HIDDEN: False}
-        hass.states.set(ENTITY_ID, round(distance_from_zone),
-			entity_attributes)
-        _LOGGER.debug('%s Update entity: distance = %s: direction = %s: '
-			'device = %s', ENTITY_ID, round(distance_from_zone),
-			direction_of_travel, entity_name)
+        tracer.span('direction', stage)
+        publish(round(distance_from_zone), direction_of_travel, entity_name,
+                log=log)
 
-        _LOGGER.info('%s: Proximity calculation complete', entity_name)
+        log.debug('%s: Proximity calculation complete', entity_name)
 
     """========================================================"""
     # main command to monitor proximity of devices
-    track_state_change(hass, proximity_devices,
-		check_proximity_dev_state_change)
+    if run_on_loop:
+        async_track_state_change(hass, proximity_devices,
+                                 callback(check_proximity_dev_state_change))
+        async_track_state_change(hass, proximity_zone,
+                                 callback(check_proximity_zone_state_change))
+    else:
+        track_state_change(hass, proximity_devices,
+                           check_proximity_dev_state_change)
+        track_state_change(hass, proximity_zone,
+                           check_proximity_zone_state_change)
+
+    # the entity is re-written from a timer of its own, as a stationary
+    # device may send nothing but updates the filter drops
+    publisher.start()
+
+    def dump_trace(call):
+        """ Write the recorded evaluation stages to a Chrome trace file. """
+        # relative names are in the configuration directory
+        filename = str(call.data.get(ATTR_FILENAME, default_trace_filename))
+        if not os.path.isabs(filename):
+            filename = hass.config.path(filename)
+        spans = tracer.dump(filename)
+        _LOGGER.info('%s: %s traced stages written to %s', ENTITY_ID, spans,
+                     filename)
+
+    # the handler is not a callback so it runs in the executor rather than
+    # blocking the event loop on the file
+    if trace_size and run_on_loop:
+        hass.services.async_register(DOMAIN, SERVICE_DUMP_TRACE, dump_trace)
+    elif trace_size:
+        hass.services.register(DOMAIN, SERVICE_DUMP_TRACE, dump_trace)
 
     # Tells the bootstrapper that the component was successfully initialized
     return True
@@ -335,3 +1041,60 @@ class Proximity(Entity):
     @property
     def nearest_device(self):
         return self._dist_from
+
+class QuietTracer(object):
+    """ Stand-in tracer used while stage tracing is off. """
+    def begin(self, device):
+        """ Start tracing an event of the device. """
+        return 0
+
+    def start(self):
+        """ Start time of a stage. """
+        return 0
+
+    def span(self, stage, started):
+        """ Record a stage. """
+        return 0
+
+QUIET_TRACER = QuietTracer()
+
+class StageTracer(object):
+    """ Bounded ring of timed evaluation stages. """
+    def __init__(self, size):
+        self.spans = deque(maxlen=size)
+        self.device = None
+
+    def begin(self, device):
+        """ Start tracing an event of the device. """
+        self.device = device
+        return perf_counter()
+
+    def start(self):
+        """ Start time of a stage. """
+        return perf_counter()
+
+    def span(self, stage, started):
+        """ Record a stage of the current event, returns its end time. """
+        ended = perf_counter()
+        self.spans.append((stage, self.device, started, ended))
+        return ended
+
+    def dump(self, filename):
+        """ Write the ring to a Chrome trace file, one thread per device. """
+        spans = list(self.spans)
+        threads = {}
+        events = []
+        for stage, device, started, ended in spans:
+            if device not in threads:
+                threads[device] = len(threads) + 1
+                events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1,
+                               'tid': threads[device],
+                               'args': {'name': str(device)}})
+            events.append({'name': stage, 'cat': DOMAIN, 'ph': 'X',
+                           'pid': 1, 'tid': threads[device],
+                           'ts': round(started * 1000000, 3),
+                           'dur': round((ended - started) * 1000000, 3)})
+        with open(filename, 'w') as trace_file:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'},
+                      trace_file)
+        return len(spans)
@@ -0,0 +1,557 @@
+"""
+proximity_benchmark
+~~~~~~~~~~~~~~~~~~~
+Offline benchmark of the proximity and proximity_zones components.
+
+Both components are run in-process against a stand-in for Home Assistant
+(hass.states, track_state_change, Entity.update_ha_state and friends, and
+their event loop counterparts for async_setup) and fed a seeded synthetic
+GPS trace, so no Home Assistant install is needed.
+
+For each scenario the benchmark reports:
+- events/sec: tracker updates processed per second
+- p50/p99: per-event latency in microseconds (with --batch, the latency of
+  each proximity_zones.update_devices call divided by its updates)
+- dist/event: distance calculations per event (exact, fast backend and
+  distance matrix entries)
+- writes/event: proximity entity writes per event
+
+Example:
+python proximity_benchmark.py --devices 10 100 1000 --zones 1 10 50 \\
+    --events 5000 --seed 1
+python proximity_benchmark.py --component proximity_zones --batch 50
+"""
+
+import argparse
+import datetime
+import heapq
+import importlib
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+import types
+
+# radius of the zones in the synthetic world (metres)
+ZONE_RADIUS = 100
+
+# share of the trace that is attribute-only updates (battery, accuracy)
+ATTRIBUTE_ONLY_RATE = 0.2
+
+# chance that a moving device heads for a zone rather than wandering
+ZONE_BOUND_RATE = 0.3
+
+# vincenty constants, as used by homeassistant.util.location
+AXIS_A = 6378137
+FLATTENING = 1 / 298.257223563
+AXIS_B = 6356752.314245
+MAX_ITERATIONS = 200
+CONVERGENCE_THRESHOLD = 1e-12
+
+
+def vincenty(point1, point2):
+    # pylint: disable=invalid-name,too-many-locals
+    """ Port of homeassistant.util.location.vincenty, result in km. """
+    if point1[0] == point2[0] and point1[1] == point2[1]:
+        return 0.0
+
+    U1 = math.atan((1 - FLATTENING) * math.tan(math.radians(point1[0])))
+    U2 = math.atan((1 - FLATTENING) * math.tan(math.radians(point2[0])))
+    L = math.radians(point2[1] - point1[1])
+    Lambda = L
+
+    sinU1 = math.sin(U1)
+    cosU1 = math.cos(U1)
+    sinU2 = math.sin(U2)
+    cosU2 = math.cos(U2)
+
+    for _ in range(MAX_ITERATIONS):
+        sinLambda = math.sin(Lambda)
+        cosLambda = math.cos(Lambda)
+        sinSigma = math.sqrt((cosU2 * sinLambda) ** 2 +
+                             (cosU1 * sinU2 - sinU1 * cosU2 * cosLambda) ** 2)
+        if sinSigma == 0:
+            return 0.0
+        cosSigma = sinU1 * sinU2 + cosU1 * cosU2 * cosLambda
+        sigma = math.atan2(sinSigma, cosSigma)
+        sinAlpha = cosU1 * cosU2 * sinLambda / sinSigma
+        cosSqAlpha = 1 - sinAlpha ** 2
+        try:
+            cos2SigmaM = cosSigma - 2 * sinU1 * sinU2 / cosSqAlpha
+        except ZeroDivisionError:
+            cos2SigmaM = 0
+        C = FLATTENING / 16 * cosSqAlpha * (4 + FLATTENING *
+                                            (4 - 3 * cosSqAlpha))
+        LambdaPrev = Lambda
+        Lambda = L + (1 - C) * FLATTENING * sinAlpha * (
+            sigma + C * sinSigma * (cos2SigmaM + C * cosSigma *
+                                    (-1 + 2 * cos2SigmaM ** 2)))
+        if abs(Lambda - LambdaPrev) < CONVERGENCE_THRESHOLD:
+            break
+    else:
+        return None
+
+    uSq = cosSqAlpha * (AXIS_A ** 2 - AXIS_B ** 2) / (AXIS_B ** 2)
+    A = 1 + uSq / 16384 * (4096 + uSq * (-768 + uSq * (320 - 175 * uSq)))
+    B = uSq / 1024 * (256 + uSq * (-128 + uSq * (74 - 47 * uSq)))
+    deltaSigma = B * sinSigma * (
+        cos2SigmaM + B / 4 * (cosSigma * (-1 + 2 * cos2SigmaM ** 2) -
+                              B / 6 * cos2SigmaM * (-3 + 4 * sinSigma ** 2) *
+                              (-3 + 4 * cos2SigmaM ** 2)))
+    return round(AXIS_B * A * (sigma - deltaSigma) / 1000, 6)
+
+
+class State(object):
+    """ Stand-in for homeassistant.core.State. """
+    __slots__ = ['entity_id', 'state', 'attributes']
+
+    def __init__(self, entity_id, state, attributes=None):
+        self.entity_id = entity_id
+        self.state = state
+        self.attributes = attributes or {}
+
+    @property
+    def name(self):
+        """ Friendly name of the entity. """
+        name = self.attributes.get('friendly_name')
+        if name is None:
+            return self.entity_id.split('.', 1)[1]
+        return name
+
+    def __repr__(self):
+        return '<state {}={}; {}>'.format(self.entity_id, self.state,
+                                          self.attributes)
+
+
+class StateMachine(object):
+    """ Stand-in for hass.states that calls listeners synchronously. """
+    def __init__(self, hass):
+        self._hass = hass
+        self._states = {}
+        self.writes = 0
+
+    def get(self, entity_id):
+        """ Return the state of an entity. """
+        return self._states.get(entity_id)
+
+    def set(self, entity_id, new_state, attributes=None):
+        """ Set the state of an entity and notify its listeners. """
+        old_state = self._states.get(entity_id)
+        state = State(entity_id, new_state, attributes)
+        self._states[entity_id] = state
+        # the writes of the proximity entities, not their diagnostics
+        if entity_id.split('.', 1)[0] not in ('device_tracker', 'zone') and \
+                not entity_id.endswith('_diagnostics'):
+            self.writes += 1
+        for action in self._hass.listeners.get(entity_id, ()):
+            action(entity_id, old_state, state)
+
+    async_set = set
+
+    def remove(self, entity_id):
+        """ Remove an entity and notify its listeners. """
+        old_state = self._states.pop(entity_id, None)
+        if old_state is None:
+            return False
+        for action in self._hass.listeners.get(entity_id, ()):
+            action(entity_id, old_state, None)
+        return True
+
+    async_remove = remove
+
+
+class ServiceRegistry(object):
+    """ Stand-in for hass.services, keeps the registered handlers. """
+    def __init__(self):
+        self.services = {}
+
+    def register(self, domain, service, service_func):
+        """ Register a service handler. """
+        self.services[(domain, service)] = service_func
+
+    async_register = register
+
+
+class EventBus(object):
+    """ Stand-in for hass.bus, keeps the one-off listeners of each event. """
+    def __init__(self):
+        self.listeners = {}
+
+    def listen_once(self, event_type, listener):
+        """ Listen for the next event of a type. """
+        self.listeners.setdefault(event_type, []).append(listener)
+
+    async_listen_once = listen_once
+
+    def fire(self, event_type):
+        """ Call and forget the listeners of an event type. """
+        for listener in self.listeners.pop(event_type, ()):
+            listener(types.SimpleNamespace(event_type=event_type))
+
+
+class Config(object):
+    """ Stand-in for hass.config. """
+    config_dir = '.'
+
+    def path(self, *path):
+        """ Path relative to the configuration directory. """
+        return os.path.join(self.config_dir, *path)
+
+
+def run_coroutine(coroutine):
+    """ Run a coroutine that never waits to its end and return its
+    result. """
+    try:
+        while True:
+            coroutine.send(None)
+    except StopIteration as stop:
+        return stop.value
+
+
+class Finished(object):
+    """ Stand-in for a future that already has its result. """
+    def __init__(self, result):
+        self.result = result
+
+    def __iter__(self):
+        yield from ()
+        return self.result
+
+    __await__ = __iter__
+
+
+class Loop(object):
+    """ Stand-in for hass.loop that runs executor jobs at once. """
+    def run_in_executor(self, executor, func, *args):
+        # pylint: disable=no-self-use,unused-argument
+        """ Run a function and return its finished future. """
+        return Finished(func(*args))
+
+
+class Hass(object):
+    """ Stand-in for the hass object passed to components. """
+    def __init__(self):
+        self.listeners = {}
+        # heap of (point in time, sequence, action)
+        self.timers = []
+        self.timer_sequence = 0
+        self.now = datetime.datetime(2016, 1, 1,
+                                     tzinfo=datetime.timezone.utc)
+        self.states = StateMachine(self)
+        self.services = ServiceRegistry()
+        self.bus = EventBus()
+        self.config = Config()
+        self.loop = Loop()
+
+    def async_add_job(self, target, *args):
+        """ Run a coroutine, or call a function with its arguments, at
+        once. """
+        if hasattr(target, 'send'):
+            return run_coroutine(target)
+        return target(*args)
+
+    def add_timer(self, point_in_time, action):
+        """ Run an action once the simulated time reaches a point. """
+        self.timer_sequence += 1
+        heapq.heappush(self.timers,
+                       (point_in_time, self.timer_sequence, action))
+
+    def fire_timers(self):
+        """ Run the timers that are due at the simulated time. """
+        while self.timers and self.timers[0][0] <= self.now:
+            point_in_time, _, action = heapq.heappop(self.timers)
+            action(point_in_time)
+
+
+def install_stub_homeassistant(hass):
+    """ Register stand-in homeassistant modules in sys.modules. """
+    def track_state_change(hass, entity_ids, action, from_state=None,
+                           to_state=None):
+        # pylint: disable=unused-argument
+        """ Stand-in for helpers.event.track_state_change. """
+        if isinstance(entity_ids, str):
+            entity_ids = [entity_ids]
+        for entity_id in entity_ids:
+            hass.listeners.setdefault(entity_id, []).append(action)
+
+    def track_point_in_utc_time(hass, action, point_in_time):
+        """ Stand-in for helpers.event.track_point_in_utc_time. """
+        hass.add_timer(point_in_time, action)
+
+    class Entity(object):
+        """ Stand-in for helpers.entity.Entity. """
+        hass = None
+        entity_id = None
+
+        @property
+        def state(self):
+            """ State of the entity. """
+            return None
+
+        @property
+        def state_attributes(self):
+            """ State attributes of the entity. """
+            return None
+
+        def update_ha_state(self, force_refresh=False):
+            # pylint: disable=unused-argument
+            """ Write the entity to the state machine. """
+            self.hass.states.set(self.entity_id, self.state,
+                                 dict(self.state_attributes or {}))
+
+        @types.coroutine
+        def async_update_ha_state(self, force_refresh=False):
+            # pylint: disable=unused-argument
+            """ Write the entity to the state machine on the loop. """
+            self.hass.states.async_set(self.entity_id, self.state,
+                                       dict(self.state_attributes or {}))
+            yield from ()
+
+    def callback(func):
+        """ Stand-in for core.callback, marks a function safe to run on
+        the loop. """
+        # pylint: disable=protected-access
+        func._hass_callback = True
+        return func
+
+    def distance(lat1, lon1, lat2, lon2):
+        """ Stand-in for util.location.distance, in metres. """
+        return vincenty((lat1, lon1), (lat2, lon2)) * 1000
+
+    modules = {
+        'homeassistant': {},
+        'homeassistant.const': {
+            'ATTR_ENTITY_ID': 'entity_id',
+            'ATTR_HIDDEN': 'hidden',
+            'EVENT_HOMEASSISTANT_STOP': 'homeassistant_stop'},
+        'homeassistant.helpers': {},
+        'homeassistant.core': {'callback': callback},
+        'homeassistant.helpers.event': {
+            'track_state_change': track_state_change,
+            'track_point_in_utc_time': track_point_in_utc_time,
+            'async_track_state_change': track_state_change,
+            'async_track_point_in_utc_time': track_point_in_utc_time},
+        'homeassistant.helpers.entity': {'Entity': Entity},
+        'homeassistant.util': {},
+        'homeassistant.util.location': {'distance': distance},
+        'homeassistant.util.dt': {'utcnow': lambda: hass.now},
+    }
+    for name, attributes in modules.items():
+        module = types.ModuleType(name)
+        module.__dict__.update(attributes)
+        sys.modules[name] = module
+
+
+class Counter(object):
+    """ Wraps a distance function and counts the distances it returns. """
+    def __init__(self, func, size=None):
+        self.func = func
+        self.size = size
+        self.calls = 0
+
+    def __call__(self, *args):
+        result = self.func(*args)
+        self.calls += 1 if self.size is None else self.size(result)
+        return result
+
+
+def generate_trace(seed, devices, zones, events):
+    # pylint: disable=too-many-locals
+    """ Generate a seeded synthetic trace of tracker updates.
+
+    Devices wander around the zones or head straight for one of them. Some
+    updates only change the battery level, like real trackers do.
+    Yields (device, state, attributes) tuples.
+    """
+    rand = random.Random(seed)
+    positions = {}
+    targets = {}
+    for device in devices:
+        zone = rand.choice(zones)
+        positions[device] = [zone[1] + rand.uniform(-0.3, 0.3),
+                             zone[2] + rand.uniform(-0.3, 0.3)]
+        targets[device] = None
+
+    for _ in range(events):
+        device = rand.choice(devices)
+        position = positions[device]
+        battery = rand.randint(1, 100)
+
+        if rand.random() >= ATTRIBUTE_ONLY_RATE:
+            if targets[device] is None and rand.random() < ZONE_BOUND_RATE:
+                targets[device] = rand.choice(zones)
+            target = targets[device]
+            if target is None:
+                position[0] += rand.gauss(0, 0.003)
+                position[1] += rand.gauss(0, 0.003)
+            else:
+                step = rand.uniform(0.1, 0.5)
+                position[0] += (target[1] - position[0]) * step
+                position[1] += (target[2] - position[1]) * step
+
+        state = 'not_home'
+        for name, latitude, longitude in zones:
+            if abs(position[0] - latitude) * 111000 < ZONE_RADIUS and \
+                    abs(position[1] - longitude) * 70000 < ZONE_RADIUS:
+                state = name
+                targets[device] = None
+                break
+
+        yield device, state, {'latitude': position[0],
+                              'longitude': position[1],
+                              'battery': battery,
+                              'friendly_name': device.split('.', 1)[1]}
+
+
+def make_world(seed, num_devices, num_zones):
+    """ Build the zones and devices of a scenario. """
+    rand = random.Random(seed)
+    zones = [('home' if index == 0 else 'zone{}'.format(index),
+              50 + rand.uniform(-0.5, 0.5), rand.uniform(-0.5, 0.5))
+             for index in range(num_zones)]
+    devices = ['device_tracker.device{}'.format(index)
+               for index in range(num_devices)]
+    return zones, devices
+
+
+def run_scenario(component, num_devices, num_zones, num_events, seed,
+                 zone_options=None, batch_size=1):
+    # pylint: disable=too-many-arguments,too-many-locals
+    """ Run one scenario and return its metrics.
+
+    With a batch_size above 1 the proximity_zones trace is fed through the
+    update_devices service that many updates at a time.
+    """
+    # persisted zones keep their snapshot in a scratch configuration
+    # directory
+    with tempfile.TemporaryDirectory() as config_dir:
+        hass = Hass()
+        hass.config.config_dir = config_dir
+        install_stub_homeassistant(hass)
+        for name in ('proximity', 'proximity_zones', 'proximity_common'):
+            sys.modules.pop(name, None)
+        module = importlib.import_module(component)
+
+        distance_counters = [Counter(module.distance)]
+        module.distance = distance_counters[0]
+        if hasattr(module, 'DISTANCE_BACKENDS'):
+            for name, func in list(module.DISTANCE_BACKENDS.items()):
+                module.DISTANCE_BACKENDS[name] = Counter(func)
+                distance_counters.append(module.DISTANCE_BACKENDS[name])
+        if getattr(module, 'np', None) is not None:
+            distance_counters.append(Counter(module.vincenty_matrix,
+                                             lambda result: result.size))
+            module.vincenty_matrix = distance_counters[-1]
+
+        zones, devices = make_world(seed, num_devices, num_zones)
+        trace = list(generate_trace(seed, devices, zones, num_events))
+
+        for name, latitude, longitude in zones:
+            hass.states.set('zone.' + name, 'zoning', {
+                'latitude': latitude, 'longitude': longitude,
+                'friendly_name': name, 'radius': ZONE_RADIUS})
+        for device in devices:
+            hass.states.set(device, 'not_home', {'friendly_name': device})
+
+        options = dict(zone_options or {})
+        if component == 'proximity':
+            options.update({'zone': 'home', 'devices': devices})
+            config = {'proximity': options}
+        else:
+            config = {'proximity_zones': [
+                dict(options, zone=name, devices=devices)
+                for name, _, _ in zones]}
+        if not module.setup(hass, config):
+            raise RuntimeError('{} setup failed'.format(component))
+
+        for counter in distance_counters:
+            counter.calls = 0
+        hass.states.writes = 0
+
+        latencies = []
+        started = time.perf_counter()
+        if batch_size > 1 and component == 'proximity_zones':
+            update_devices = hass.services.services[(
+                module.DOMAIN, module.SERVICE_UPDATE_DEVICES)]
+            for first in range(0, len(trace), batch_size):
+                updates = [dict(attributes, entity_id=device, state=state)
+                           for device, state, attributes
+                           in trace[first:first + batch_size]]
+                hass.now += datetime.timedelta(seconds=1)
+                event_start = time.perf_counter()
+                hass.fire_timers()
+                update_devices(types.SimpleNamespace(
+                    data={module.ATTR_UPDATES: updates}))
+                latencies.extend([(time.perf_counter() - event_start) /
+                                  len(updates)] * len(updates))
+        else:
+            for device, state, attributes in trace:
+                hass.now += datetime.timedelta(seconds=1)
+                event_start = time.perf_counter()
+                hass.fire_timers()
+                hass.states.set(device, state, attributes)
+                latencies.append(time.perf_counter() - event_start)
+        elapsed = time.perf_counter() - started
+
+        latencies.sort()
+        return {
+            'events_per_sec': num_events / elapsed,
+            'p50_us': latencies[len(latencies) // 2] * 1e6,
+            'p99_us': latencies[min(len(latencies) - 1,
+                                    int(len(latencies) * 0.99))] * 1e6,
+            'distances_per_event': sum(counter.calls for counter
+                                       in distance_counters) / num_events,
+            'writes_per_event': hass.states.writes / num_events,
+        }
+
+
+def main(argv=None):
+    """ Run the benchmark matrix from the command line. """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[3])
+    parser.add_argument('--component', nargs='+',
+                        default=['proximity', 'proximity_zones'],
+                        choices=['proximity', 'proximity_zones'])
+    parser.add_argument('--devices', nargs='+', type=int,
+                        default=[10, 100, 1000])
+    parser.add_argument('--zones', nargs='+', type=int, default=[1, 10, 50])
+    parser.add_argument('--events', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--batch', type=int, default=1,
+                        help='feed proximity_zones this many updates per '
+                        'update_devices call')
+    parser.add_argument('--option', action='append', default=[],
+                        metavar='KEY=VALUE',
+                        help='zone option, e.g. distance_backend=haversine')
+    args = parser.parse_args(argv)
+
+    zone_options = {}
+    for option in args.option:
+        key, value = option.split('=', 1)
+        try:
+            value = float(value) if '.' in value else int(value)
+        except ValueError:
+            pass
+        zone_options[key] = value
+
+    print('{:<16} {:>7} {:>5} {:>10} {:>9} {:>9} {:>10} {:>12}'.format(
+        'component', 'devices', 'zones', 'events/sec', 'p50 us', 'p99 us',
+        'dist/event', 'writes/event'))
+    for component in args.component:
+        # proximity only ever monitors a single zone
+        zone_counts = [1] if component == 'proximity' else args.zones
+        for num_zones in zone_counts:
+            for num_devices in args.devices:
+                result = run_scenario(component, num_devices, num_zones,
+                                      args.events, args.seed, zone_options,
+                                      args.batch)
+                print('{:<16} {:>7} {:>5} {:>10.0f} {:>9.1f} {:>9.1f} '
+                      '{:>10.2f} {:>12.3f}'.format(
+                          component, num_devices, num_zones,
+                          result['events_per_sec'], result['p50_us'],
+                          result['p99_us'], result['distances_per_event'],
+                          result['writes_per_event']))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,595 @@
+"""
+custom_components.proximity_common
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+Helpers shared by the proximity and proximity_zones components: the
+distance backend constants and error bounds, the movement, rounding and
+throttle checks, per-device log sampling, the ring buffer of recent
+distances, the snapshot store, the diagnostics entity and the publisher
+deciding when an entity is written.
+
+It is not a component and takes no configuration.
+"""
+
+import json
+import logging
+import os
+import tempfile
+import threading
+from array import array
+from bisect import bisect_left
+from datetime import timedelta
+from math import cos, hypot, radians
+from time import monotonic
+from homeassistant.helpers.event import track_point_in_utc_time
+from homeassistant.const import EVENT_HOMEASSISTANT_STOP
+from homeassistant.helpers.entity import Entity
+import homeassistant.util.dt as dt_util
+
+# cores without the asyncio event loop only support the synchronous setup
+try:
+    from homeassistant.core import callback
+    from homeassistant.helpers.event import async_track_point_in_utc_time
+except ImportError:
+    callback = None
+
+# distance backends: exact is homeassistant.util.location.distance, the
+# others are cheaper approximations that fall back to it whenever their
+# error could change a published value
+BACKEND_EXACT = 'exact'
+BACKEND_HAVERSINE = 'haversine'
+BACKEND_EQUIRECTANGULAR = 'equirectangular'
+DEFAULT_DISTANCE_BACKEND = BACKEND_EXACT
+
+# WGS-84 ellipsoid, as used by homeassistant.util.location.vincenty, and
+# the mean earth radius used by the haversine backend
+AXIS_A = 6378137
+FLATTENING = 1 / 298.257223563
+ECCENTRICITY_SQ = FLATTENING * (2 - FLATTENING)
+EARTH_RADIUS = 6371008.8
+
+# error bounds of the fast backends against the ellipsoid: relative error
+# of the spherical model, relative error of the locally flat model (which
+# grows with the square of the distance) and an absolute floor covering the
+# millimetre rounding of vincenty
+HAVERSINE_ERROR = 0.006
+EQUIRECTANGULAR_ERROR = 5e-5
+DISTANCE_ERROR_FLOOR = 0.005
+# the locally flat model is not used this close to the poles
+EQUIRECTANGULAR_MAX_LATITUDE = 80
+
+# per-event debug logging: log every Nth event of a device and at most
+# this many events per device per minute
+DEFAULT_LOG_SAMPLE_RATE = 1
+DEFAULT_LOG_RATE_LIMIT = 10
+LOG_RATE_WINDOW = 60
+
+# diagnostics entities are written at most this often (seconds)
+DIAGNOSTICS_INTERVAL = 60
+
+# upper bounds (microseconds) of the evaluation latency histogram buckets
+LATENCY_BUCKETS = (10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000,
+                   20000, 50000, 100000)
+
+# snapshots are written at most this often (seconds) after a change
+SNAPSHOT_DELAY = 30
+SNAPSHOT_VERSION = 1
+
+# default number of recent distances the direction of travel follows: the
+# previous and latest update of the device
+DEFAULT_TREND_WINDOW = 2
+
+# safety margin applied to the flat-earth displacement used by the
+# movement filter
+DISPLACEMENT_MARGIN = 1.01
+
+ATTR_FRIENDLY_NAME = 'friendly_name'
+
+# Shortcut for the logger
+_LOGGER = logging.getLogger(__name__)
+
+def displacement(lat1, lon1, lat2, lon2):
+    """ Cheap flat-earth distance in metres between two nearby points. """
+    lon_diff = (lon2 - lon1 + 180) % 360 - 180
+    return EARTH_RADIUS * DISPLACEMENT_MARGIN * hypot(
+        radians(lon_diff) * cos(radians(lat1)), radians(lat2 - lat1))
+
+def near_rounding_boundary(metres, error):
+    """ True if the distance published in km could differ within error. """
+    return round((metres - error) / 1000, 1) != \
+        round((metres + error) / 1000, 1)
+
+def near_tolerance_boundary(travelled, error, tolerance):
+    """ True if the direction of travel could differ within error. """
+    # allow for the 0.1 metre rounding of the distance travelled
+    return abs(abs(travelled) - tolerance) <= error + 0.05
+
+def throttled(published_dist, dist, elapsed, interval, delta):
+    """ True if a change of the published distance (km) comes too soon or
+    is too small for the distance band of the device. """
+    if not isinstance(dist, (int, float)) or \
+            not isinstance(published_dist, (int, float)):
+        return False
+    band = min(dist, published_dist)
+    if interval and elapsed < interval * band:
+        return True
+    return bool(delta) and abs(dist - published_dist) < delta * band
+
+def throttle_remaining(published_dist, dist, elapsed, interval):
+    """ Seconds until the interval of the distance band lets a throttled
+    change through, None if the interval does not hold it back. """
+    if not interval:
+        return None
+    remaining = interval * min(dist, published_dist) - elapsed
+    if remaining > 0:
+        return remaining
+    return None
+
+def load_snapshot(filename):
+    """ Read the snapshot, an empty one if missing or unreadable. """
+    try:
+        with open(filename) as snapshot_file:
+            snapshot = json.load(snapshot_file)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as err:
+        _LOGGER.error('%s: snapshot not loaded: %s', filename, err)
+        return {}
+    if not isinstance(snapshot, dict) or \
+            snapshot.get('version') != SNAPSHOT_VERSION:
+        _LOGGER.error('%s: snapshot version not supported', filename)
+        return {}
+    return snapshot.get('zones', {})
+
+
+class QuietLogger(object):
+    """ Stands in for the logger on events that are not logged. """
+    def debug(self, *args, **kwargs):
+        """ Discard the message without formatting it. """
+        pass
+
+    info = debug
+
+QUIET_LOGGER = QuietLogger()
+
+
+class DeviceLogLimiter(object):
+    """ Per-device sampling and rate limiting of per-event log lines. """
+    def __init__(self, logger, sample_rate, rate_limit):
+        self.logger = logger
+        self.sample_rate = max(1, sample_rate)
+        self.rate_limit = rate_limit
+        self._events = {}
+        self._windows = {}
+
+    def logger_for(self, device):
+        """ The logger to use for an event of the device. """
+        if not self.logger.isEnabledFor(logging.DEBUG):
+            return QUIET_LOGGER
+
+        events = self._events.get(device, 0) + 1
+        self._events[device] = events
+        if events % self.sample_rate:
+            return QUIET_LOGGER
+
+        now = monotonic()
+        started, logged = self._windows.get(device, (now, 0))
+        if now - started >= LOG_RATE_WINDOW:
+            started, logged = now, 0
+        if logged >= self.rate_limit:
+            return QUIET_LOGGER
+        self._windows[device] = (started, logged + 1)
+        return self.logger
+
+
+class DeviceTrack(object):  # pylint: disable=too-few-public-methods
+    """ What a proximity entity knows about one of its devices.
+
+    One record per entity and device is allocated at setup and updated in
+    place on each event, so the hot path allocates no per-device dicts.
+    state and position are those the device was last evaluated at, state is
+    None until it has been, distance is None while the device has no usable
+    position.
+    """
+    __slots__ = ('name', 'state', 'in_zone', 'latitude', 'longitude',
+                 'distance', 'error', 'batch', 'old_state', 'old_distance',
+                 'old_error', 'old_position', 'new_state', 'restored', 'far',
+                 'trend')
+
+    def __init__(self):
+        self.name = None
+        self.state = None
+        # in the monitored zone, kept with the state it was decided from
+        self.in_zone = False
+        self.latitude = None
+        self.longitude = None
+        self.distance = None
+        self.error = 0
+        # proximity_zones: evaluation the device last changed in, with its
+        # state, cached distance and the position that was measured at from
+        # before the first change of that evaluation
+        self.batch = 0
+        self.old_state = None
+        self.old_distance = None
+        self.old_error = 0
+        self.old_position = None
+        self.new_state = None
+        # position from the snapshot, used as the previous position of a
+        # device that had none at startup
+        self.restored = None
+        # proximity_zones: beyond the max_range of the zone, so not measured
+        # or ranked
+        self.far = False
+        # recent distances when the zone has a trend_window
+        self.trend = None
+
+
+class DistanceTrend(object):
+    """ Ring buffer of the recent distances of a device from the zone.
+
+    Each distance is kept with the position it was measured at and its
+    error bound, so approximate distances can be re-measured exactly when
+    their error could change the direction of travel.
+    """
+    __slots__ = ('size', 'count', 'next', 'distances', 'errors',
+                 'latitudes', 'longitudes')
+
+    def __init__(self, size):
+        self.size = size
+        self.count = 0
+        self.next = 0
+        self.distances = array('d', bytes(8 * size))
+        self.errors = array('d', bytes(8 * size))
+        self.latitudes = array('d', bytes(8 * size))
+        self.longitudes = array('d', bytes(8 * size))
+
+    def clear(self):
+        """ Forget the distances, e.g. when the zone has moved. """
+        self.count = 0
+        self.next = 0
+
+    def add(self, metres, error, latitude, longitude):
+        """ Record the latest distance in place of the oldest. """
+        index = self.next
+        self.distances[index] = metres
+        self.errors[index] = error
+        self.latitudes[index] = latitude
+        self.longitudes[index] = longitude
+        self.next = (index + 1) % self.size
+        if self.count < self.size:
+            self.count += 1
+
+    def change(self):
+        """ Change in distance (metres) across the window along the
+        least-squares line through the distances, and its error bound. """
+        count = self.count
+        start = self.next - count
+        middle = (count - 1) / 2
+        spread = count * (count * count - 1) / 12
+        slope = error = 0
+        for sample in range(count):
+            index = (start + sample) % self.size
+            weight = (sample - middle) / spread
+            slope += weight * self.distances[index]
+            error += abs(weight) * self.errors[index]
+        return slope * (count - 1), error * (count - 1)
+
+    def remeasure(self, measure):
+        """ Replace the approximate distances with measure(lat, lon). """
+        for sample in range(self.next - self.count, self.next):
+            index = sample % self.size
+            if self.errors[index]:
+                self.distances[index] = measure(self.latitudes[index],
+                                                self.longitudes[index])
+                self.errors[index] = 0
+
+
+class SnapshotStore(object):
+    """ Snapshot of the persisted entities on disk.
+
+    The file is read once at setup by load_snapshot. A change schedules a
+    single write SNAPSHOT_DELAY seconds later; the data is collected on
+    the caller's thread and written to a temporary file that replaces the
+    snapshot. A scheduled write and the write at shutdown can overlap, so
+    each has its own temporary file and an older collection never replaces
+    a newer one.
+    """
+    def __init__(self, hass, filename, collect, run_on_loop):
+        self.hass = hass
+        self.filename = filename
+        self.collect = collect
+        self.run_on_loop = run_on_loop
+        self._scheduled = False
+        self._lock = threading.Lock()
+        self._collected = 0
+        self._written = 0
+
+        # write the latest values on shutdown
+        if run_on_loop:
+            hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP,
+                                       self.stop)
+        else:
+            hass.bus.listen_once(EVENT_HOMEASSISTANT_STOP, self.stop)
+
+    def schedule(self):
+        """ Write the snapshot shortly, unless a write is already due. """
+        if self._scheduled:
+            return
+        self._scheduled = True
+        point_in_time = dt_util.utcnow() + timedelta(seconds=SNAPSHOT_DELAY)
+        if self.run_on_loop:
+            async_track_point_in_utc_time(
+                self.hass, callback(lambda now: self.flush(now)),
+                point_in_time)
+        else:
+            track_point_in_utc_time(self.hass, self.flush, point_in_time)
+
+    def collect_numbered(self):
+        """ Collect the snapshot, numbered in the order of collection. """
+        with self._lock:
+            self._collected += 1
+            return self.collect(), self._collected
+
+    def flush(self, now=None):
+        """ Collect the snapshot and write it off the event loop. """
+        # pylint: disable=unused-argument
+        self._scheduled = False
+        zones, number = self.collect_numbered()
+        if self.run_on_loop:
+            self.hass.async_add_job(self.write, zones, number)
+        else:
+            self.write(zones, number)
+
+    def stop(self, event):
+        """ Write the snapshot as Home Assistant stops. """
+        # pylint: disable=unused-argument
+        self.write(*self.collect_numbered())
+
+    def write(self, zones, number):
+        """ Replace the snapshot file with the zones of a collection,
+        unless a later collection has been written already. """
+        directory, name = os.path.split(self.filename)
+        temporary = None
+        try:
+            handle, temporary = tempfile.mkstemp(
+                prefix=name + '.', suffix='.tmp', dir=directory or '.')
+            with os.fdopen(handle, 'w') as snapshot_file:
+                json.dump({'version': SNAPSHOT_VERSION, 'zones': zones},
+                          snapshot_file, separators=(',', ':'))
+            with self._lock:
+                if number > self._written:
+                    os.replace(temporary, self.filename)
+                    self._written = number
+                    temporary = None
+        except OSError as err:
+            _LOGGER.error('%s: snapshot not written: %s', self.filename, err)
+        if temporary is not None:
+            try:
+                os.remove(temporary)
+            except OSError:
+                pass
+
+
+class ProximityDiagnostics(Entity):
+    """ Hot path counters of a proximity entity, published as an entity.
+
+    Counts events received and skipped, distance calculations, state reads
+    and entity writes, and keeps a fixed-size histogram of evaluation
+    latencies so the cost of a zone can be read without debug logging.
+    """
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, hass, zone_friendly_name):
+        self.hass = hass
+        self.friendly_name = zone_friendly_name + ' diagnostics'
+        self.run_on_loop = False
+        self.events = 0
+        self.skipped = 0
+        self.distances = 0
+        self.state_reads = 0
+        self.writes = 0
+        self.throttled = 0
+        self.shadow_checks = 0
+        self.shadow_divergences = 0
+        self.shadow_time = 0
+        self.latency = [0] * (len(LATENCY_BUCKETS) + 1)
+        self._published_counts = None
+
+    def record_latency(self, seconds):
+        """ Add an evaluation time to the latency histogram. """
+        self.latency[bisect_left(LATENCY_BUCKETS, seconds * 1e6)] += 1
+
+    def latency_percentile(self, fraction):
+        """ Upper bound of the bucket holding the given percentile. """
+        target = sum(self.latency) * fraction
+        count = 0
+        for index, bucket in enumerate(self.latency):
+            count += bucket
+            if bucket and count >= target:
+                if index < len(LATENCY_BUCKETS):
+                    return LATENCY_BUCKETS[index]
+                return 'over {}'.format(LATENCY_BUCKETS[-1])
+        return None
+
+    @property
+    def should_poll(self):
+        return False
+
+    @property
+    def name(self):
+        return self.friendly_name
+
+    @property
+    def state(self):
+        return self.events
+
+    @property
+    def unit_of_measurement(self):
+        """ Unit of measurement of this entity """
+        return "events"
+
+    @property
+    def state_attributes(self):
+        buckets = ['<={}us'.format(bound) for bound in LATENCY_BUCKETS]
+        buckets.append('>{}us'.format(LATENCY_BUCKETS[-1]))
+        return {
+            'events_skipped': self.skipped,
+            'distance_calculations': self.distances,
+            'state_reads': self.state_reads,
+            'entity_writes': self.writes,
+            'writes_throttled': self.throttled,
+            'shadow_checks': self.shadow_checks,
+            'shadow_divergences': self.shadow_divergences,
+            'shadow_overhead_us': int(self.shadow_time * 1e6),
+            'latency_p50_us': self.latency_percentile(0.5),
+            'latency_p99_us': self.latency_percentile(0.99),
+            'latency_histogram': dict(zip(buckets, self.latency)),
+            ATTR_FRIENDLY_NAME: self.friendly_name
+        }
+
+    def publish(self):
+        """ Write the entity if any events have been received since. """
+        counts = (self.events, self.skipped)
+        if counts == self._published_counts:
+            return
+        self._published_counts = counts
+        if self.run_on_loop:
+            self.hass.async_add_job(self.async_update_ha_state())
+        else:
+            self.update_ha_state()
+
+
+class EntityPublisher(object):
+    """ Decides when the values of a proximity entity are written.
+
+    Unchanged values are not re-written until refresh_interval has passed,
+    from a timer of its own, and changes of the distance alone wait for the
+    throttle of the distance band, with a trailing write once its interval
+    has passed. The component writes the entity in write(values, ranking).
+    """
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, hass, plan, diagnostics, distance_index, write):
+        self.hass = hass
+        self.entity_id = None
+        self.run_on_loop = False
+        self.lock = threading.RLock()
+        self.refresh_interval = plan.refresh_interval
+        self.throttle_interval = plan.throttle_interval
+        self.throttle_delta = plan.throttle_delta
+        self.top_k = plan.top_k
+        self.diagnostics = diagnostics
+        # the (distance in km, device) index of the component, whose front
+        # is the top_k ranking
+        self.distance_index = distance_index
+        self.write = write
+        # the values and ranking last written and when they were written
+        self.published = None
+        self.ranking = None
+        self.published_at = monotonic()
+        # the values last decided, which a throttled write has not published
+        self.decided = None
+        # when the trailing write of a distance the throttle held back is due
+        self._trailing_at = None
+        # while held only the decided values are kept, the entity is written
+        # once on release
+        self._holding = False
+        self._held = None
+
+    def schedule(self, action, seconds):
+        """ Run a timer callback once the seconds have passed. """
+        point_in_time = dt_util.utcnow() + timedelta(seconds=seconds)
+        if self.run_on_loop:
+            async_track_point_in_utc_time(
+                self.hass, callback(lambda now: action(now)), point_in_time)
+        else:
+            track_point_in_utc_time(self.hass, action, point_in_time)
+
+    def start(self):
+        """ Start the refresh timer once the entity has been set up. """
+        if self.refresh_interval:
+            self.schedule(self.refresh, self.refresh_interval)
+
+    def publish(self, values, throttle=True, log=_LOGGER):
+        """ Write the (distance, direction, nearest) values unless they are
+        unchanged or throttled.
+
+        log is the per-event logger of the device being evaluated.
+        """
+        self.decided = values
+        if self._holding:
+            # a write without the throttle stays without it
+            self._held = (throttle and (self._held is None or
+                                        self._held[0]), log)
+            return
+        ranking = None
+        if self.top_k:
+            ranking = tuple(self.distance_index[:self.top_k])
+        now = monotonic()
+        elapsed = now - self.published_at
+        published = self.published
+        if values == published and ranking == self.ranking and (
+                self.refresh_interval is None or
+                elapsed < self.refresh_interval):
+            log.debug('%s: entity not updated: values unchanged',
+                      self.entity_id)
+            return
+        # changes of the distance alone wait for the throttle of its band
+        if throttle and published is not None and \
+                values[1:] == published[1:] and ranking == self.ranking and (
+                    self.refresh_interval is None or
+                    elapsed < self.refresh_interval) and \
+                throttled(published[0], values[0], elapsed,
+                          self.throttle_interval, self.throttle_delta):
+            self.diagnostics.throttled += 1
+            log.debug('%s: entity not updated: distance %s throttled',
+                      self.entity_id, values[0])
+            # write the distance once the interval has passed, in case the
+            # device does not report again
+            remaining = throttle_remaining(published[0], values[0], elapsed,
+                                           self.throttle_interval)
+            if remaining is not None and (
+                    self._trailing_at is None or
+                    now + remaining < self._trailing_at):
+                due = self._trailing_at = now + remaining
+                self.schedule(lambda _now: self.write_trailing(due),
+                              remaining)
+            return
+        self.published = values
+        self.ranking = ranking
+        self.published_at = now
+        self._trailing_at = None
+        self.diagnostics.writes += 1
+        self.write(values, ranking)
+        _LOGGER.info('%s: distance=%s direction=%s nearest=%s',
+                     self.entity_id, *values)
+
+    def hold(self):
+        """ Keep the values decided from now on without writing them. """
+        self._holding = True
+
+    def release(self):
+        """ Write the values decided while held, once. """
+        self._holding = False
+        if self._held is not None:
+            throttle, log = self._held
+            self._held = None
+            self.publish(self.decided, throttle, log)
+
+    def write_trailing(self, due):
+        """ Write the values the throttle held back, unless the trailing
+        write due then has been superseded. """
+        with self.lock:
+            if self._trailing_at != due:
+                return
+            self._trailing_at = None
+            self.publish(self.decided)
+
+    def refresh(self, now=None):
+        """ Re-write the entity once refresh_interval has passed without a
+        write, then wait for the next one. """
+        # pylint: disable=unused-argument
+        with self.lock:
+            elapsed = monotonic() - self.published_at
+            if elapsed >= self.refresh_interval:
+                if self.decided is not None:
+                    self.publish(self.decided, throttle=False)
+                elapsed = 0
+            self.schedule(self.refresh, self.refresh_interval - elapsed)
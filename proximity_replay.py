@@ -0,0 +1,265 @@
+"""
+proximity_replay
+~~~~~~~~~~~~~~~~
+Offline replay of recorded device tracker history through the proximity
+or proximity_zones component, to backtest a configuration (tolerances,
+ignored zones, ...) without Home Assistant.
+
+The history is a CSV file with a header row, or a file of JSON lines, with
+timestamp, device, state, latitude and longitude columns/keys, in time
+order. Timestamps are ISO 8601 or seconds since the epoch; latitude and
+longitude may be empty for updates without a position.
+
+The configuration is a JSON file holding the zones and the component's
+configuration, as it would appear in configuration.yaml:
+
+{"zones": {"home": {"latitude": 52.37, "longitude": 4.89},
+           "work": {"latitude": 52.09, "longitude": 5.12}},
+ "proximity_zones": [{"zone": "home", "devices": ["device_tracker.phone"],
+                      "tolerance": 50, "ignored_zones": ["work"]}]}
+
+Rows are read and replayed one at a time, so memory does not grow with
+the length of the history. Each write of a proximity entity is output as a
+JSON line of timestamp, entity_id, state and attributes. The components'
+timers and refresh intervals follow the recorded timestamps.
+
+A replay neither reads nor writes the persisted snapshot, and leaves out
+the diagnostics and tracing: the persist, diagnostics and trace_size
+options are ignored. Shadow checks (shadow_sample_rate) still log any
+divergence. The rows are passed
+straight to the component's state change listeners rather than written to
+the state machine. Zones without a distance_backend are replayed with the
+equirectangular backend (see --backend), which falls back to the exact
+distance near every decision, so the states match an exact replay.
+
+Example:
+python proximity_replay.py config.json history.csv --output states.jsonl
+"""
+
+import argparse
+import copy
+import csv
+import datetime
+import importlib
+import itertools
+import json
+import sys
+import time
+
+from proximity_benchmark import Hass, State, install_stub_homeassistant
+
+# columns of the history, latitude and longitude are optional
+HISTORY_COLUMNS = ('timestamp', 'device', 'state', 'latitude', 'longitude')
+
+# distance backend of zones that do not configure one
+DEFAULT_BACKEND = 'equirectangular'
+
+
+def parse_timestamp(value):
+    """ Timestamp of a history row as an aware UTC datetime. """
+    if ':' not in value:
+        try:
+            return datetime.datetime.fromtimestamp(float(value),
+                                                   datetime.timezone.utc)
+        except ValueError:
+            pass
+    timestamp = datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=datetime.timezone.utc)
+    return timestamp
+
+
+def parse_coordinate(value):
+    """ Latitude or longitude of a history row, None when missing. """
+    if value is None or value == '':
+        return None
+    return float(value)
+
+
+def read_history(path):
+    """ Read a CSV or JSON lines history file one row at a time.
+
+    Yields (timestamp, device, state, latitude, longitude) tuples.
+    """
+    with open(path, newline='') as history_file:
+        if not path.endswith('.csv'):
+            for line in history_file:
+                if line.strip():
+                    row = json.loads(line)
+                    yield (parse_timestamp(str(row['timestamp'])),
+                           row['device'], row['state'],
+                           parse_coordinate(row.get('latitude')),
+                           parse_coordinate(row.get('longitude')))
+            return
+        # plain rows by column index, cheaper than a dict per row
+        rows = csv.reader(history_file)
+        header = next(rows, [])
+        missing = [column for column in HISTORY_COLUMNS[:3]
+                   if column not in header]
+        if missing:
+            raise ValueError('{}: missing columns {}'.format(
+                path, ', '.join(missing)))
+        timestamp, device, state = (header.index(column)
+                                    for column in HISTORY_COLUMNS[:3])
+        latitude, longitude = (
+            header.index(column) if column in header else None
+            for column in HISTORY_COLUMNS[3:])
+        for row in rows:
+            yield (parse_timestamp(row[timestamp]), row[device], row[state],
+                   None if latitude is None else
+                   parse_coordinate(row[latitude]),
+                   None if longitude is None else
+                   parse_coordinate(row[longitude]))
+
+
+def component_of(config):
+    """ The component a replay configuration is for. """
+    for component in ('proximity_zones', 'proximity'):
+        if component in config:
+            return component
+    raise ValueError('configuration has no proximity or proximity_zones')
+
+
+def replay_config(config, backend=DEFAULT_BACKEND):
+    """ The component configuration of a replay.
+
+    Turns off persist, the diagnostics and tracing, and gives zones
+    without a distance_backend the backend.
+    """
+    component = component_of(config)
+    component_config = copy.deepcopy(config[component])
+    zone_configs = component_config
+    if isinstance(zone_configs, dict):
+        zone_configs = [zone_configs]
+    for zone_config in zone_configs:
+        for key in ('persist', 'trace_size'):
+            zone_config.pop(key, None)
+        zone_config['diagnostics'] = False
+        zone_config.setdefault('distance_backend', backend)
+    return {component: component_config}
+
+
+def replay(config, rows, backend=DEFAULT_BACKEND):
+    # pylint: disable=too-many-locals
+    """ Replay history rows through the component of a configuration.
+
+    Yields (timestamp, entity_id, state, attributes) for every write of a
+    proximity entity, as the rows are consumed.
+    """
+    component = component_of(config)
+    hass = Hass()
+    install_stub_homeassistant(hass)
+    for name in ('proximity', 'proximity_zones', 'proximity_common'):
+        sys.modules.pop(name, None)
+    module = importlib.import_module(component)
+
+    # refresh intervals and log rate limits follow the recorded timestamps
+    sys.modules['proximity_common'].monotonic = \
+        lambda: hass.now.timestamp()
+
+    # collect the writes of the proximity entities (not their diagnostics)
+    written = []
+    set_state = hass.states.set
+
+    def record_state(entity_id, new_state, attributes=None):
+        """ Set a state and keep the proximity entity writes. """
+        set_state(entity_id, new_state, attributes)
+        if entity_id.startswith(component + '.') and \
+                not entity_id.endswith('_diagnostics'):
+            written.append((entity_id, new_state, attributes))
+    hass.states.set = record_state
+
+    for name, zone in config.get('zones', {}).items():
+        set_state('zone.' + name, 'zoning', {
+            'latitude': zone['latitude'], 'longitude': zone['longitude'],
+            'radius': zone.get('radius', 100),
+            'friendly_name': zone.get('name', name)})
+
+    rows = iter(rows)
+    first = next(rows, None)
+    if first is None:
+        return
+    hass.now = first[0]
+    if not module.setup(hass, replay_config(config, backend)):
+        raise RuntimeError('{} setup failed'.format(component))
+    del written[:]
+
+    # per device: its listeners, its name, the attributes of its updates
+    # without a position (shared, as nothing writes to them) and its latest
+    # state
+    devices = {}
+    for timestamp, device, state, latitude, longitude in \
+            itertools.chain([first], rows):
+        hass.now = timestamp
+        hass.fire_timers()
+        known = devices.get(device)
+        if known is None:
+            name = device.split('.', 1)[-1]
+            known = devices[device] = [
+                hass.listeners.get(device, ()), name,
+                {'friendly_name': name}, None]
+        listeners, name, unplaced, old_state = known
+        if latitude is None:
+            new_state = State(device, state, unplaced)
+        else:
+            new_state = State(device, state, {
+                'friendly_name': name, 'latitude': latitude,
+                'longitude': longitude})
+        known[3] = new_state
+        for action in listeners:
+            action(device, old_state, new_state)
+        if written:
+            for entity_id, entity_state, entity_attributes in written:
+                yield timestamp, entity_id, entity_state, entity_attributes
+            del written[:]
+
+
+def main(argv=None):
+    """ Replay a history file from the command line. """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[3])
+    parser.add_argument('config', help='JSON file of zones and component '
+                        'configuration')
+    parser.add_argument('history', help='CSV or JSON lines history file')
+    parser.add_argument('--output', help='JSON lines file for the entity '
+                        'states (default stdout)')
+    parser.add_argument('--backend', default=DEFAULT_BACKEND,
+                        help='distance backend of zones without one '
+                        '(default %(default)s)')
+    args = parser.parse_args(argv)
+
+    with open(args.config) as config_file:
+        config = json.load(config_file)
+
+    output = sys.stdout
+    if args.output:
+        output = open(args.output, 'w')
+    rows = 0
+
+    def counted(history):
+        """ Count the rows as they are replayed. """
+        nonlocal rows
+        for row in history:
+            rows += 1
+            yield row
+
+    writes = 0
+    started = time.perf_counter()
+    try:
+        for timestamp, entity_id, state, attributes in \
+                replay(config, counted(read_history(args.history)),
+                       args.backend):
+            writes += 1
+            output.write(json.dumps({
+                'timestamp': timestamp.isoformat(), 'entity_id': entity_id,
+                'state': state, 'attributes': attributes}, default=str))
+            output.write('\n')
+    finally:
+        if args.output:
+            output.close()
+    elapsed = time.perf_counter() - started
+    print('{} rows, {} entity writes in {:.1f}s ({:.0f} rows/sec)'.format(
+        rows, writes, elapsed, rows / elapsed if elapsed else 0),
+          file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,214 @@
+"""
+proximity_sweep
+~~~~~~~~~~~~~~~
+Parameter sweep of the proximity and proximity_zones components over
+recorded device tracker history, run across a pool of processes.
+
+The history (see proximity_replay) is packed once into a binary trace of
+fixed size records. Every worker memory-maps the trace read-only, so the
+operating system shares its pages between the workers rather than each
+worker holding a copy, and replays one variant of the configuration
+through the component.
+
+Variants are every combination of the given tolerances, zone sets and
+ignored zone lists, each overriding the base configuration. A zone set
+is a comma separated list of the zones (of the base proximity_zones
+configuration) to keep; for proximity its first zone is the monitored
+zone. An ignored zone list is comma separated, an empty string ignores
+nothing.
+
+For each variant the sweep reports the entity writes and how often each
+direction of travel was published, as a table or JSON lines.
+
+Example:
+python proximity_sweep.py config.json history.csv --tolerance 10 50 100 \\
+    --zone-set home home,work --ignored "" work --processes 4
+"""
+
+import argparse
+import copy
+import datetime
+import itertools
+import json
+import math
+import mmap
+import multiprocessing
+import os
+import struct
+import sys
+import tempfile
+import time
+
+from proximity_replay import component_of, read_history, replay
+
+# trace file: magic, header length, JSON header of the device and state
+# names, then one record per row of timestamp, device index, state index,
+# latitude and longitude (NaN when missing)
+TRACE_MAGIC = b'PXTR0001'
+TRACE_HEADER = struct.Struct('<8sI')
+TRACE_RECORD = struct.Struct('<dIIdd')
+
+
+def pack_trace(history_path, trace_path):
+    """ Pack a history file into a trace file, returns the row count. """
+    devices = {}
+    states = {}
+    rows = 0
+    body_path = trace_path + '.body'
+    with open(body_path, 'wb') as body:
+        for timestamp, device, state, latitude, longitude in \
+                read_history(history_path):
+            body.write(TRACE_RECORD.pack(
+                timestamp.timestamp(),
+                devices.setdefault(device, len(devices)),
+                states.setdefault(state, len(states)),
+                math.nan if latitude is None else latitude,
+                math.nan if longitude is None else longitude))
+            rows += 1
+
+    header = json.dumps({'devices': list(devices),
+                         'states': list(states)}).encode()
+    with open(trace_path, 'wb') as trace, open(body_path, 'rb') as body:
+        trace.write(TRACE_HEADER.pack(TRACE_MAGIC, len(header)))
+        trace.write(header)
+        while True:
+            chunk = body.read(1 << 20)
+            if not chunk:
+                break
+            trace.write(chunk)
+    os.remove(body_path)
+    return rows
+
+
+def trace_rows(trace_path):
+    """ Read a trace file through a read-only memory map.
+
+    Yields (timestamp, device, state, latitude, longitude) tuples like
+    proximity_replay.read_history.
+    """
+    with open(trace_path, 'rb') as trace, \
+            mmap.mmap(trace.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        magic, header_length = TRACE_HEADER.unpack_from(mapped)
+        if magic != TRACE_MAGIC:
+            raise ValueError('{}: not a trace file'.format(trace_path))
+        start = TRACE_HEADER.size + header_length
+        header = json.loads(mapped[TRACE_HEADER.size:start].decode())
+        devices = header['devices']
+        states = header['states']
+        utc = datetime.timezone.utc
+        view = memoryview(mapped)[start:]
+        try:
+            for timestamp, device, state, latitude, longitude in \
+                    TRACE_RECORD.iter_unpack(view):
+                if latitude != latitude:
+                    latitude = longitude = None
+                yield (datetime.datetime.fromtimestamp(timestamp, utc),
+                       devices[device], states[state], latitude, longitude)
+        finally:
+            view.release()
+
+
+def split_list(value):
+    """ A comma separated command line list. """
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+def variants(config, tolerances, zone_sets, ignored_lists):
+    """ Every combination of the parameters applied to the base
+    configuration, as (parameters, configuration) pairs. """
+    component = component_of(config)
+    for tolerance, zone_set, ignored in itertools.product(
+            tolerances or [None], zone_sets or [None],
+            ignored_lists or [None]):
+        variant = copy.deepcopy(config)
+        if component == 'proximity':
+            zone_configs = [variant[component]]
+            if zone_set is not None:
+                variant[component]['zone'] = split_list(zone_set)[0]
+        else:
+            zone_configs = variant[component]
+            if zone_set is not None:
+                keep = split_list(zone_set)
+                zone_configs = variant[component] = [
+                    zone_config for zone_config in zone_configs
+                    if zone_config.get('zone', 'home') in keep]
+        for zone_config in zone_configs:
+            if tolerance is not None:
+                zone_config['tolerance'] = tolerance
+            if ignored is not None:
+                zone_config['ignored_zones'] = split_list(ignored)
+        yield ({'tolerance': tolerance, 'zones': zone_set,
+                'ignored': ignored}, variant)
+
+
+def run_variant(task):
+    """ Replay the trace through one variant and summarise the writes. """
+    parameters, config, trace_path = task
+    writes = 0
+    directions = {}
+    started = time.perf_counter()
+    for _, _, _, attributes in replay(config, trace_rows(trace_path)):
+        writes += 1
+        direction = attributes.get('dir_of_travel')
+        directions[direction] = directions.get(direction, 0) + 1
+    return dict(parameters, writes=writes, directions=directions,
+                seconds=time.perf_counter() - started)
+
+
+def main(argv=None):
+    """ Run a parameter sweep from the command line. """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[3])
+    parser.add_argument('config', help='JSON file of zones and the base '
+                        'component configuration')
+    parser.add_argument('history', help='CSV or JSON lines history file')
+    parser.add_argument('--tolerance', nargs='+', type=float, default=[])
+    parser.add_argument('--zone-set', nargs='+', default=[],
+                        help='comma separated zones to keep')
+    parser.add_argument('--ignored', nargs='+', default=[],
+                        help='comma separated ignored zones')
+    parser.add_argument('--processes', type=int,
+                        default=multiprocessing.cpu_count())
+    parser.add_argument('--trace', help='keep the packed trace at this '
+                        'path (reused if it exists)')
+    parser.add_argument('--json', action='store_true',
+                        help='write JSON lines instead of a table')
+    args = parser.parse_args(argv)
+
+    with open(args.config) as config_file:
+        config = json.load(config_file)
+
+    trace_path = args.trace
+    if trace_path is None:
+        handle, trace_path = tempfile.mkstemp(suffix='.trace')
+        os.close(handle)
+    try:
+        if args.trace is None or not os.path.exists(trace_path):
+            rows = pack_trace(args.history, trace_path)
+            print('{} rows packed into {}'.format(rows, trace_path),
+                  file=sys.stderr)
+
+        tasks = [(parameters, variant, trace_path) for parameters, variant
+                 in variants(config, args.tolerance, args.zone_set,
+                             args.ignored)]
+        if not args.json:
+            print('{:>10} {:<20} {:<20} {:>8} {:>8}  {}'.format(
+                'tolerance', 'zones', 'ignored', 'writes', 'seconds',
+                'directions'))
+        with multiprocessing.Pool(args.processes) as pool:
+            for result in pool.imap(run_variant, tasks):
+                if args.json:
+                    print(json.dumps(result))
+                    continue
+                print('{:>10} {:<20} {:<20} {:>8} {:>8.1f}  {}'.format(
+                    str(result['tolerance']), str(result['zones']),
+                    str(result['ignored']), result['writes'],
+                    result['seconds'], ', '.join(
+                        '{}={}'.format(direction, count) for direction, count
+                        in sorted(result['directions'].items(),
+                                  key=lambda item: str(item[0])))))
+    finally:
+        if args.trace is None:
+            os.remove(trace_path)
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,82 @@
 """
 custom_components.proximity_zones
 ~~~~~~~~~~~~~~~~~~~~~~~~~
+Component to monitor the proximity of devices to a list of zones. Each zone
+gets an entity in HA which maintains its proximity data, and a diagnostics
+entity with its hot path counters
 
+Use configuration.yaml to tune these settings for each zone:
+- Zone: the zone to which the distance is measured
+- Ignored Zones: where proximity is not calculated (e.g. work or school)
+- Devices: a list of devices to compare location against to check closeness to
+  the zone
+- Tolerance: the tolerance used to calculate the direction of travel in metres
+  (to filter out small GPS co-ordinate changes)
+- Refresh Interval: optional number of seconds after which the entity is
+  written even if its values have not changed, from a timer, so it is
+  re-written while no device reports a move. By default unchanged values
+  are never re-written
+- Distance Backend: exact (default), haversine or equirectangular. The fast
+  backends fall back to the exact calculation whenever their error could
+  change the published distance or direction of travel
+- Coalesce Window: optional number of seconds in which a burst of updates
+  is collected. Each device's updates collapse to its latest one, its
+  direction of travel is taken from its position before the window, and
+  the zone is evaluated once per window. Off by default
+- Log Sample Rate / Log Rate Limit: per-event debug lines are only written
+  for every Nth update of a device, and at most this many times per device
+  per minute (defaults 1 and 10)
+- Persist: optionally keep the entity values and the last device positions
+  in .proximity_zones.json in the configuration directory, so the entity
+  comes back with its last values after a restart and the direction of
+  travel is known from the first update of each device
+- Top K: optionally publish the K devices nearest to the zone, with their
+  distances, in the nearest_devices attribute
+- Max Range: optional distance in km beyond which devices are not measured;
+  zones further from a device are found from a grid over the zone centres
+  and the device is far from them. When all of a zone's devices are far its
+  entity is 'far'
+- Trend Window: optional number of recent distances of each device (default
+  2, its previous and latest update) the direction of travel is taken from,
+  along the least-squares line through them, so GPS jitter does not flip
+  the direction back and forth
+- Throttle Interval / Throttle Delta: optionally hold back writes where only
+  the distance changed until this many seconds per km of distance have
+  passed since the last write and the distance has changed by this fraction
+  of itself, so a device far from the zone is written rarely while one
+  close to it stays responsive. Changes of the direction of travel or the
+  nearest device are always written. A distance held back by the interval
+  is written once the interval has passed, even if the device has stopped
+- Shadow Sample Rate: optionally check every Nth evaluation against the
+  original full scan of the zone's devices with exact distances, counting
+  (in the diagnostics entity) and logging any evaluation where the
+  published distance, direction of travel or nearest device differs from
+  it. Off by default
+- Diagnostics: set to false to leave out the zone's diagnostics entity and
+  the timing of each evaluation it reports, e.g. for offline replays. On
+  by default
+
+The proximity_zones.update_devices service takes the positions of many
+devices in one call, e.g. from a GPS gateway reporting a fleet at once.
+Each device's state is written with its position (and any other keys as
+attributes; state is required, an update without one is ignored) and
+every zone tracking the devices is evaluated and written once for the
+whole batch.
+
+Example service data for proximity_zones.update_devices:
+updates:
+  - entity_id: device_tracker.van1
+    latitude: 52.37
+    longitude: 4.89
+    state: not_home
+  - entity_id: device_tracker.van2
+    latitude: 52.09
+    longitude: 5.12
+    state: work
+
+Example configuration.yaml entry:
 proximity_zones:
-- zone: home
+  - zone: home
     ignored_zones:
       - twork
       - elschool
@@ -12,7 +85,23 @@ proximity_zones:
       - device_tracker.eleanorsiphone
       - device_tracker.tsiphone
     tolerance: 1
-- zone: work
+    refresh_interval: 3600
+    distance_backend: equirectangular
+    coalesce_window: 5
+    log_sample_rate: 10
+    log_rate_limit: 6
+    persist: true
+    top_k: 3
+    trend_window: 5
+    throttle_interval: 2
+    throttle_delta: 0.05
+    shadow_sample_rate: 100
+    diagnostics: true
+  - zone: depot
+    devices:
+      - device_tracker.nwaring_nickmobile
+    max_range: 50
+  - zone: work
     ignored_zones:
       - home
     devices:
@@ -21,15 +110,73 @@ proximity_zones:
 """
 
 import logging
-from homeassistant.helpers.event import track_state_change
+import threading
+from bisect import bisect_left, insort
+from collections import OrderedDict, namedtuple
+from math import asin, ceil, cos, floor, hypot, pi, radians, sin, sqrt
+from datetime import timedelta
+from time import perf_counter
+from homeassistant.helpers.event import (
+    track_point_in_utc_time, track_state_change)
+from homeassistant.const import ATTR_ENTITY_ID
 from homeassistant.helpers.entity import Entity
 from homeassistant.util.location import distance
+import homeassistant.util.dt as dt_util
+
+# cores without the asyncio event loop only support the synchronous setup
+try:
+    from homeassistant.core import callback
+    from homeassistant.helpers.event import (
+        async_track_point_in_utc_time, async_track_state_change)
+except ImportError:
+    callback = None
+
+# async_setup is a generator coroutine, the kind the Python 3.4 cores run;
+# asyncio.coroutine is gone from Python 3.11, where types.coroutine makes
+# the same generator awaitable
+try:
+    from asyncio import coroutine
+except ImportError:
+    from types import coroutine
+
+# numpy is optional: without it distances are calculated one at a time
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# helpers shared with proximity: relative inside custom_components,
+# top-level for the offline tools
+try:
+    from .proximity_common import (
+        ATTR_FRIENDLY_NAME, AXIS_A, BACKEND_EQUIRECTANGULAR, BACKEND_EXACT,
+        BACKEND_HAVERSINE, DEFAULT_DISTANCE_BACKEND, DEFAULT_LOG_RATE_LIMIT,
+        DEFAULT_LOG_SAMPLE_RATE, DEFAULT_TREND_WINDOW, DIAGNOSTICS_INTERVAL,
+        DISTANCE_ERROR_FLOOR, EARTH_RADIUS, ECCENTRICITY_SQ,
+        EQUIRECTANGULAR_ERROR, EQUIRECTANGULAR_MAX_LATITUDE, FLATTENING,
+        HAVERSINE_ERROR, DeviceLogLimiter, DeviceTrack, DistanceTrend,
+        EntityPublisher, ProximityDiagnostics, SnapshotStore, displacement,
+        load_snapshot, near_rounding_boundary, near_tolerance_boundary)
+except ImportError:
+    from proximity_common import (
+        ATTR_FRIENDLY_NAME, AXIS_A, BACKEND_EQUIRECTANGULAR, BACKEND_EXACT,
+        BACKEND_HAVERSINE, DEFAULT_DISTANCE_BACKEND, DEFAULT_LOG_RATE_LIMIT,
+        DEFAULT_LOG_SAMPLE_RATE, DEFAULT_TREND_WINDOW, DIAGNOSTICS_INTERVAL,
+        DISTANCE_ERROR_FLOOR, EARTH_RADIUS, ECCENTRICITY_SQ,
+        EQUIRECTANGULAR_ERROR, EQUIRECTANGULAR_MAX_LATITUDE, FLATTENING,
+        HAVERSINE_ERROR, DeviceLogLimiter, DeviceTrack, DistanceTrend,
+        EntityPublisher, ProximityDiagnostics, SnapshotStore, displacement,
+        load_snapshot, near_rounding_boundary, near_tolerance_boundary)
 
 DEPENDENCIES = ['zone', 'device_tracker']
 
 # domain for the component
 DOMAIN = 'proximity_zones'
 
+# service evaluating the positions of many devices in one batch
+SERVICE_UPDATE_DEVICES = 'update_devices'
+ATTR_UPDATES = 'updates'
+
 # default tolerance
 DEFAULT_TOLERANCE = 1
 
@@ -40,112 +187,925 @@ DEFAULT_PROXIMITY_ZONE = 'home'
 ATTR_DIST_FROM = 'dist_to_zone'
 ATTR_DIR_OF_TRAVEL = 'dir_of_travel'
 ATTR_NEAREST = 'nearest'
-ATTR_FRIENDLY_NAME = 'friendly_name'
+ATTR_NEAREST_DEVICES = 'nearest_devices'
+
+# WGS-84 semi-minor axis and iteration limits of the vincenty formula
+AXIS_B = 6356752.314245
+MAX_ITERATIONS = 200
+CONVERGENCE_THRESHOLD = 1e-12
+
+# shortest length (metres) of a degree of latitude and longest length of a
+# degree of longitude, bounding the grid cells a range can span
+LATITUDE_DEGREE = pi * AXIS_A * (1 - ECCENTRICITY_SQ) / 180
+LONGITUDE_DEGREE = pi * AXIS_A / 180
+# safety margin applied to the range covered by the zone grid
+GRID_MARGIN = 1.1
+
+# snapshot of the entities of the zones with persist set and the last
+# device positions, read once at setup and written shortly after a change
+# so the entities come back warm after a restart
+SNAPSHOT_FILE = '.proximity_zones.json'
+
+# cached position of a zone or device and the values derived from it,
+# including its unit vector (x, y, z) from the centre of the earth
+Position = namedtuple('Position', [
+    'latitude', 'longitude', 'lat_radians', 'lon_radians', 'sin_lat',
+    'cos_lat', 'x', 'y', 'z'])
+
+# options accepted for each zone in configuration.yaml
+CONF_ZONE_KEYS = frozenset([
+    'zone', 'devices', 'ignored_zones', 'tolerance', 'refresh_interval',
+    'distance_backend', 'coalesce_window', 'log_sample_rate',
+    'log_rate_limit', 'persist', 'top_k', 'max_range', 'trend_window',
+    'throttle_interval', 'throttle_delta', 'shadow_sample_rate',
+    'diagnostics'])
+
+# validated configuration of one zone, compiled once at setup
+ZonePlan = namedtuple('ZonePlan', [
+    'name', 'entity_id', 'zone', 'devices', 'ignored_zones', 'tolerance',
+    'refresh_interval', 'distance_backend', 'coalesce_window',
+    'log_sample_rate', 'log_rate_limit', 'persist', 'top_k', 'max_range',
+    'trend_window', 'throttle_interval', 'throttle_delta',
+    'shadow_sample_rate', 'diagnostics'])
 
 # Shortcut for the logger
 _LOGGER = logging.getLogger(__name__)
 
-def setup(hass, config):  # pylint: disable=too-many-locals,too-many-statements
-    """ get the zones and offsets from configuration.yaml"""
- 
-    # stop if no zones are specified
-    if 'zone' not in config[DOMAIN]:
-        _LOGGER.error('zones not found in config')
+def setup(hass, config):
+    """ Set up the proximity zones from a worker thread.
+
+    Compatibility shim for cores without async_setup: callbacks run in the
+    worker pool and write the entities with update_ha_state.
+    """
+    zone_plans = compile_plan(config.get(DOMAIN))
+    if zone_plans is None:
         return False
+    snapshot_zones = {}
+    if any(zone_plan.persist for zone_plan in zone_plans):
+        snapshot_zones = load_snapshot(hass.config.path(SNAPSHOT_FILE))
+    return setup_proximity_zones(hass, zone_plans, snapshot_zones,
+                                 run_on_loop=False)
+
+@coroutine
+def async_setup(hass, config):
+    """ Set up the proximity zones on the event loop.
+
+    Callbacks run directly on the loop and write the entities with
+    async_update_ha_state, so tracker updates never hop threads. The
+    snapshot is read in the executor before the entities are built.
+    """
+    zone_plans = compile_plan(config.get(DOMAIN))
+    if zone_plans is None:
+        return False
+    snapshot_zones = {}
+    if any(zone_plan.persist for zone_plan in zone_plans):
+        snapshot_zones = yield from hass.loop.run_in_executor(
+            None, load_snapshot, hass.config.path(SNAPSHOT_FILE))
+    return setup_proximity_zones(hass, zone_plans, snapshot_zones,
+                                 run_on_loop=True)
+
+def setup_proximity_zones(hass, zone_plans, snapshot_zones, run_on_loop):
+    # pylint: disable=too-many-locals,too-many-statements
+    """ get the zones and offsets from configuration.yaml"""
+
+    # index of device -> proximity entities tracking that device, used to
+    # route each state change only to the zones interested in it
+    device_zones = {}
+    proximities = []
+    # the zones with a diagnostics entity
+    diagnosed = []
+    movement_filter = MovementFilter()
+
+    # the synchronous setup receives the state changes (and timers) on the
+    # worker pool, so the evaluations that update the caches shared by the
+    # zones take turns; on the event loop the lock is never contended
+    lock = threading.RLock()
 
-    # mater list to record zones, devices & ignore zones
-    proximity_list = []
-    
-    # setup a master device list
-    master_device_list = []
-    
     # for each zone in the config file
-    for zone in config[DOMAIN]['zone']:
-
-        # setup empty lists to store config variables in
-        devices[]
-        ignored_zones[]
-        tolerance[]
-        
-        # create the config lists (need to think about error checking)
-        for variable in config[DOMAIN][zone]['devices']:
-            devices.append(variable)
-            master_device_list.append(variable)
-        for variable config[DOMAIN][zone]['ignored_zones']:
-            ignored_zones.append(variable)
-        for variable config[DOMAIN][zone]['tolerance']:
-            tolerance.append(variable)
-
-        # create the master list of lists
-        proximity_list.append([zone, devices, ignored_zones, tolerance])
-
-        # for loop to iterate through the master list of list
-        # use index values to make recall of values easier
-        for zone_entry in range(len(proximity_list)):
-            _LOGGER.debug('%s: getting proximity zone config',
-                          device_list[zone_entry][0])
-            proximity_zone = device_list[zone_entry][0]
-            
-            # the devices to be tracked
-            for device in device_list[zone_entry][1]:
-                print("device: " + device)
-                _LOGGER.debug('%s: device added: %s',
-                              device_list[zone_entry][0], device)
-
-            # recall the ignore zones
-            for ignore in device_list[zone_entry][2]:
-                print("ignore: " + ignore)
-                _LOGGER.debug('%s: ignore zone added: %s',
-                              device_list[zone_entry][0], ignore)
-
-            # recall the tolerance
-            for tolerance in device_list[zone_entry][3]:
-                print("tolerance: " + ignore)
-                _LOGGER.debug('%s: tolerance added: %s',
-                              device_list[zone_entry][0], tolerance)
-        
-            entity_id = DOMAIN + '.' + proximity_zone
-            proximity_zone = 'zone.' + proximity_zone
-
-            state = hass.states.get(proximity_zone)
-            zone_friendly_name = (state.name).lower()
-
-            # set the default values
-            dist_to_zone = 'not set'
-            dir_of_travel = 'not set'
-            nearest = 'not set'
-
-            proximity = Proximity(hass, zone_friendly_name, dist_to_zone,
-                                  dir_of_travel, nearest, ignored_zones,
-                                  proximity_devices, tolerance, proximity_zone)
-            proximity.entity_id = entity_id
-
-            proximity.update_ha_state()
+    for zone_plan in zone_plans:
+        state = hass.states.get(zone_plan.zone)
+        if state is None:
+            _LOGGER.error('%s: zone not found', zone_plan.zone)
+            continue
+
+        proximity = Proximity(hass, zone_plan, (state.name).lower())
+        proximity.entity_id = zone_plan.entity_id
+        proximity.run_on_loop = run_on_loop
+        proximity.lock = lock
+        proximity.publisher.entity_id = zone_plan.entity_id
+        proximity.publisher.run_on_loop = run_on_loop
+        proximity.publisher.lock = lock
+
+        proximity.diagnostics.entity_id = zone_plan.entity_id + \
+            '_diagnostics'
+        proximity.diagnostics.run_on_loop = run_on_loop
+        proximities.append(proximity)
+        if zone_plan.diagnostics:
+            diagnosed.append(proximity)
+
+        for device in zone_plan.devices:
+            device_zones.setdefault(device, []).append(proximity)
+            movement_filter.add_device(device, zone_plan.tolerance)
+
+    if not device_zones:
+        _LOGGER.error('no proximity zones could be set up')
+        return False
+
+    # with numpy available the zone x device distances are filled in bulk
+    # in a matrix, at setup and for update_devices batches; single updates
+    # are cheaper measured one at a time, so they only invalidate the
+    # device's column
+    device_states = {device: hass.states.get(device)
+                     for device in device_zones}
+    for device, device_state in device_states.items():
+        movement_filter.processed(device, device_state)
+    matrix = None
+    if np is not None:
+        matrix = DistanceMatrix(hass, proximities, list(device_zones))
+        matrix.update_devices(device_states)
+
+    # the zones that are persisted share one snapshot file
+    persisted = [proximity for proximity in proximities
+                 if proximity.plan.persist]
+    snapshot = None
+    if persisted:
+        snapshot = SnapshotStore(
+            hass, hass.config.path(SNAPSHOT_FILE),
+            lambda: {proximity.entity_id: proximity.snapshot_state()
+                     for proximity in persisted}, run_on_loop)
+
+    # the device positions are shared by all the zones
+    device_positions = PositionCache()
+    for proximity in proximities:
+        proximity.device_positions = device_positions
+
+    # the zones with a max_range are filed in a grid by their centre
+    ranges = [proximity.max_range for proximity in proximities
+              if proximity.max_range is not None]
+    zone_grid = None
+    if ranges:
+        zone_grid = ZoneGrid(max(ranges))
+        for proximity in proximities:
+            if proximity.max_range is not None:
+                zone_grid.move(proximity.entity_id,
+                               hass.states.get(proximity.proximity_zone))
+                proximity.zone_grid = zone_grid
+
+    # cache each zone's position, prime its distance cache with the
+    # current device states and bring back any snapshot of the zone; the
+    # entity starts from the primed states rather than waiting for an
+    # update that the filter may drop
+    zone_proximities = {}
+    for proximity in proximities:
+        proximity.distance_matrix = matrix
+        proximity.set_zone(hass.states.get(proximity.proximity_zone),
+                           device_states)
+        kept = None
+        if proximity.plan.persist:
+            proximity.snapshot = snapshot
+            kept = proximity.restore(snapshot_zones.get(proximity.entity_id))
+        proximity.settle(kept)
+        proximity.publish()
+        # the entity is re-written from a timer of its own, as a stationary
+        # device may send nothing but updates the filter drops
+        proximity.publisher.start()
+        zone_proximities.setdefault(proximity.proximity_zone,
+                                    []).append(proximity)
+
+    # the (state, latitude, longitude) of each write of the update_devices
+    # service to a device, in order: the state changes of its writes reach
+    # the listeners too, after it has evaluated them itself
+    echoes = {}
+
+    def count_event(entity):
+        """ Count a device update against the zones tracking the device,
+        before the movement filter can drop it. """
+        for proximity in device_zones.get(entity, ()):
+            proximity.diagnostics.events += 1
+
+    def count_skipped(entity):
+        """ Count an update the movement filter dropped against the zones
+        tracking the device. """
+        for proximity in device_zones.get(entity, ()):
+            proximity.diagnostics.skipped += 1
+            proximity.log_limiter.logger_for(entity).debug(
+                '%s: update of %s skipped, %s skipped so far',
+                proximity.entity_id, entity, proximity.diagnostics.skipped)
+
+    def dispatch_state_change(entity, old_state, new_state):
+        """ Pass a device state change to the zones tracking the device. """
+        with lock:
+            expected = echoes.get(entity)
+            if expected and new_state is not None and expected[0] == (
+                    new_state.state, new_state.attributes.get('latitude'),
+                    new_state.attributes.get('longitude')):
+                del expected[0]
+                if not expected:
+                    del echoes[entity]
+                return
+            count_event(entity)
+            if not movement_filter.should_process(entity, new_state):
+                count_skipped(entity)
+                return
+            if matrix is not None:
+                matrix.invalidate_device(entity)
+            for proximity in device_zones.get(entity, ()):
+                proximity.check_proximity_state_change(entity, old_state,
+                                                       new_state)
+
+    def dispatch_state_changes(changes):
+        """ Pass a batch of device state changes to the zones tracking the
+        devices, evaluating each zone once. """
+        # collapse the changes of each device to its first old state and
+        # latest new state
+        latest = OrderedDict()
+        for entity, old_state, new_state in changes:
+            count_event(entity)
+            if entity in latest:
+                old_state = latest[entity][1]
+            latest[entity] = (entity, old_state, new_state)
+
+        moved = OrderedDict()
+        zone_changes = OrderedDict()
+        for entity, old_state, new_state in latest.values():
+            if not movement_filter.should_process(entity, new_state):
+                count_skipped(entity)
+                continue
+            moved[entity] = new_state
+            for proximity in device_zones[entity]:
+                zone_changes.setdefault(proximity.entity_id, (
+                    proximity, []))[1].append((entity, old_state, new_state))
+
+        # a burst of devices is measured in one numpy call
+        if matrix is not None and len(moved) > 1:
+            matrix.update_devices(moved)
+        elif matrix is not None:
+            for entity in moved:
+                matrix.invalidate_device(entity)
+
+        for proximity, zone_batch in zone_changes.values():
+            if proximity.coalesce_window:
+                for entity, old_state, new_state in zone_batch:
+                    proximity.check_proximity_state_change(
+                        entity, old_state, new_state)
+            else:
+                proximity.check_proximity_state_changes(zone_batch)
+
+    def update_devices(call):
+        """ Write the states of a batch of device positions and evaluate
+        the zones tracking them once. """
+        if run_on_loop:
+            set_state = hass.states.async_set
+        else:
+            set_state = hass.states.set
+        changes = []
+        for update in call.data.get(ATTR_UPDATES) or ():
+            entity = update.get(ATTR_ENTITY_ID) \
+                if isinstance(update, dict) else None
+            if entity not in device_zones:
+                _LOGGER.error('%s: not a proximity device, update ignored',
+                              entity)
+                continue
+            try:
+                latitude = float(update['latitude'])
+                longitude = float(update['longitude'])
+            except (KeyError, TypeError, ValueError):
+                _LOGGER.error('%s: update without a valid position ignored',
+                              entity)
+                continue
+            # the zone the device is in moves with it, so it is not kept
+            if update.get('state') is None:
+                _LOGGER.error('%s: update without a state ignored', entity)
+                continue
+            state = str(update['state'])
+
+            old_state = hass.states.get(entity)
+            attributes = {}
+            if old_state is not None:
+                attributes.update(old_state.attributes)
+            attributes.update(
+                (key, value) for key, value in update.items()
+                if key not in (ATTR_ENTITY_ID, 'state'))
+            attributes['latitude'] = latitude
+            attributes['longitude'] = longitude
+            # a write that changes nothing fires no state change
+            if old_state is None or old_state.state != state or \
+                    old_state.attributes != attributes:
+                with lock:
+                    echoes.setdefault(entity, []).append(
+                        (state, latitude, longitude))
+            set_state(entity, state, attributes)
+            changes.append((entity, old_state, hass.states.get(entity)))
+        with lock:
+            dispatch_state_changes(changes)
+
+    def zone_state_change(entity, old_state, new_state):
+        """ Refresh the cached position of a zone that has been edited. """
+        if new_state is None or 'latitude' not in new_state.attributes:
+            return
+        if old_state is not None and \
+                old_state.attributes.get('latitude') == \
+                new_state.attributes['latitude'] and \
+                old_state.attributes.get('longitude') == \
+                new_state.attributes.get('longitude'):
+            return
+        _LOGGER.info('%s: zone moved, recalculating distances', entity)
+        with lock:
+            if matrix is not None:
+                matrix.set_zone(entity, new_state)
+            for proximity in zone_proximities[entity]:
+                if proximity.zone_grid is not None:
+                    proximity.zone_grid.move(proximity.entity_id, new_state)
+            zone_device_states = {}
+            for proximity in zone_proximities[entity]:
+                for device in proximity.proximity_devices:
+                    if device not in zone_device_states:
+                        zone_device_states[device] = hass.states.get(device)
+                        proximity.diagnostics.state_reads += 1
+                proximity.move_zone(new_state, zone_device_states)
+
+    def publish_diagnostics(now=None):
+        """ Write the diagnostics entities and schedule the next write. """
+        for proximity in diagnosed:
+            proximity.diagnostics.publish()
+        point_in_time = dt_util.utcnow() + \
+            timedelta(seconds=DIAGNOSTICS_INTERVAL)
+        if run_on_loop:
+            async_track_point_in_utc_time(hass, publish_diagnostics,
+                                          point_in_time)
+        else:
+            track_point_in_utc_time(hass, publish_diagnostics, point_in_time)
+
+    if run_on_loop:
+        publish_diagnostics = callback(publish_diagnostics)
+    if diagnosed:
+        publish_diagnostics()
 
     # main command to monitor proximity of devices
-    track_state_change(hass, master_device_list,
-                       proximity.check_proximity_state_change)
+    if run_on_loop:
+        async_track_state_change(hass, list(device_zones),
+                                 callback(dispatch_state_change))
+        async_track_state_change(hass, list(zone_proximities),
+                                 callback(zone_state_change))
+    else:
+        track_state_change(hass, list(device_zones), dispatch_state_change)
+        track_state_change(hass, list(zone_proximities), zone_state_change)
+
+    # the batch service runs where the state change callbacks run
+    if run_on_loop:
+        hass.services.async_register(DOMAIN, SERVICE_UPDATE_DEVICES,
+                                     callback(update_devices))
+    else:
+        hass.services.register(DOMAIN, SERVICE_UPDATE_DEVICES,
+                               update_devices)
 
     # Tells the bootstrapper that the component was successfully initialized
     return True
 
-#******************** UPDATES MADE UP TO HERE ***********************
+def compile_plan(zone_configs):
+    """ Compile the proximity_zones configuration into ZonePlans, None if
+    no zones are specified. """
+    if not zone_configs:
+        _LOGGER.error('zones not found in config')
+        return None
+    zone_plans = (compile_zone_plan(zone_config)
+                  for zone_config in zone_configs)
+    return tuple(zone_plan for zone_plan in zone_plans
+                 if zone_plan is not None)
+
+def compile_zone_plan(zone_config):
+    """ Validate the configuration of one zone, None if it is unusable. """
+    if not isinstance(zone_config, dict):
+        _LOGGER.error('zone configuration must be a mapping: %s',
+                      zone_config)
+        return None
+    name = str(zone_config.get('zone', DEFAULT_PROXIMITY_ZONE))
+    _LOGGER.debug('%s: getting proximity zone config', name)
+    for key in sorted(set(zone_config) - CONF_ZONE_KEYS):
+        _LOGGER.error('%s: unknown option %s ignored', name, key)
+
+    # the devices to be tracked, each once and in the configured order
+    devices = zone_config.get('devices')
+    if not devices:
+        _LOGGER.error('%s: devices not found in config', name)
+        return None
+    if isinstance(devices, str):
+        devices = [devices]
+    devices = tuple(OrderedDict.fromkeys(str(device) for device in devices))
+    _LOGGER.debug('%s: devices added: %s', name, ', '.join(devices))
+
+    # recall the ignore zones
+    ignored_zones = zone_config.get('ignored_zones') or ()
+    if isinstance(ignored_zones, str):
+        ignored_zones = [ignored_zones]
+    ignored_zones = frozenset(str(ignore) for ignore in ignored_zones)
+    _LOGGER.debug('%s: ignore zones: %s', name, ', '.join(ignored_zones))
+
+    # recall the distance backend
+    distance_backend = zone_config.get('distance_backend',
+                                       DEFAULT_DISTANCE_BACKEND)
+    if distance_backend != BACKEND_EXACT and \
+            distance_backend not in DISTANCE_BACKENDS:
+        _LOGGER.error('%s: unknown distance backend %s, using %s', name,
+                      distance_backend, BACKEND_EXACT)
+        distance_backend = BACKEND_EXACT
+
+    zone_plan = ZonePlan(
+        name=name,
+        entity_id=DOMAIN + '.' + name,
+        zone='zone.' + name,
+        devices=devices,
+        ignored_zones=ignored_zones,
+        tolerance=config_number(name, zone_config, 'tolerance',
+                                DEFAULT_TOLERANCE),
+        # optional forced refresh interval (seconds)
+        refresh_interval=config_number(name, zone_config,
+                                       'refresh_interval'),
+        distance_backend=distance_backend,
+        # optional window (seconds) in which bursts of updates are
+        # collapsed into a single evaluation
+        coalesce_window=config_number(name, zone_config, 'coalesce_window'),
+        log_sample_rate=int(config_number(name, zone_config,
+                                          'log_sample_rate',
+                                          DEFAULT_LOG_SAMPLE_RATE)),
+        log_rate_limit=config_number(name, zone_config, 'log_rate_limit',
+                                     DEFAULT_LOG_RATE_LIMIT),
+        # keep the entity and device positions across restarts
+        persist=bool(zone_config.get('persist', False)),
+        # optional number of nearest devices published as an attribute
+        top_k=int(config_number(name, zone_config, 'top_k', 0)),
+        # optional range (km) beyond which devices are not measured
+        max_range=config_number(name, zone_config, 'max_range'),
+        # number of recent distances the direction of travel follows
+        trend_window=int(config_number(name, zone_config, 'trend_window',
+                                       DEFAULT_TREND_WINDOW)),
+        # optional throttle of distance changes: seconds per km since the
+        # last write, and change as a fraction of the distance
+        throttle_interval=config_number(name, zone_config,
+                                        'throttle_interval'),
+        throttle_delta=config_number(name, zone_config, 'throttle_delta'),
+        # optional check of every Nth evaluation against the full scan
+        shadow_sample_rate=int(config_number(name, zone_config,
+                                             'shadow_sample_rate', 0)),
+        # the diagnostics entity and the latency of each evaluation
+        diagnostics=bool(zone_config.get('diagnostics', True)))
+    _LOGGER.debug('%s: tolerance set to: %s', name, zone_plan.tolerance)
+    return zone_plan
+
+def config_number(name, zone_config, key, default=None):
+    """ A non-negative number option of a zone, else its default. """
+    value = zone_config.get(key, default)
+    if value is None or (isinstance(value, (int, float)) and
+                         not isinstance(value, bool) and value >= 0):
+        return value
+    _LOGGER.error('%s: %s must be a non-negative number, using %s', name,
+                  key, default)
+    return default
+
+def position(latitude, longitude):
+    """ Build the cached position of a latitude and longitude. """
+    lat_radians = radians(latitude)
+    lon_radians = radians(longitude)
+    sin_lat = sin(lat_radians)
+    cos_lat = cos(lat_radians)
+    return Position(latitude, longitude, lat_radians, lon_radians, sin_lat,
+                    cos_lat, cos_lat * cos(lon_radians),
+                    cos_lat * sin(lon_radians), sin_lat)
+
+def zone_position(zone_state):
+    """ Build the cached position of a zone from its state. """
+    return position(zone_state.attributes.get('latitude'),
+                    zone_state.attributes.get('longitude'))
+
+def haversine_distance(zone, device):
+    """ Spherical distance in metres between two positions and its error
+    bound, from the chord between their unit vectors. """
+    chord = sqrt((zone.x - device.x) ** 2 + (zone.y - device.y) ** 2 +
+                 (zone.z - device.z) ** 2)
+    metres = 2 * EARTH_RADIUS * asin(min(chord / 2, 1))
+    return metres, metres * HAVERSINE_ERROR + DISTANCE_ERROR_FLOOR
+
+def equirectangular_distance(zone, device):
+    """ Locally flat ellipsoidal distance in metres and its error bound.
+
+    The ellipsoid's radii of curvature at the mean latitude scale the
+    latitude and longitude differences, which is accurate to a few metres
+    over tens of kilometres.
+    """
+    mean_lat = (zone.lat_radians + device.lat_radians) / 2
+    sin_mean = sin(mean_lat)
+    curvature = 1 - ECCENTRICITY_SQ * sin_mean ** 2
+    prime_vertical = AXIS_A / sqrt(curvature)
+    meridional = prime_vertical * (1 - ECCENTRICITY_SQ) / curvature
+    lon_diff = (device.longitude - zone.longitude + 180) % 360 - 180
+    metres = hypot(radians(lon_diff) * prime_vertical * cos(mean_lat),
+                   (device.lat_radians - zone.lat_radians) * meridional)
+
+    if abs(device.latitude) > EQUIRECTANGULAR_MAX_LATITUDE or \
+            abs(zone.latitude) > EQUIRECTANGULAR_MAX_LATITUDE:
+        return metres, float('inf')
+    ratio = metres / EARTH_RADIUS
+    return metres, metres * (EQUIRECTANGULAR_ERROR + 2 * ratio ** 2) + \
+        DISTANCE_ERROR_FLOOR
+
+DISTANCE_BACKENDS = {
+    BACKEND_HAVERSINE: haversine_distance,
+    BACKEND_EQUIRECTANGULAR: equirectangular_distance,
+}
+
+def diverges(expected, decided):
+    """ True if decided entity values differ from the expected ones,
+    ignoring the expected values that are None. """
+    for value, actual in zip(expected, decided):
+        if value is None or value == actual:
+            continue
+        # the devices in the zone may be listed in any order
+        if expected[1] == 'arrived' and isinstance(actual, str) and \
+                sorted(actual.split(', ')) == sorted(value.split(', ')):
+            continue
+        return True
+    return False
+
+def vincenty_matrix(lat1, lon1, lat2, lon2):
+    # pylint: disable=too-many-locals
+    """ Vectorised homeassistant.util.location.distance.
+
+    Takes arrays of latitudes/longitudes in degrees that broadcast against
+    each other and returns the distances in metres. Entries where the
+    formula does not converge are NaN.
+    """
+    lat1, lon1, lat2, lon2 = np.broadcast_arrays(
+        np.asarray(lat1, dtype=float), np.asarray(lon1, dtype=float),
+        np.asarray(lat2, dtype=float), np.asarray(lon2, dtype=float))
+
+    u_1 = np.arctan((1 - FLATTENING) * np.tan(np.radians(lat1)))
+    u_2 = np.arctan((1 - FLATTENING) * np.tan(np.radians(lat2)))
+    sin_u1, cos_u1 = np.sin(u_1), np.cos(u_1)
+    sin_u2, cos_u2 = np.sin(u_2), np.cos(u_2)
+    lon_diff = np.radians(lon2 - lon1)
+
+    lambda_ = lon_diff.copy()
+    sin_sigma = np.zeros(lat1.shape)
+    cos_sigma = np.ones(lat1.shape)
+    sigma = np.zeros(lat1.shape)
+    cos_sq_alpha = np.ones(lat1.shape)
+    cos2_sigma_m = np.zeros(lat1.shape)
+    # coincident points are 0 metres apart and need no iteration
+    active = ~((lat1 == lat2) & (lon1 == lon2))
+    converged = ~active
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for _ in range(MAX_ITERATIONS):
+            if not active.any():
+                break
+            sin_lambda = np.sin(lambda_[active])
+            cos_lambda = np.cos(lambda_[active])
+            su1, cu1 = sin_u1[active], cos_u1[active]
+            su2, cu2 = sin_u2[active], cos_u2[active]
+
+            s_sigma = np.sqrt((cu2 * sin_lambda) ** 2 +
+                              (cu1 * su2 - su1 * cu2 * cos_lambda) ** 2)
+            c_sigma = su1 * su2 + cu1 * cu2 * cos_lambda
+            sig = np.arctan2(s_sigma, c_sigma)
+            sin_alpha = cu1 * cu2 * sin_lambda / s_sigma
+            c_sq_alpha = 1 - sin_alpha ** 2
+            c2_sigma_m = np.where(c_sq_alpha != 0,
+                                  c_sigma - 2 * su1 * su2 / c_sq_alpha, 0)
+            c_term = FLATTENING / 16 * c_sq_alpha * (
+                4 + FLATTENING * (4 - 3 * c_sq_alpha))
+            lambda_prev = lambda_[active]
+            lambda_new = lon_diff[active] + (1 - c_term) * FLATTENING * \
+                sin_alpha * (sig + c_term * s_sigma * (
+                    c2_sigma_m + c_term * c_sigma *
+                    (-1 + 2 * c2_sigma_m ** 2)))
+
+            sin_sigma[active] = s_sigma
+            cos_sigma[active] = c_sigma
+            sigma[active] = sig
+            cos_sq_alpha[active] = c_sq_alpha
+            cos2_sigma_m[active] = c2_sigma_m
+            lambda_[active] = lambda_new
+
+            # points on top of each other along the same meridian
+            done = (s_sigma == 0) | \
+                (np.abs(lambda_new - lambda_prev) < CONVERGENCE_THRESHOLD)
+            index = np.flatnonzero(active)[done]
+            converged.flat[index] = True
+            active.flat[index] = False
+
+        u_sq = cos_sq_alpha * (AXIS_A ** 2 - AXIS_B ** 2) / (AXIS_B ** 2)
+        a_term = 1 + u_sq / 16384 * (
+            4096 + u_sq * (-768 + u_sq * (320 - 175 * u_sq)))
+        b_term = u_sq / 1024 * (256 + u_sq * (-128 + u_sq * (74 - 47 * u_sq)))
+        delta_sigma = b_term * sin_sigma * (
+            cos2_sigma_m + b_term / 4 * (
+                cos_sigma * (-1 + 2 * cos2_sigma_m ** 2) -
+                b_term / 6 * cos2_sigma_m * (-3 + 4 * sin_sigma ** 2) *
+                (-3 + 4 * cos2_sigma_m ** 2)))
+        metres = AXIS_B * a_term * (sigma - delta_sigma)
+
+    metres = np.where(sin_sigma == 0, 0.0, metres)
+    # match the km precision returned by homeassistant's vincenty
+    metres = np.round(metres / 1000, 6) * 1000
+    return np.where(converged, metres, np.nan)
+
+
+class DistanceMatrix(object):
+    """ Bulk-filled distances from every proximity zone to the devices.
+
+    Zone and device coordinates are held in contiguous float arrays so the
+    whole matrix, or the columns of a burst of devices that changed, is
+    recalculated in a single numpy call. It only fills distances: the
+    zones with the exact backend read their devices' distances from it at
+    setup and after an update_devices batch, and pick the nearest device
+    from their own sorted index. A single update leaves the device's
+    column unknown, and the zone measures the device itself.
+    """
+    def __init__(self, hass, proximities, devices):
+        self.zones = []
+        for proximity in proximities:
+            if proximity.proximity_zone not in self.zones:
+                self.zones.append(proximity.proximity_zone)
+        self.devices = list(devices)
+        self._zone_rows = {zone: row for row, zone in enumerate(self.zones)}
+        self._device_cols = {device: col for col, device
+                             in enumerate(self.devices)}
+
+        self.zone_latitudes = np.full(len(self.zones), np.nan)
+        self.zone_longitudes = np.full(len(self.zones), np.nan)
+        self.device_latitudes = np.full(len(self.devices), np.nan)
+        self.device_longitudes = np.full(len(self.devices), np.nan)
+        self.matrix = np.full((len(self.zones), len(self.devices)), np.nan)
+
+        for zone in self.zones:
+            self.set_zone(zone, hass.states.get(zone))
+
+    def set_zone(self, zone, zone_state):
+        """ Store the position of a zone and recalculate its row. """
+        row = self._zone_rows[zone]
+        self.zone_latitudes[row] = zone_state.attributes.get('latitude')
+        self.zone_longitudes[row] = zone_state.attributes.get('longitude')
+        # only the devices last updated in bulk have a position here
+        cols = np.flatnonzero(~np.isnan(self.device_latitudes))
+        self.matrix[row] = np.nan
+        self.matrix[row, cols] = vincenty_matrix(
+            self.zone_latitudes[row], self.zone_longitudes[row],
+            self.device_latitudes[cols], self.device_longitudes[cols])
+
+    def update_devices(self, device_states):
+        """ Store new device positions and recalculate their columns. """
+        cols = []
+        for device, device_state in device_states.items():
+            col = self._device_cols[device]
+            cols.append(col)
+            if device_state is None or \
+                    'latitude' not in device_state.attributes:
+                self.device_latitudes[col] = np.nan
+                self.device_longitudes[col] = np.nan
+            else:
+                self.device_latitudes[col] = \
+                    device_state.attributes['latitude']
+                self.device_longitudes[col] = \
+                    device_state.attributes['longitude']
+
+        self.matrix[:, cols] = vincenty_matrix(
+            self.zone_latitudes[:, None], self.zone_longitudes[:, None],
+            self.device_latitudes[cols], self.device_longitudes[cols])
+
+    def invalidate_device(self, device):
+        """ Forget a device's position until it is next updated in bulk.
+
+        A numpy call costs far more than a few scalar distances, so single
+        tracker updates are measured by the zones themselves.
+        """
+        col = self._device_cols[device]
+        self.device_latitudes[col] = np.nan
+        self.device_longitudes[col] = np.nan
+        self.matrix[:, col] = np.nan
+
+    def distance(self, zone, device):
+        """ Distance in metres from a zone to a device, None if unknown. """
+        value = self.matrix[self._zone_rows[zone], self._device_cols[device]]
+        if np.isnan(value):
+            return None
+        return float(value)
+
+
+class PositionCache(object):
+    """ The Position of each device's latest co-ordinates.
+
+    Shared by the zones so the trigonometry of a device update is done
+    once, however many zones track the device.
+    """
+    def __init__(self):
+        self.positions = {}
+
+    def get(self, device, latitude, longitude):
+        """ The Position of a device at the co-ordinates. """
+        cached = self.positions.get(device)
+        if cached is None or cached.latitude != latitude or \
+                cached.longitude != longitude:
+            cached = self.positions[device] = position(latitude, longitude)
+        return cached
+
+
+class ZoneGrid(object):
+    """ Grid over the centres of the zones with a max_range.
+
+    Cells are as tall as the largest range, so a zone within range of a
+    position is in the position's row or one of its neighbours, and as
+    many columns either side as the range spans at that latitude. The
+    last lookup is kept, as every zone of a device asks for the same one.
+    """
+    def __init__(self, max_range):
+        # max_range in metres
+        self.range = max_range * GRID_MARGIN
+        self.cell = self.range / LATITUDE_DEGREE
+        self.columns = max(1, int(ceil(360 / self.cell)))
+        self.cells = {}
+        self.zone_cells = {}
+        self._last = (None, None, frozenset())
+
+    def cell_of(self, latitude, longitude):
+        """ The (row, column) of the cell holding a position. """
+        return (int(floor(latitude / self.cell)),
+                int(floor((longitude + 180) / self.cell)) % self.columns)
+
+    def move(self, entity_id, zone_state):
+        """ File a proximity entity in the cell of its zone's centre. """
+        old_cell = self.zone_cells.pop(entity_id, None)
+        if old_cell is not None:
+            self.cells[old_cell].discard(entity_id)
+        latitude = zone_state.attributes.get('latitude')
+        longitude = zone_state.attributes.get('longitude')
+        if latitude is not None and longitude is not None:
+            cell = self.cell_of(latitude, longitude)
+            self.cells.setdefault(cell, set()).add(entity_id)
+            self.zone_cells[entity_id] = cell
+        self._last = (None, None, frozenset())
+
+    def near(self, latitude, longitude):
+        """ The proximity entities whose zone may be within range of a
+        position. """
+        last_latitude, last_longitude, near = self._last
+        if latitude == last_latitude and longitude == last_longitude:
+            return near
+
+        row, column = self.cell_of(latitude, longitude)
+        # a degree of longitude shortens towards the poles
+        furthest = abs(latitude) + self.cell
+        if furthest >= 90:
+            spread = self.columns
+        else:
+            spread = int(ceil(self.range / (LONGITUDE_DEGREE *
+                                            cos(radians(furthest)) *
+                                            self.cell)))
+        if 2 * spread + 1 >= self.columns:
+            columns = range(self.columns)
+        else:
+            columns = [(column + offset) % self.columns
+                       for offset in range(-spread, spread + 1)]
+        near = set()
+        for near_row in (row - 1, row, row + 1):
+            for near_column in columns:
+                near.update(self.cells.get((near_row, near_column), ()))
+        self._last = (latitude, longitude, near)
+        return near
+
+
+class FilteredDevice(object):
+    """ Last evaluated state and position of a device in the filter. """
+    __slots__ = ('tolerance', 'seen', 'state', 'latitude', 'longitude')
+
+    def __init__(self, tolerance):
+        self.tolerance = tolerance
+        self.seen = False
+        self.state = None
+        self.latitude = None
+        self.longitude = None
+
+
+class MovementFilter(object):
+    """ Drops tracker updates that do not need evaluating.
+
+    An update is dropped when the device's state is unchanged and it has
+    moved less than the smallest tolerance of the zones tracking it since
+    the last update that was processed, e.g. a battery or GPS accuracy
+    change or a few metres of GPS drift.
+    """
+    def __init__(self):
+        self.devices = {}
+        self.skipped = 0
+
+    def add_device(self, device, tolerance):
+        """ Track a device, keeping the smallest tolerance of its zones. """
+        track = self.devices.get(device)
+        if track is None:
+            self.devices[device] = FilteredDevice(tolerance)
+        else:
+            track.tolerance = min(tolerance, track.tolerance)
+
+    def processed(self, device, device_state):
+        """ Record the state of a device that has been evaluated. """
+        track = self.devices[device]
+        if device_state is None:
+            track.seen = False
+            return
+        track.seen = True
+        track.state = device_state.state
+        track.latitude = device_state.attributes.get('latitude')
+        track.longitude = device_state.attributes.get('longitude')
+
+    def should_process(self, device, new_state):
+        """ True if the update must be evaluated, else count it skipped. """
+        track = self.devices[device]
+        if not track.seen or new_state is None or \
+                new_state.state != track.state:
+            self.processed(device, new_state)
+            return True
+
+        latitude = new_state.attributes.get('latitude')
+        longitude = new_state.attributes.get('longitude')
+        if latitude != track.latitude or longitude != track.longitude:
+            if latitude is None or track.latitude is None or \
+                    displacement(track.latitude, track.longitude, latitude,
+                                 longitude) >= track.tolerance:
+                self.processed(device, new_state)
+                return True
+
+        self.skipped += 1
+        return False
+
 
 class Proximity(Entity):  # pylint: disable=too-many-instance-attributes
     """ Represents a Proximity in Home Assistant. """
-    def __init__(self, hass, zone_friendly_name, dist_to, dir_of_travel,
-                 nearest, ignored_zones, proximity_devices, tolerance,
-                 proximity_zone):
-        # pylint: disable=too-many-arguments
+    def __init__(self, hass, plan, zone_friendly_name):
         self.hass = hass
+        self.plan = plan
+        # lower case, as the device states are compared against it
         self.friendly_name = zone_friendly_name
-        self.dist_to = dist_to
-        self.dir_of_travel = dir_of_travel
-        self.nearest = nearest
-        self.ignored_zones = ignored_zones
-        self.proximity_devices = proximity_devices
-        self.tolerance = tolerance
-        self.proximity_zone = proximity_zone
+        self.dist_to = 'not set'
+        self.dir_of_travel = 'not set'
+        self.nearest = 'not set'
+        self.ignored_zones = plan.ignored_zones
+        self.proximity_devices = plan.devices
+        self.tolerance = plan.tolerance
+        self.proximity_zone = plan.zone
+        self.distance_backend = DISTANCE_BACKENDS.get(plan.distance_backend)
+        self.coalesce_window = plan.coalesce_window
+        self.top_k = plan.top_k
+        self.max_range = None
+        if plan.max_range is not None:
+            self.max_range = plan.max_range * 1000
+
+        # device updates waiting for the end of the coalescing window
+        self._pending = {}
+        self._flush_scheduled = False
+
+        # held while the zone is evaluated, shared by all the zones at setup
+        self.lock = threading.RLock()
+
+        # set when the entity is driven from the event loop by async_setup
+        self.run_on_loop = False
+
+        # hot path counters, published as their own entity
+        self.diagnostics = ProximityDiagnostics(hass, zone_friendly_name)
+
+        # sampling and rate limiting of the per-event debug lines
+        self.log_limiter = DeviceLogLimiter(_LOGGER, plan.log_sample_rate,
+                                            plan.log_rate_limit)
+
+        # per-device track of the position and distance (metres) to the zone,
+        # plus an index of (distance in km, device) pairs kept in ascending
+        # order so the nearest device is always at the front of the list
+        self._tracks = {device: DeviceTrack()
+                        for device in plan.devices}
+        if plan.trend_window > DEFAULT_TREND_WINDOW:
+            for track in self._tracks.values():
+                track.trend = DistanceTrend(plan.trend_window)
+        self._batch = 0
+        self._shadow_batches = 0
+        self._distance_index = []
+        self._devices_in_zone = {}
+        self._devices_to_calculate = set()
+
+        # decides which of the values evaluated are written, and when
+        self.publisher = EntityPublisher(hass, plan, self.diagnostics,
+                                         self._distance_index, self.write)
+
+        # optional DistanceMatrix shared by all zones
+        self.distance_matrix = None
+
+        # cached Position of the zone, refreshed only when the zone itself
+        # changes, and of the devices, shared by all the zones
+        self.zone_position = None
+        self.device_positions = PositionCache()
+
+        # SnapshotStore of the zone when it is persisted
+        self.snapshot = None
+
+        # ZoneGrid holding the zone when it has a max_range
+        self.zone_grid = None
 
     @property
     def state(self):
@@ -158,116 +1118,488 @@ class Proximity(Entity):  # pylint: disable=too-many-instance-attributes
 
     @property
     def state_attributes(self):
-        return {
+        attributes = {
             ATTR_DIR_OF_TRAVEL: self.dir_of_travel,
             ATTR_NEAREST: self.nearest,
             ATTR_FRIENDLY_NAME: self.friendly_name
         }
+        if self.top_k:
+            attributes[ATTR_NEAREST_DEVICES] = [
+                {'entity_id': device, 'name': self._tracks[device].name,
+                 'distance': dist_to_zone}
+                for dist_to_zone, device in self.publisher.ranking or ()]
+        return attributes
+
+    def publish(self, throttle=True, log=_LOGGER):
+        """ Write the entity unless the visible values are unchanged.
+
+        log is the per-event logger of the device being evaluated.
+        """
+        self.publisher.publish((self.dist_to, self.dir_of_travel,
+                                self.nearest), throttle, log)
+
+    def write(self, values, ranking):
+        """ Write the entity with the values the publisher let through. """
+        # pylint: disable=unused-argument
+        self.dist_to, self.dir_of_travel, self.nearest = values
+        if self.run_on_loop:
+            self.hass.async_add_job(self.async_update_ha_state())
+        else:
+            self.update_ha_state()
+
+    def set_zone(self, zone_state, device_states):
+        """ Cache the zone position and recalculate the device distances. """
+        self.zone_position = zone_position(zone_state)
+        for device in self.proximity_devices:
+            if self._tracks[device].trend is not None:
+                self._tracks[device].trend.clear()
+            self.update_device_cache(device, device_states[device])
+
+    def move_zone(self, zone_state, device_states):
+        """ Recalculate the device distances to the moved zone and publish
+        the nearest device, whose direction of travel is not known until
+        it reports again. """
+        self.set_zone(zone_state, device_states)
+        self.settle()
+        self.publish(throttle=False)
+
+    def settle(self, kept=None):
+        """ Decide the entity values from the cached devices alone.
+
+        kept are values published before: their direction of travel stands
+        while the same device is the nearest, and they stand in whole while
+        the devices decide nothing.
+        """
+        if self._devices_in_zone:
+            values = (0, 'arrived', ', '.join(self._devices_in_zone.values()))
+        elif self._distance_index:
+            dist_to_zone, closest_device = self._distance_index[0]
+            name = self._tracks[closest_device].name
+            direction = 'unknown'
+            if kept is not None and kept[2] == name and \
+                    kept[1] in ('towards', 'away_from', 'stationary'):
+                direction = kept[1]
+            values = (round(dist_to_zone), direction, name)
+        elif self._devices_to_calculate and self.max_range is not None and \
+                all(self._tracks[device].far
+                    for device in self._devices_to_calculate):
+            values = ('far', 'far', 'far')
+        elif kept is not None:
+            values = kept
+        else:
+            return
+        self.dist_to, self.dir_of_travel, self.nearest = values
+
+    def restore(self, saved):
+        """ Bring back the device positions of a zone from its snapshot
+        and return the entity values it saved, if any. """
+        if not isinstance(saved, dict):
+            return None
+        published = saved.get('state')
+        if isinstance(published, list) and len(published) == 3:
+            published = tuple(published)
+            _LOGGER.info('%s: restored distance=%s direction=%s nearest=%s',
+                         self.entity_id, *published)
+        else:
+            published = None
+        devices = saved.get('devices')
+        if isinstance(devices, dict):
+            for device, position in devices.items():
+                track = self._tracks.get(device)
+                if track is not None and track.latitude is None and \
+                        isinstance(position, list) and len(position) == 2:
+                    track.restored = tuple(position)
+        return published
+
+    def snapshot_state(self):
+        """ The entity values and last device positions to persist. """
+        devices = {}
+        for device, track in self._tracks.items():
+            if track.latitude is not None:
+                devices[device] = [track.latitude, track.longitude]
+            elif track.restored is not None:
+                devices[device] = list(track.restored)
+        return {'state': [self.dist_to, self.dir_of_travel, self.nearest],
+                'devices': devices}
+
+    def update_device_cache(self, device, device_state):
+        """ Update the cached zone membership and distance for a device. """
+        track = self._tracks[device]
+        if track.distance is not None:
+            del self._distance_index[bisect_left(
+                self._distance_index,
+                (round(track.distance / 1000, 1), device))]
+            track.distance = None
+            track.error = 0
+        track.far = False
+
+        if device_state is None:
+            track.latitude = track.longitude = None
+            track.state = None
+            track.in_zone = False
+            self._devices_in_zone.pop(device, None)
+            self._devices_to_calculate.discard(device)
+            return None
+
+        track.name = device_state.name
+        track.latitude = device_state.attributes.get('latitude')
+        track.longitude = device_state.attributes.get('longitude')
+
+        # the state is only normalised when it differs from the last one
+        if device_state.state != track.state:
+            track.state = device_state.state
+            track.in_zone = (track.state).lower() == self.friendly_name
+        if track.in_zone:
+            self._devices_in_zone[device] = device_state.name
+        else:
+            self._devices_in_zone.pop(device, None)
+
+        if device_state.state in self.ignored_zones:
+            self._devices_to_calculate.discard(device)
+            return None
+        self._devices_to_calculate.add(device)
+
+        # ignore devices if proximity cannot be calculated
+        if track.latitude is None:
+            return None
+
+        # devices the grid puts out of range are far without measuring
+        if self.zone_grid is not None and self.entity_id not in \
+                self.zone_grid.near(track.latitude, track.longitude):
+            track.far = True
+            return None
+
+        dist_to_zone = None
+        if self.distance_backend is not None:
+            # use the fast backend unless its error straddles a 0.1 km step
+            dist_to_zone, error = self.distance_backend(
+                self.zone_position, self.device_positions.get(
+                    device, track.latitude, track.longitude))
+            self.diagnostics.distances += 1
+            if near_rounding_boundary(dist_to_zone, error):
+                dist_to_zone = None
+            else:
+                track.error = error
+        elif self.distance_matrix is not None:
+            dist_to_zone = self.distance_matrix.distance(self.proximity_zone,
+                                                         device)
+        if dist_to_zone is None:
+            dist_to_zone = self.exact_distance(device_state)
+        if self.max_range is not None:
+            if track.error and \
+                    abs(dist_to_zone - self.max_range) <= track.error:
+                dist_to_zone = self.exact_distance(device_state)
+                track.error = 0
+            if dist_to_zone > self.max_range:
+                track.far = True
+                track.error = 0
+                return None
+        track.distance = dist_to_zone
+        insort(self._distance_index, (round(dist_to_zone / 1000, 1), device))
+        if track.trend is not None:
+            track.trend.add(dist_to_zone, track.error, track.latitude,
+                            track.longitude)
+        return dist_to_zone
+
+    def exact_distance(self, device_state):
+        """ Distance in metres from the zone to a device's position. """
+        return self.position_distance(device_state.attributes['latitude'],
+                                      device_state.attributes['longitude'])
+
+    def position_distance(self, latitude, longitude):
+        """ Distance in metres from the zone to a position. """
+        self.diagnostics.distances += 1
+        return distance(self.zone_position.latitude,
+                        self.zone_position.longitude, latitude, longitude)
 
     def check_proximity_state_change(self, entity, old_state, new_state):
-        # pylint: disable=too-many-branches,too-many-statements,too-many-locals
         """ Function to perform the proximity checking """
-        entity_name = new_state.name
-        devices_to_calculate = False
-        devices_in_zone = ''
+        if not self.coalesce_window:
+            self.check_proximity_state_changes(
+                ((entity, old_state, new_state),))
+            return
+
+        # collapse the updates of each device within the window to its
+        # first old state and latest new state and evaluate them together
+        with self.lock:
+            if entity in self._pending:
+                old_state = self._pending[entity][1]
+            self._pending[entity] = (entity, old_state, new_state)
+            if self._flush_scheduled:
+                return
+            self._flush_scheduled = True
+        self.publisher.schedule(self.flush_pending_state_changes,
+                                self.coalesce_window)
+
+    def flush_pending_state_changes(self, now=None):
+        """ Evaluate the device updates collected during the window. """
+        with self.lock:
+            changes = list(self._pending.values())
+            self._pending.clear()
+            self._flush_scheduled = False
+            if changes:
+                self.check_proximity_state_changes(changes)
+
+    def check_proximity_state_changes(self, changes):
+        """ Update the cache for (entity, old_state, new_state) changes of
+        one or more devices and evaluate the zone once. """
+        if self.plan.diagnostics:
+            started = perf_counter()
+        sampled = None
+        if self.plan.shadow_sample_rate:
+            self._shadow_batches += 1
+            if not self._shadow_batches % self.plan.shadow_sample_rate:
+                sampled = (self.dist_to, self.dir_of_travel, self.nearest)
+        self.evaluate_state_changes(changes)
+        if self.plan.diagnostics:
+            self.diagnostics.record_latency(perf_counter() - started)
+        if sampled is not None:
+            self.shadow_check(changes, sampled)
+
+    def shadow_check(self, changes, before):
+        """ Compare the values decided for changes with the reference
+        evaluation and count any divergence. """
+        started = perf_counter()
+        expected = self.reference_evaluation(changes)
+        if expected is None:
+            expected = before
+        decided = (self.dist_to, self.dir_of_travel, self.nearest)
+        self.diagnostics.shadow_checks += 1
+        if diverges(expected, decided):
+            self.diagnostics.shadow_divergences += 1
+            _LOGGER.error('%s: shadow check of %s diverged: expected %s, '
+                          'decided %s', self.entity_id,
+                          ', '.join(change[0] for change in changes),
+                          expected, decided)
+        self.diagnostics.shadow_time += perf_counter() - started
 
-        zone_state = self.hass.states.get(self.proximity_zone)
-        proximity_latitude = zone_state.attributes.get('latitude')
-        proximity_longitude = zone_state.attributes.get('longitude')
+    def reference_evaluation(self, changes):
+        # pylint: disable=too-many-branches,too-many-locals
+        """ The values the original full scan of the devices gives the
+        entity for changes, None if it leaves the entity unchanged.
 
-        # check for devices in the monitored zone
+        The scan measures every device exactly from the state it was last
+        evaluated at. A direction of travel that follows a trend is None.
+        """
+        latitude = self.zone_position.latitude
+        longitude = self.zone_position.longitude
+        devices_to_calculate = []
+        devices_in_zone = []
         for device in self.proximity_devices:
-            device_state = self.hass.states.get(device)
+            track = self._tracks[device]
+            if track.state is None:
+                continue
+            if track.state not in self.ignored_zones:
+                devices_to_calculate.append(track)
+            if (track.state).lower() == self.friendly_name:
+                devices_in_zone.append(track.name)
 
-            if device_state.state not in self.ignored_zones:
-                devices_to_calculate = True
+        # no-one to track, or someone in the monitored zone
+        if not devices_to_calculate:
+            return ('not set', 'not set', 'not set')
+        if devices_in_zone:
+            return (0, 'arrived', ', '.join(devices_in_zone))
 
-            # check the location of all devices
-            if (device_state.state).lower() == (self.friendly_name).lower():
-                device_friendly = device_state.name
-                if devices_in_zone != '':
-                    devices_in_zone = devices_in_zone + ', '
-                devices_in_zone = devices_in_zone + device_friendly
+        # collect distances to the zone for all devices within range
+        distances_to_zone = {}
+        far = []
+        for device in self.proximity_devices:
+            track = self._tracks[device]
+            if track.state is None or track.state in self.ignored_zones or \
+                    track.latitude is None:
+                continue
+            metres = distance(latitude, longitude, track.latitude,
+                              track.longitude)
+            if self.max_range is not None and metres > self.max_range:
+                far.append(track)
+                continue
+            distances_to_zone[device] = round(metres / 1000, 1)
+        if not distances_to_zone:
+            if self.max_range is not None and \
+                    len(far) == len(devices_to_calculate):
+                return ('far', 'far', 'far')
+            return None
+
+        # the closest device, or the last that changed if it did not change
+        closest_device = min(distances_to_zone, key=lambda device: (
+            distances_to_zone[device], device))
+        dist_to_zone = distances_to_zone[closest_device]
+        if self._tracks[closest_device].batch == self._batch:
+            entity = closest_device
+        else:
+            entity = changes[-1][0]
+        track = self._tracks[entity]
+        new_state = track.new_state
+        if 'latitude' not in new_state.attributes:
+            return None
+        if closest_device != entity:
+            return (round(dist_to_zone), 'unknown',
+                    self._tracks[closest_device].name)
+
+        # a trend of the recent distances decides the direction even
+        # without a previous position
+        if track.trend is not None and track.trend.count > 1:
+            return (round(dist_to_zone), None, new_state.name)
+
+        # the previous position the direction of travel is measured from
+        old_state = track.old_state
+        if track.old_distance is not None:
+            old_position = track.old_position
+        elif old_state is not None and 'latitude' in old_state.attributes:
+            old_position = (old_state.attributes['latitude'],
+                            old_state.attributes['longitude'])
+        else:
+            return (round(dist_to_zone), 'unknown', new_state.name)
+        distance_travelled = round(
+            distance(latitude, longitude, track.latitude, track.longitude) -
+            distance(latitude, longitude, *old_position), 1)
+        if distance_travelled < self.tolerance * -1:
+            direction_of_travel = 'towards'
+        elif distance_travelled > self.tolerance:
+            direction_of_travel = 'away_from'
+        else:
+            direction_of_travel = 'stationary'
+        return (round(dist_to_zone), direction_of_travel, new_state.name)
+
+    def evaluate_state_changes(self, changes):
+        # pylint: disable=too-many-branches,too-many-statements,too-many-locals
+        """ Proximity checking for one or more device changes """
+        if self.snapshot is not None:
+            self.snapshot.schedule()
+
+        # per-event lines are debug only, sampled and rate limited per
+        # device (the last that changed)
+        log = self.log_limiter.logger_for(changes[-1][0])
+
+        # only the devices that changed need their distance recalculating
+        self._batch += 1
+        batch = self._batch
+        for entity, old_state, new_state in changes:
+            track = self._tracks[entity]
+            if track.batch != batch:
+                track.batch = batch
+                track.old_state = old_state
+                track.old_distance = track.distance
+                track.old_error = track.error
+                track.old_position = (track.latitude, track.longitude)
+                if track.restored is not None:
+                    # the previous position is only known from the snapshot
+                    if track.old_distance is None:
+                        track.old_distance = self.position_distance(
+                            *track.restored)
+                        track.old_position = track.restored
+                        if track.trend is not None:
+                            track.trend.add(track.old_distance, 0,
+                                            *track.restored)
+                    track.restored = None
+            track.new_state = new_state
+            self.update_device_cache(entity, new_state)
 
         # no-one to track so reset the entity
-        if not devices_to_calculate:
+        if not self._devices_to_calculate:
             self.dist_to = 'not set'
             self.dir_of_travel = 'not set'
             self.nearest = 'not set'
-            self.update_ha_state()
+            self.publish(log=log)
             return
 
         # at least one device is in the monitored zone so update the entity
-        if devices_in_zone != '':
+        if self._devices_in_zone:
             self.dist_to = 0
             self.dir_of_travel = 'arrived'
-            self.nearest = devices_in_zone
-            self.update_ha_state()
+            self.nearest = ', '.join(self._devices_in_zone.values())
+            self.publish(log=log)
             return
 
-        # we can't check proximity because latitude and longitude don't exist
-        if 'latitude' not in new_state.attributes:
+        # the nearest device is always at the front of the index; when it is
+        # one of the devices that changed, evaluate its direction of travel
+        closest_device = None
+        if self._distance_index:
+            dist_to_zone, closest_device = self._distance_index[0]
+        elif self.max_range is not None and \
+                all(self._tracks[device].far
+                    for device in self._devices_to_calculate):
+            # every device is beyond the range of the zone
+            self.dist_to = 'far'
+            self.dir_of_travel = 'far'
+            self.nearest = 'far'
+            self.publish(log=log)
             return
+        if closest_device is not None and \
+                self._tracks[closest_device].batch == batch:
+            entity = closest_device
+        else:
+            entity = changes[-1][0]
+        track = self._tracks[entity]
+        old_state = track.old_state
+        old_distance = track.old_distance
+        old_error = track.old_error
+        new_state = track.new_state
+        new_distance = track.distance
 
-        # collect distances to the zone for all devices
-        distances_to_zone = {}
-        for device in self.proximity_devices:
-            # ignore devices in an ignored zone
-            device_state = self.hass.states.get(device)
-            if device_state.state in self.ignored_zones:
-                continue
-
-            # ignore devices if proximity cannot be calculated
-            if 'latitude' not in device_state.attributes:
-                continue
-
-            # calculate the distance to the proximity zone
-            dist_to_zone = distance(proximity_latitude,
-                                    proximity_longitude,
-                                    device_state.attributes['latitude'],
-                                    device_state.attributes['longitude'])
-
-            # add the device and distance to a dictionary
-            distances_to_zone[device] = round(dist_to_zone / 1000, 1)
-
-        # loop through each of the distances collected and work out the closest
-        closest_device = ''
-        dist_to_zone = 1000000
+        # a removed device has no position: the other devices decide the
+        # entity
+        if new_state is None:
+            self.settle((self.dist_to, self.dir_of_travel, self.nearest))
+            self.publish(log=log)
+            return
+        entity_name = new_state.name
 
-        for device in distances_to_zone:
-            if distances_to_zone[device] < dist_to_zone:
-                closest_device = device
-                dist_to_zone = distances_to_zone[device]
+        # we can't check proximity because latitude and longitude don't exist
+        # (though the device may have left the ranking)
+        if 'latitude' not in new_state.attributes or closest_device is None:
+            if self.top_k:
+                self.publish(log=log)
+            return
 
         # if the closest device is one of the other devices
         if closest_device != entity:
-            self.dist_to = round(distances_to_zone[closest_device])
+            self.dist_to = round(dist_to_zone)
             self.dir_of_travel = 'unknown'
-            device_state = self.hass.states.get(closest_device)
-            self.nearest = device_state.name
-            self.update_ha_state()
+            self.nearest = self._tracks[closest_device].name
+            self.publish(log=log)
             return
 
+        trend = track.trend
+        if trend is not None and trend.count > 1:
+            # follow the least-squares line through the recent distances,
+            # re-measuring them exactly if their error could change the
+            # direction of travel
+            travelled, error = trend.change()
+            if error and near_tolerance_boundary(travelled, error,
+                                                 self.tolerance):
+                trend.remeasure(self.position_distance)
+                travelled, error = trend.change()
+            distance_travelled = round(travelled, 1)
+
         # stop if we cannot calculate the direction of travel (i.e. we don't
-        # have a previous state and a current LAT and LONG)
-        if old_state is None or 'latitude' not in old_state.attributes:
-            self.dist_to = round(distances_to_zone[entity])
+        # have a previous position and a current LAT and LONG)
+        elif old_distance is None and (
+                old_state is None or 'latitude' not in old_state.attributes):
+            self.dist_to = round(dist_to_zone)
             self.dir_of_travel = 'unknown'
             self.nearest = entity_name
-            self.update_ha_state()
+            self.publish(log=log)
             return
 
-        # reset the variables
-        distance_travelled = 0
+        else:
+            # calculate the distance travelled, reusing the cached distance
+            # for the previous position when we have it
+            if old_distance is None:
+                old_distance = self.exact_distance(old_state)
+                old_error = 0
+            distance_travelled = round(new_distance - old_distance, 1)
 
-        # calculate the distance travelled
-        old_distance = distance(proximity_latitude, proximity_longitude,
-                                old_state.attributes['latitude'],
-                                old_state.attributes['longitude'])
-        new_distance = distance(proximity_latitude, proximity_longitude,
-                                new_state.attributes['latitude'],
-                                new_state.attributes['longitude'])
-        distance_travelled = round(new_distance - old_distance, 1)
+            # approximate distances are re-measured exactly if their error
+            # could change the direction of travel
+            error = old_error + track.error
+            if error and near_tolerance_boundary(new_distance - old_distance,
+                                                 error, self.tolerance):
+                if old_error:
+                    old_distance = self.position_distance(
+                        *track.old_position)
+                distance_travelled = round(self.exact_distance(new_state) -
+                                           old_distance, 1)
 
         # check for tolerance
         if distance_travelled < self.tolerance * -1:
@@ -281,9 +1613,6 @@ class Proximity(Entity):  # pylint: disable=too-many-instance-attributes
         self.dist_to = round(dist_to_zone)
         self.dir_of_travel = direction_of_travel
         self.nearest = entity_name
-        self.update_ha_state()
-        _LOGGER.debug('proximity.%s update entity: distance=%s: direction=%s: '
-                      'device=%s', self.friendly_name, round(dist_to_zone),
-                      direction_of_travel, entity_name)
-
-        _LOGGER.info('%s: proximity calculation complete', entity_name)
+        self.publish(log=log)
+        log.debug('%s: travelled %s metres: direction=%s', entity_name,
+                  distance_travelled, direction_of_travel)
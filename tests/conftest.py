@@ -0,0 +1,159 @@
+"""
+Fixtures running the proximity components against the benchmark's stand-in
+hass, with the components' clock following its simulated time.
+"""
+
+import datetime
+import importlib
+import os
+import sys
+import types
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+# pylint: disable=wrong-import-position
+from proximity_benchmark import (
+    Hass, generate_trace, install_stub_homeassistant, make_world,
+    run_coroutine)
+
+COMPONENTS = ('proximity', 'proximity_zones')
+
+# the attribute holding the nearest device of each component's entity
+NEAREST = {'proximity': 'nearest_device', 'proximity_zones': 'nearest'}
+
+HOME = (50.0, 0.0)
+WORK = (50.0, 1.0)
+
+# degrees of latitude per km, near enough for placing devices
+KM = 1 / 111.2
+
+
+class Harness(object):
+    """ A component loaded against a fresh stand-in hass. """
+    def __init__(self, component, config_dir):
+        self.component = component
+        self.hass = Hass()
+        self.hass.config.config_dir = config_dir
+        install_stub_homeassistant(self.hass)
+        for name in COMPONENTS + ('proximity_common',):
+            sys.modules.pop(name, None)
+        self.module = importlib.import_module(component)
+        sys.modules['proximity_common'].monotonic = \
+            lambda: self.hass.now.timestamp()
+
+        # the writes of the proximity entities (not their diagnostics)
+        self.writes = []
+        set_state = self.hass.states.set
+
+        def record_state(entity_id, new_state, attributes=None):
+            """ Set a state and keep the proximity entity writes. """
+            set_state(entity_id, new_state, attributes)
+            if entity_id.startswith(component + '.') and \
+                    not entity_id.endswith('_diagnostics'):
+                self.writes.append((entity_id, new_state, attributes))
+        self.hass.states.set = self.hass.states.async_set = record_state
+
+    def zone(self, name, latitude, longitude, radius=100):
+        """ Add a zone. """
+        self.hass.states.set('zone.' + name, 'zoning', {
+            'latitude': latitude, 'longitude': longitude, 'radius': radius,
+            'friendly_name': name})
+
+    def setup(self, config, on_loop=False):
+        """ Set up the component with its configuration, on the event
+        loop with async_setup if on_loop. """
+        config = {self.component: config}
+        if on_loop:
+            assert run_coroutine(self.module.async_setup(self.hass, config))
+        else:
+            assert self.module.setup(self.hass, config)
+
+    def monitor(self, devices, zones=('home',), on_loop=False, **options):
+        """ Set up the component to monitor the zones (proximity only the
+        first) with the given options. """
+        if self.component == 'proximity':
+            self.setup(dict(options, zone=zones[0], devices=devices),
+                       on_loop)
+        else:
+            self.setup([dict(options, zone=zone, devices=devices)
+                        for zone in zones], on_loop)
+
+    def advance(self, seconds):
+        """ Move the simulated time on and run the timers that are due. """
+        self.hass.now += datetime.timedelta(seconds=seconds)
+        self.hass.fire_timers()
+
+    def report(self, device, state, latitude=None, longitude=None,
+               **attributes):
+        """ Write a tracker state, with a position if one is given. """
+        attributes.setdefault('friendly_name', device.split('.', 1)[1])
+        if latitude is not None:
+            attributes['latitude'] = latitude
+            attributes['longitude'] = longitude
+        self.hass.states.set(device, state, attributes)
+
+    def play(self, rows):
+        """ Report proximity_replay history rows at their timestamps. """
+        for timestamp, device, state, latitude, longitude in rows:
+            self.hass.now = timestamp
+            self.hass.fire_timers()
+            self.report(device, state, latitude, longitude)
+
+    def call(self, service, **data):
+        """ Call a service of the component. """
+        self.hass.services.services[(self.module.DOMAIN, service)](
+            types.SimpleNamespace(data=data))
+
+    def get(self, entity_id):
+        """ The current state of an entity. """
+        return self.hass.states.get(entity_id)
+
+    def diagnostics(self, entity_id):
+        """ The counters of an entity, written by its next timer. """
+        self.advance(self.module.DIAGNOSTICS_INTERVAL)
+        return self.get(entity_id + '_diagnostics').attributes
+
+
+@pytest.fixture
+def harness(tmp_path):
+    """ Factory of Harnesses sharing a scratch configuration directory. """
+    return lambda component: Harness(component, str(tmp_path))
+
+
+def setup_component(harness, component, devices, zones=('home',),
+                    **options):
+    """ A component monitoring the zones, with home and work defined. """
+    loaded = harness(component)
+    loaded.zone('home', *HOME)
+    loaded.zone('work', *WORK)
+    loaded.monitor(devices, zones, **options)
+    return loaded
+
+
+def seeded_history(seed, num_devices, num_zones, events, interval=15):
+    """ A seeded synthetic trace as proximity_replay history rows, with
+    the zones and devices it covers. """
+    zones, devices = make_world(seed, num_devices, num_zones)
+    started = datetime.datetime(2016, 1, 1, tzinfo=datetime.timezone.utc)
+    rows = [(started + datetime.timedelta(seconds=interval * index), device,
+             state, attributes['latitude'], attributes['longitude'])
+            for index, (device, state, attributes)
+            in enumerate(generate_trace(seed, devices, zones, events))]
+    return zones, devices, rows
+
+
+def replay_config(component, zones, devices, **options):
+    """ A proximity_replay configuration of the seeded zones, monitoring
+    home with proximity and every zone with proximity_zones. """
+    config = {'zones': {name: {'latitude': latitude, 'longitude': longitude}
+                        for name, latitude, longitude in zones}}
+    if component == 'proximity':
+        config['proximity'] = dict(options, zone='home', devices=devices)
+    else:
+        config['proximity_zones'] = [dict(options, zone=name,
+                                          devices=devices)
+                                     for name, _, _ in zones]
+    return config
@@ -0,0 +1,34 @@
+"""
+Tests of both components set up on the event loop with async_setup.
+"""
+
+import pytest
+
+from conftest import COMPONENTS, HOME, KM, setup_component
+
+
+@pytest.mark.parametrize('component', COMPONENTS)
+def test_async_setup_evaluates_on_the_loop(harness, component):
+    """ The entity, its timers and its snapshot work the same when the
+    component is set up on the event loop. """
+    loaded = setup_component(harness, component, ['device_tracker.a'],
+                             on_loop=True, persist=True, coalesce_window=5,
+                             refresh_interval=60)
+    loaded.report('device_tracker.a', 'not_home', HOME[0] + 10 * KM, HOME[1])
+    loaded.report('device_tracker.a', 'not_home', HOME[0] + 9 * KM, HOME[1])
+    loaded.advance(5)
+    state = loaded.get(component + '.home')
+    assert state.state == 9
+    assert state.attributes['dir_of_travel'].lower() == 'unknown'
+
+    written = len(loaded.writes)
+    loaded.advance(60)
+    assert len(loaded.writes) == written + 1
+    assert loaded.diagnostics(component + '.home')['events_skipped'] == 0
+    assert loaded.get(component + '.home_diagnostics').state == 2
+
+    loaded.hass.bus.fire('homeassistant_stop')
+    restarted = setup_component(harness, component, ['device_tracker.a'],
+                                on_loop=True, persist=True)
+    assert restarted.get(component + '.home').state == \
+        loaded.get(component + '.home').state
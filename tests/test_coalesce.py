@@ -0,0 +1,33 @@
+"""
+Tests of the coalescing window of both components.
+"""
+
+import pytest
+
+from conftest import COMPONENTS, HOME, KM, NEAREST, setup_component
+
+
+@pytest.mark.parametrize('component', COMPONENTS)
+def test_coalesce_window_writes_a_burst_once(harness, component):
+    """ A burst of updates is written once, at the end of the window, with
+    the direction of travel from the position before it. """
+    devices = ['device_tracker.a', 'device_tracker.b']
+    loaded = setup_component(harness, component, devices, coalesce_window=5)
+    loaded.report('device_tracker.a', 'not_home', HOME[0] + 20 * KM, HOME[1])
+    loaded.report('device_tracker.b', 'not_home', HOME[0] + 30 * KM, HOME[1])
+    loaded.advance(5)
+    written = len(loaded.writes)
+
+    for km in (19, 18, 17, 16):
+        loaded.report('device_tracker.a', 'not_home', HOME[0] + km * KM,
+                      HOME[1])
+        loaded.report('device_tracker.b', 'not_home',
+                      HOME[0] + (km + 10) * KM, HOME[1])
+    assert len(loaded.writes) == written
+    loaded.advance(5)
+    assert len(loaded.writes) == written + 1
+    _, state, attributes = loaded.writes[-1]
+    assert (state, attributes['dir_of_travel'],
+            attributes[NEAREST[component]]) == (16, 'towards', 'a')
+    loaded.diagnostics(component + '.home')
+    assert loaded.get(component + '.home_diagnostics').state == 10
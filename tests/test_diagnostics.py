@@ -0,0 +1,34 @@
+"""
+Tests of the diagnostics entity of both components.
+"""
+
+import pytest
+
+from conftest import COMPONENTS, HOME, KM, setup_component
+
+
+@pytest.mark.parametrize('component', COMPONENTS)
+def test_diagnostics_count_the_events_the_filter_drops(harness, component):
+    """ Every device update is an event, including those the movement
+    filter skips. """
+    loaded = setup_component(harness, component, ['device_tracker.a'],
+                             tolerance=50)
+    loaded.report('device_tracker.a', 'not_home', HOME[0] + 10 * KM, HOME[1])
+    for battery in (90, 80, 70, 60, 50):
+        loaded.report('device_tracker.a', 'not_home', HOME[0] + 10 * KM,
+                      HOME[1], battery=battery)
+
+    skipped = loaded.diagnostics(component + '.home')['events_skipped']
+    events = loaded.get(component + '.home_diagnostics').state
+    assert (events, skipped) == (6, 5)
+
+
+@pytest.mark.parametrize('component', COMPONENTS)
+def test_diagnostics_can_be_turned_off(harness, component):
+    """ Without diagnostics there is no diagnostics entity to write. """
+    loaded = setup_component(harness, component, ['device_tracker.a'],
+                             diagnostics=False)
+    loaded.report('device_tracker.a', 'not_home', HOME[0] + 10 * KM, HOME[1])
+    loaded.advance(loaded.module.DIAGNOSTICS_INTERVAL)
+    assert loaded.get(component + '.home').state == 10
+    assert loaded.get(component + '.home_diagnostics') is None
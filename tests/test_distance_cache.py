@@ -0,0 +1,30 @@
+"""
+Tests of the per-device distance cache and nearest-device index of both
+components.
+"""
+
+import pytest
+
+from conftest import COMPONENTS, HOME, KM, setup_component
+
+
+@pytest.mark.parametrize('component', COMPONENTS)
+def test_removed_devices_leave_the_index(harness, component):
+    """ A removed device hands the entity to the nearest of the others,
+    and the entity is reset once no device is left. """
+    loaded = setup_component(harness, component,
+                             ['device_tracker.a', 'device_tracker.b'])
+    loaded.report('device_tracker.a', 'home', HOME[0], HOME[1])
+    loaded.report('device_tracker.b', 'not_home', HOME[0] + 8 * KM, HOME[1])
+    state = loaded.get(component + '.home')
+    assert (state.state, state.attributes['dir_of_travel']) == (0, 'arrived')
+
+    loaded.hass.states.remove('device_tracker.a')
+    state = loaded.get(component + '.home')
+    assert state.state == 8
+    assert state.attributes['dir_of_travel'].lower() == 'unknown'
+
+    loaded.hass.states.remove('device_tracker.b')
+    state = loaded.get(component + '.home')
+    assert (state.state, state.attributes['dir_of_travel']) == \
+        ('not set', 'not set')
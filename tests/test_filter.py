@@ -0,0 +1,44 @@
+"""
+Tests of the movement filter of both components.
+"""
+
+import pytest
+
+from conftest import COMPONENTS, HOME, KM, setup_component
+
+
+@pytest.mark.parametrize('component', COMPONENTS)
+def test_filter_drops_attribute_only_and_small_moves(harness, component):
+    """ Battery updates and moves within the tolerance are not evaluated,
+    the next move is measured from the last evaluated position. """
+    loaded = setup_component(harness, component, ['device_tracker.a'],
+                             tolerance=50)
+    loaded.report('device_tracker.a', 'not_home', HOME[0] + 10 * KM, HOME[1])
+    written = len(loaded.writes)
+    loaded.report('device_tracker.a', 'not_home', HOME[0] + 10 * KM, HOME[1],
+                  battery=50)
+    loaded.report('device_tracker.a', 'not_home', HOME[0] + 10.03 * KM,
+                  HOME[1])
+    assert len(loaded.writes) == written
+
+    loaded.report('device_tracker.a', 'not_home', HOME[0] + 9 * KM, HOME[1])
+    _, state, attributes = loaded.writes[-1]
+    assert (state, attributes['dir_of_travel']) == (9, 'towards')
+    assert loaded.diagnostics(component + '.home')['events_skipped'] == 2
+
+
+@pytest.mark.parametrize('component', COMPONENTS)
+def test_filter_starts_from_the_device_states_at_setup(harness, component):
+    """ A device already home at setup has arrived, though every update
+    that follows is dropped by the filter. """
+    loaded = harness(component)
+    loaded.zone('home', *HOME)
+    loaded.report('device_tracker.a', 'home', HOME[0], HOME[1])
+    loaded.monitor(['device_tracker.a'], tolerance=50)
+    for battery in (90, 80, 70):
+        loaded.report('device_tracker.a', 'home', HOME[0], HOME[1],
+                      battery=battery)
+
+    state = loaded.get(component + '.home')
+    assert (state.state, state.attributes['dir_of_travel']) == (0, 'arrived')
+    assert loaded.diagnostics(component + '.home')['events_skipped'] == 3
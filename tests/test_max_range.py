@@ -0,0 +1,27 @@
+"""
+Tests of the max_range option of proximity_zones.
+"""
+
+from conftest import HOME, KM, setup_component
+
+
+def test_max_range_publishes_far_devices(harness):
+    """ Devices beyond the range are far and not measured. """
+    devices = ['device_tracker.a', 'device_tracker.b']
+    proximity_zones = setup_component(harness, 'proximity_zones', devices,
+                                      max_range=50)
+    proximity_zones.report('device_tracker.a', 'not_home',
+                           HOME[0] + 100 * KM, HOME[1])
+    assert proximity_zones.get('proximity_zones.home').state == 'far'
+
+    proximity_zones.report('device_tracker.b', 'not_home',
+                           HOME[0] + 30 * KM, HOME[1])
+    state = proximity_zones.get('proximity_zones.home')
+    assert (state.state, state.attributes['nearest']) == (30, 'b')
+
+    # the grid keeps a device on another continent from being measured
+    before = proximity_zones.diagnostics('proximity_zones.home')
+    proximity_zones.report('device_tracker.a', 'not_home', -30.0, 150.0)
+    after = proximity_zones.diagnostics('proximity_zones.home')
+    assert after['distance_calculations'] == \
+        before['distance_calculations']
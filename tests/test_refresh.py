@@ -0,0 +1,35 @@
+"""
+Tests of the writes of unchanged values of both components.
+"""
+
+import pytest
+
+from conftest import COMPONENTS, HOME, KM, setup_component
+
+
+@pytest.mark.parametrize('component', COMPONENTS)
+def test_unchanged_values_are_not_written(harness, component):
+    """ A move that leaves the rounded distance, the direction of travel
+    and the nearest device as they are is not written. """
+    loaded = setup_component(harness, component, ['device_tracker.a'])
+    loaded.report('device_tracker.a', 'not_home', HOME[0] + 10 * KM, HOME[1])
+    loaded.report('device_tracker.a', 'not_home', HOME[0] + 9 * KM, HOME[1])
+    written = len(loaded.writes)
+    loaded.report('device_tracker.a', 'not_home', HOME[0] + 8.6 * KM,
+                  HOME[1])
+    assert len(loaded.writes) == written
+
+
+@pytest.mark.parametrize('component', COMPONENTS)
+def test_refresh_interval_rewrites_a_stationary_device(harness, component):
+    """ Updates the filter drops do not hold back the refresh. """
+    loaded = setup_component(harness, component, ['device_tracker.a'],
+                             refresh_interval=60)
+    loaded.report('device_tracker.a', 'not_home', HOME[0] + 10 * KM, HOME[1])
+    written = len(loaded.writes)
+    for battery in range(60):
+        loaded.advance(30)
+        loaded.report('device_tracker.a', 'not_home', HOME[0] + 10 * KM,
+                      HOME[1], battery=battery)
+    assert len(loaded.writes) - written == 30
+    assert {state for _, state, _ in loaded.writes[written:]} == {10}
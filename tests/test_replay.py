@@ -0,0 +1,101 @@
+"""
+Replays of seeded traces through both components: the published values
+must not depend on the distance backend, and must match the full scan of
+the shadow check.
+"""
+
+import pytest
+
+from conftest import COMPONENTS, replay_config, seeded_history
+from proximity_replay import replay
+
+BACKENDS = ('exact', 'haversine', 'equirectangular')
+
+OPTIONS = ({}, {'tolerance': 50}, {'top_k': 3})
+
+
+def shadow_divergences(caplog):
+    """ The shadow check divergences logged so far. """
+    return [record.getMessage() for record in caplog.records
+            if 'diverged' in record.getMessage()]
+
+
+@pytest.mark.parametrize('component', COMPONENTS)
+@pytest.mark.parametrize('options', OPTIONS)
+@pytest.mark.parametrize('seed', (1, 2))
+def test_fast_backends_publish_the_exact_writes(component, options, seed):
+    """ The fast backends fall back to the exact distance whenever their
+    error could change a published value. """
+    zones, devices, rows = seeded_history(seed, 6, 3, 2000)
+    config = replay_config(component, zones, devices, **options)
+    writes = {backend: list(replay(config, rows, backend))
+              for backend in BACKENDS}
+    assert writes['exact']
+    assert writes['haversine'] == writes['exact']
+    assert writes['equirectangular'] == writes['exact']
+
+
+@pytest.mark.parametrize('component', COMPONENTS)
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_shadow_check_agrees_with_the_full_scan(component, backend, caplog):
+    """ Checking every update finds no divergence from the reference. """
+    zones, devices, rows = seeded_history(3, 6, 3, 2000)
+    config = replay_config(component, zones, devices, shadow_sample_rate=1)
+    assert list(replay(config, rows, backend))
+    assert shadow_divergences(caplog) == []
+
+
+@pytest.mark.parametrize('component', COMPONENTS)
+def test_shadow_check_agrees_with_a_trend(component, caplog):
+    """ A direction of travel that follows a trend is not a divergence,
+    with or without a previous position. """
+    zones, devices, rows = seeded_history(9, 6, 3, 2000)
+    # every tenth update has no position, so the next has no previous one
+    rows = [(timestamp, device, state, None, None) if not index % 10 else
+            (timestamp, device, state, latitude, longitude)
+            for index, (timestamp, device, state, latitude, longitude)
+            in enumerate(rows)]
+    config = replay_config(component, zones, devices, trend_window=4,
+                           shadow_sample_rate=1)
+    assert list(replay(config, rows))
+    assert shadow_divergences(caplog) == []
+
+
+def test_shadow_check_flags_a_wrong_distance(harness, caplog):
+    """ A backend whose error bound is wrong is caught by the check. """
+    zones, devices, rows = seeded_history(4, 4, 1, 300)
+    proximity_zones = harness('proximity_zones')
+    for name, latitude, longitude in zones:
+        proximity_zones.zone(name, latitude, longitude)
+    proximity_zones.module.DISTANCE_BACKENDS['haversine'] = \
+        lambda zone, device: (1000000, 0)
+    proximity_zones.setup([{'zone': 'home', 'devices': devices,
+                            'distance_backend': 'haversine',
+                            'shadow_sample_rate': 1}])
+    proximity_zones.play(rows)
+    assert shadow_divergences(caplog)
+    diagnostics = proximity_zones.diagnostics('proximity_zones.home')
+    assert diagnostics['shadow_divergences'] > 0
+    assert diagnostics['shadow_checks'] >= diagnostics['shadow_divergences']
+
+
+def test_zone_grid_matches_an_unbounded_zone():
+    """ A max_range beyond every device measures the devices the grid
+    would not skip, giving the writes of a zone without a range. """
+    zones, devices, rows = seeded_history(5, 6, 3, 2000)
+    unbounded = list(replay(replay_config('proximity_zones', zones,
+                                          devices), rows))
+    bounded = list(replay(replay_config('proximity_zones', zones, devices,
+                                        max_range=10000), rows))
+    assert bounded == unbounded
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_zone_grid_agrees_with_the_full_scan(backend, caplog):
+    """ Zones skipped by the grid are far in the full scan as well. """
+    zones, devices, rows = seeded_history(6, 6, 3, 2000)
+    config = replay_config('proximity_zones', zones, devices, max_range=20,
+                           shadow_sample_rate=1)
+    writes = list(replay(config, rows, backend))
+    assert any(state == 'far' for _, _, state, _ in writes)
+    assert shadow_divergences(caplog) == []
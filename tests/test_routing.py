@@ -0,0 +1,31 @@
+"""
+Tests of the routing of device updates to the zones of proximity_zones.
+"""
+
+from conftest import HOME, KM, WORK
+
+
+def test_updates_reach_only_the_zones_tracking_the_device(harness):
+    """ A device's updates are neither evaluated nor counted by a zone
+    that does not track it. """
+    proximity_zones = harness('proximity_zones')
+    proximity_zones.zone('home', *HOME)
+    proximity_zones.zone('work', *WORK)
+    proximity_zones.setup([
+        {'zone': 'home', 'devices': ['device_tracker.a']},
+        {'zone': 'work', 'devices': ['device_tracker.a',
+                                     'device_tracker.b']}])
+    del proximity_zones.writes[:]
+
+    for km in (5, 4, 3):
+        proximity_zones.report('device_tracker.b', 'not_home',
+                               WORK[0] + km * KM, WORK[1])
+    assert {entity_id for entity_id, _, _ in proximity_zones.writes} == \
+        {'proximity_zones.work'}
+    proximity_zones.advance(proximity_zones.module.DIAGNOSTICS_INTERVAL)
+    assert proximity_zones.get('proximity_zones.home_diagnostics').state == 0
+    assert proximity_zones.get('proximity_zones.work_diagnostics').state == 3
+
+    proximity_zones.report('device_tracker.a', 'not_home',
+                           HOME[0] + 2 * KM, HOME[1])
+    assert proximity_zones.get('proximity_zones.home').state == 2
@@ -0,0 +1,87 @@
+"""
+Tests of the snapshot that carries the entities of both components over a
+restart.
+"""
+
+import json
+import os
+
+import pytest
+
+from conftest import COMPONENTS, HOME, KM
+
+STOP = 'homeassistant_stop'
+
+
+def start(harness, component, positions):
+    """ A component persisting home, started with the device at the given
+    (state, latitude) or without a state. """
+    loaded = harness(component)
+    loaded.zone('home', *HOME)
+    if positions is not None:
+        state, latitude = positions
+        loaded.report('device_tracker.a', state, latitude, HOME[1])
+    loaded.monitor(['device_tracker.a'], persist=True)
+    return loaded
+
+
+def entity(loaded):
+    """ The distance and direction of travel of the entity. """
+    state = loaded.get(loaded.component + '.home')
+    return state.state, state.attributes['dir_of_travel']
+
+
+def stopped_towards(harness, component):
+    """ Run the device towards home, then stop Home Assistant. """
+    loaded = start(harness, component, None)
+    loaded.report('device_tracker.a', 'not_home', HOME[0] + 10 * KM, HOME[1])
+    loaded.report('device_tracker.a', 'not_home', HOME[0] + 9 * KM, HOME[1])
+    loaded.hass.bus.fire(STOP)
+    return loaded
+
+
+@pytest.mark.parametrize('component', COMPONENTS)
+def test_stop_writes_the_snapshot_at_once(harness, component):
+    """ Stopping writes the latest values without waiting for the
+    scheduled write. """
+    loaded = stopped_towards(harness, component)
+    with open(os.path.join(loaded.hass.config.config_dir,
+                           loaded.module.SNAPSHOT_FILE)) as snapshot_file:
+        snapshot = json.load(snapshot_file)
+    saved = snapshot['zones'][component + '.home']
+    assert saved['state'] == [9, 'towards', 'a']
+    assert saved['devices']['device_tracker.a'][0] == \
+        pytest.approx(HOME[0] + 9 * KM)
+
+
+@pytest.mark.parametrize('component', COMPONENTS)
+def test_restart_restores_the_values_of_an_unplaced_device(harness,
+                                                           component):
+    """ With no device state at startup the snapshot values stand, and the
+    next move is measured from the snapshot position. """
+    stopped_towards(harness, component)
+    loaded = start(harness, component, None)
+    assert entity(loaded) == (9, 'towards')
+
+    loaded.report('device_tracker.a', 'not_home', HOME[0] + 12 * KM, HOME[1])
+    assert entity(loaded) == (12, 'away_from')
+
+
+@pytest.mark.parametrize('component', COMPONENTS)
+def test_restart_keeps_the_direction_of_the_same_nearest(harness,
+                                                         component):
+    """ The distance follows the device state at startup, the direction
+    of travel comes from the snapshot. """
+    stopped_towards(harness, component)
+    loaded = start(harness, component, ('not_home', HOME[0] + 8 * KM))
+    assert entity(loaded) == (8, 'towards')
+
+
+@pytest.mark.parametrize('component', COMPONENTS)
+def test_restart_checks_the_snapshot_against_the_device_states(harness,
+                                                               component):
+    """ A device that came home while Home Assistant was stopped has
+    arrived, whatever the snapshot says. """
+    stopped_towards(harness, component)
+    loaded = start(harness, component, ('home', HOME[0]))
+    assert entity(loaded) == (0, 'arrived')
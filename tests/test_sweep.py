@@ -0,0 +1,61 @@
+"""
+Tests of the parameter sweep over a packed trace.
+"""
+
+import csv
+import json
+
+from conftest import replay_config, seeded_history
+from proximity_replay import replay
+from proximity_sweep import main, pack_trace, trace_rows, variants
+
+
+def write_history(path, rows):
+    """ Write history rows as a proximity_replay CSV file. """
+    with open(str(path), 'w', newline='') as history_file:
+        writer = csv.writer(history_file)
+        writer.writerow(('timestamp', 'device', 'state', 'latitude',
+                         'longitude'))
+        for timestamp, device, state, latitude, longitude in rows:
+            writer.writerow((timestamp.isoformat(), device, state,
+                             latitude, longitude))
+
+
+def test_packed_trace_reads_back_the_history(tmp_path):
+    """ The memory-mapped trace gives back the rows of the history. """
+    _, _, rows = seeded_history(10, 3, 2, 200)
+    history = tmp_path / 'history.csv'
+    write_history(history, rows)
+    assert pack_trace(str(history), str(tmp_path / 'trace')) == len(rows)
+    assert list(trace_rows(str(tmp_path / 'trace'))) == rows
+
+
+def test_sweep_processes_match_serial_replays(tmp_path, capsys):
+    """ Each variant replayed in the process pool writes what a replay of
+    the same configuration in this process writes. """
+    zones, devices, rows = seeded_history(11, 4, 2, 500)
+    config = replay_config('proximity_zones', zones, devices)
+    history = tmp_path / 'history.csv'
+    write_history(history, rows)
+    with open(str(tmp_path / 'config.json'), 'w') as config_file:
+        json.dump(config, config_file)
+
+    main([str(tmp_path / 'config.json'), str(history), '--tolerance', '10',
+          '200', '--zone-set', 'home', 'home,zone1', '--processes', '2',
+          '--json'])
+    results = [json.loads(line)
+               for line in capsys.readouterr().out.splitlines()]
+
+    expected = []
+    for parameters, variant in variants(config, [10, 200],
+                                        ['home', 'home,zone1'], []):
+        directions = {}
+        for _, _, _, attributes in replay(variant, rows):
+            direction = attributes.get('dir_of_travel')
+            directions[direction] = directions.get(direction, 0) + 1
+        expected.append(dict(parameters, writes=sum(directions.values()),
+                             directions=directions))
+    for result in results:
+        del result['seconds']
+    assert results == expected
+    assert len({result['writes'] for result in results}) > 1
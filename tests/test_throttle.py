@@ -0,0 +1,58 @@
+"""
+Tests of the distance throttle of both components.
+"""
+
+import pytest
+
+from conftest import COMPONENTS, HOME, KM, setup_component
+
+
+@pytest.mark.parametrize('component', COMPONENTS)
+def test_throttle_holds_back_distant_distance_changes(harness, component):
+    """ A device far away is written rarely, a change of direction is
+    written at once. """
+    loaded = setup_component(harness, component, ['device_tracker.a'],
+                             throttle_interval=2)
+    for step in range(20):
+        loaded.advance(10)
+        loaded.report('device_tracker.a', 'not_home',
+                      HOME[0] + (100 - step / 2) * KM, HOME[1])
+    assert len(loaded.writes) < 10
+    assert loaded.diagnostics(component + '.home')['writes_throttled'] > 0
+
+    loaded.report('device_tracker.a', 'not_home', HOME[0] + 96 * KM, HOME[1])
+    _, state, attributes = loaded.writes[-1]
+    assert (state, attributes['dir_of_travel']) == (96, 'away_from')
+
+
+@pytest.mark.parametrize('component', COMPONENTS)
+def test_throttle_writes_the_held_back_distance_later(harness, component):
+    """ A device that stops while its distance is throttled is written
+    once the interval of its band has passed. """
+    loaded = setup_component(harness, component, ['device_tracker.a'],
+                             throttle_interval=2)
+    for km in range(300, 277, -1):
+        loaded.advance(10)
+        loaded.report('device_tracker.a', 'not_home', HOME[0] + km * KM,
+                      HOME[1])
+    assert loaded.writes[-1][1] != 278
+    loaded.advance(2 * 278)
+    _, state, attributes = loaded.writes[-1]
+    assert (state, attributes['dir_of_travel']) == (278, 'towards')
+    written = len(loaded.writes)
+    loaded.advance(3600)
+    assert len(loaded.writes) == written
+
+
+@pytest.mark.parametrize('component', COMPONENTS)
+def test_throttle_keeps_nearby_devices_responsive(harness, component):
+    """ A device a kilometre away is written on every move. """
+    loaded = setup_component(harness, component, ['device_tracker.a'],
+                             throttle_interval=2)
+    loaded.report('device_tracker.a', 'not_home', HOME[0] + 3 * KM, HOME[1])
+    for km in (2, 1):
+        loaded.advance(10)
+        loaded.report('device_tracker.a', 'not_home', HOME[0] + km * KM,
+                      HOME[1])
+    assert [state for _, state, _ in loaded.writes[-3:]] == [3, 2, 1]
+    assert loaded.diagnostics(component + '.home')['writes_throttled'] == 0
@@ -0,0 +1,29 @@
+"""
+Tests of the ranking of the nearest devices of both components.
+"""
+
+import pytest
+
+from conftest import COMPONENTS, HOME, KM, NEAREST, setup_component
+
+
+@pytest.mark.parametrize('component', COMPONENTS)
+def test_top_k_ranks_the_nearest_devices(harness, component):
+    """ A change in the ranking is written even when the nearest device
+    and its distance are unchanged. """
+    devices = ['device_tracker.a', 'device_tracker.b', 'device_tracker.c']
+    loaded = setup_component(harness, component, devices, top_k=2)
+    for device, km in zip(devices, (5, 10, 20)):
+        loaded.report(device, 'not_home', HOME[0] + km * KM, HOME[1])
+    ranking = loaded.get(component + '.home').attributes['nearest_devices']
+    assert [entry['entity_id'] for entry in ranking] == devices[:2]
+    assert [round(entry['distance']) for entry in ranking] == [5, 10]
+
+    written = len(loaded.writes)
+    loaded.report('device_tracker.c', 'not_home', HOME[0] + 7 * KM, HOME[1])
+    assert len(loaded.writes) == written + 1
+    state = loaded.get(component + '.home')
+    assert (state.state, state.attributes[NEAREST[component]]) == (5, 'a')
+    assert [entry['entity_id'] for entry
+            in state.attributes['nearest_devices']] == [
+                'device_tracker.a', 'device_tracker.c']
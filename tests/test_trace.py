@@ -0,0 +1,39 @@
+"""
+Tests of the stage tracing of the proximity component.
+"""
+
+import json
+
+from conftest import HOME, KM, setup_component
+
+
+def test_dump_trace_writes_relative_names_in_the_config_dir(harness,
+                                                             tmp_path,
+                                                             monkeypatch):
+    """ A relative filename does not depend on the working directory. """
+    proximity = setup_component(harness, 'proximity', ['device_tracker.a'],
+                                trace_size=100)
+    proximity.report('device_tracker.a', 'not_home', HOME[0] + 10 * KM,
+                     HOME[1])
+    monkeypatch.chdir(tmp_path.parent)
+    proximity.call('dump_trace', filename='trace.json')
+    with open(str(tmp_path / 'trace.json')) as trace_file:
+        assert json.load(trace_file)['traceEvents']
+
+    proximity.call('dump_trace')
+    assert (tmp_path / 'proximity_trace.json').exists()
+
+
+def test_trace_names_the_stages_of_an_evaluation(harness, tmp_path):
+    """ Each evaluated update is traced with its stages. """
+    proximity = setup_component(harness, 'proximity', ['device_tracker.a'],
+                                trace_size=100)
+    for km in (10, 9):
+        proximity.report('device_tracker.a', 'not_home', HOME[0] + km * KM,
+                         HOME[1])
+    proximity.call('dump_trace', filename='trace.json')
+    with open(str(tmp_path / 'trace.json')) as trace_file:
+        names = {event['name'] for event
+                 in json.load(trace_file)['traceEvents']}
+    assert {'distance', 'in_zone_scan', 'comparison', 'write',
+            'evaluate'} <= names
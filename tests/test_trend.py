@@ -0,0 +1,44 @@
+"""
+Tests of the direction of travel of both components along a trend of the
+recent distances.
+"""
+
+import pytest
+
+from conftest import COMPONENTS, HOME, KM, setup_component
+
+
+def directions(loaded, kms):
+    """ The direction of travel published after each of the distances. """
+    published = []
+    for km in kms:
+        loaded.report('device_tracker.a', 'not_home', HOME[0] + km * KM,
+                      HOME[1])
+        published.append(loaded.get(loaded.component + '.home').attributes[
+            'dir_of_travel'])
+    return published
+
+
+@pytest.mark.parametrize('component', COMPONENTS)
+def test_trend_rides_out_a_jitter(harness, component):
+    """ A single jump back does not flip the direction of a device that
+    keeps approaching, though it does with the default window. """
+    kms = (20, 19, 18, 18.3, 17)
+    trended = setup_component(harness, component, ['device_tracker.a'],
+                              tolerance=50, trend_window=5)
+    assert directions(trended, kms)[2:] == ['towards'] * 3
+
+    latest = setup_component(harness, component, ['device_tracker.a'],
+                             tolerance=50)
+    assert directions(latest, kms)[2:] == ['towards', 'away_from',
+                                           'towards']
+
+
+@pytest.mark.parametrize('component', COMPONENTS)
+def test_trend_follows_a_sustained_turn(harness, component):
+    """ A device that turns round is soon moving away. """
+    loaded = setup_component(harness, component, ['device_tracker.a'],
+                             tolerance=50, trend_window=3)
+    published = directions(loaded, (20, 19, 18, 19, 20, 21))
+    assert published[2] == 'towards'
+    assert published[-1] == 'away_from'
@@ -0,0 +1,121 @@
+"""
+Tests of the update_devices service of proximity_zones.
+"""
+
+from conftest import HOME, KM, seeded_history, setup_component
+
+
+def test_batch_writes_each_zone_once(harness):
+    """ A batch of devices is evaluated and written once per zone. """
+    devices = ['device_tracker.a', 'device_tracker.b', 'device_tracker.c']
+    proximity_zones = setup_component(harness, 'proximity_zones', devices,
+                                      zones=('home', 'work'))
+    del proximity_zones.writes[:]
+    proximity_zones.call('update_devices', updates=[
+        {'entity_id': device, 'state': 'not_home',
+         'latitude': HOME[0] + km * KM, 'longitude': HOME[1]}
+        for device, km in zip(devices, (5, 10, 20))])
+    assert sorted(entity_id for entity_id, _, _
+                  in proximity_zones.writes) == [
+                      'proximity_zones.home', 'proximity_zones.work']
+    state = proximity_zones.get('proximity_zones.home')
+    assert (state.state, state.attributes['nearest']) == (5, 'a')
+
+
+def test_batch_updates_need_a_state(harness):
+    """ An update without a state is ignored rather than keeping the state
+    of the device's previous position. """
+    proximity_zones = setup_component(harness, 'proximity_zones',
+                                      ['device_tracker.a'])
+    proximity_zones.report('device_tracker.a', 'home', *HOME)
+    proximity_zones.call('update_devices', updates=[
+        {'entity_id': 'device_tracker.a', 'latitude': HOME[0] + 55 * KM,
+         'longitude': HOME[1]}])
+    assert proximity_zones.get('device_tracker.a').attributes[
+        'latitude'] == HOME[0]
+    state = proximity_zones.get('proximity_zones.home')
+    assert (state.state, state.attributes['dir_of_travel']) == (
+        0, 'arrived')
+
+
+def test_batch_state_changes_are_not_evaluated_again(harness):
+    """ The tracker state changes written by a batch reach the listeners
+    once the service has returned, as in Home Assistant, and are neither
+    evaluated again nor counted as skipped. """
+    devices = ['device_tracker.a', 'device_tracker.b']
+    proximity_zones = setup_component(harness, 'proximity_zones', devices,
+                                      zones=('home', 'work'))
+    hass = proximity_zones.hass
+    old_states = {device: hass.states.get(device) for device in devices}
+    listeners, hass.listeners = hass.listeners, {}
+    proximity_zones.call('update_devices', updates=[
+        {'entity_id': device, 'state': 'not_home',
+         'latitude': HOME[0] + km * KM, 'longitude': HOME[1]}
+        for device, km in zip(devices, (5, 10))])
+    hass.listeners = listeners
+    written = len(proximity_zones.writes)
+
+    for device in devices:
+        for action in listeners[device]:
+            action(device, old_states[device], hass.states.get(device))
+    assert len(proximity_zones.writes) == written
+    for zone in ('home', 'work'):
+        diagnostics = proximity_zones.diagnostics('proximity_zones.' + zone)
+        assert diagnostics['events_skipped'] == 0
+
+
+def test_single_update_batches_match_state_changes(harness):
+    """ The service given one update at a time writes what the tracker
+    state changes write. """
+    zones, devices, rows = seeded_history(7, 5, 2, 1000)
+    config = [{'zone': name, 'devices': devices} for name, _, _ in zones]
+
+    tracked = harness('proximity_zones')
+    for name, latitude, longitude in zones:
+        tracked.zone(name, latitude, longitude)
+    tracked.setup(config)
+    tracked.play(rows)
+
+    batched = harness('proximity_zones')
+    for name, latitude, longitude in zones:
+        batched.zone(name, latitude, longitude)
+    batched.setup(config)
+    for timestamp, device, state, latitude, longitude in rows:
+        batched.hass.now = timestamp
+        batched.hass.fire_timers()
+        batched.call('update_devices', updates=[
+            {'entity_id': device, 'state': state, 'latitude': latitude,
+             'longitude': longitude}])
+
+    assert batched.writes == tracked.writes
+
+
+def test_batches_end_at_the_tracked_distances(harness):
+    """ Batches of many updates end with the distances and nearest
+    devices of the same updates made one at a time. """
+    zones, devices, rows = seeded_history(8, 5, 2, 1000)
+    config = [{'zone': name, 'devices': devices} for name, _, _ in zones]
+
+    tracked = harness('proximity_zones')
+    for name, latitude, longitude in zones:
+        tracked.zone(name, latitude, longitude)
+    tracked.setup(config)
+    tracked.play(rows)
+
+    batched = harness('proximity_zones')
+    for name, latitude, longitude in zones:
+        batched.zone(name, latitude, longitude)
+    batched.setup(config)
+    for first in range(0, len(rows), 20):
+        batched.call('update_devices', updates=[
+            {'entity_id': device, 'state': state, 'latitude': latitude,
+             'longitude': longitude}
+            for _, device, state, latitude, longitude
+            in rows[first:first + 20]])
+    assert len(batched.writes) < len(tracked.writes)
+
+    for name, _, _ in zones:
+        entity_id = 'proximity_zones.' + name
+        assert batched.get(entity_id).state == tracked.get(entity_id).state
+        assert batched.get(entity_id).attributes['nearest'] == \
+            tracked.get(entity_id).attributes['nearest']
@@ -0,0 +1,41 @@
+"""
+Tests of the cached zone position of both components.
+"""
+
+import pytest
+
+from conftest import COMPONENTS, HOME, KM, setup_component
+
+
+@pytest.mark.parametrize('component', COMPONENTS)
+def test_moving_the_zone_remeasures_the_devices(harness, component):
+    """ The nearest device is re-measured from the moved zone, without a
+    direction of travel, and later moves are measured from it. """
+    loaded = setup_component(harness, component, ['device_tracker.a'])
+    loaded.report('device_tracker.a', 'not_home', HOME[0] + 10 * KM, HOME[1])
+    loaded.report('device_tracker.a', 'not_home', HOME[0] + 9 * KM, HOME[1])
+
+    loaded.zone('home', HOME[0] + 4 * KM, HOME[1])
+    state = loaded.get(component + '.home')
+    assert state.state == 5
+    assert state.attributes['dir_of_travel'].lower() == 'unknown'
+
+    loaded.report('device_tracker.a', 'not_home', HOME[0] + 12 * KM, HOME[1])
+    state = loaded.get(component + '.home')
+    assert (state.state, state.attributes['dir_of_travel']) == \
+        (8, 'away_from')
+
+
+@pytest.mark.parametrize('component', COMPONENTS)
+def test_editing_the_zone_in_place_measures_nothing(harness, component):
+    """ A zone edit that keeps its position leaves the cache alone. """
+    loaded = setup_component(harness, component, ['device_tracker.a'])
+    loaded.report('device_tracker.a', 'not_home', HOME[0] + 10 * KM, HOME[1])
+    before = loaded.diagnostics(component + '.home')
+    written = len(loaded.writes)
+
+    loaded.zone('home', HOME[0], HOME[1], radius=500)
+    after = loaded.diagnostics(component + '.home')
+    assert after['distance_calculations'] == \
+        before['distance_calculations']
+    assert len(loaded.writes) == written